@@ -0,0 +1,112 @@
+"""
+MPI (mpicasa) helpers for SgrB2 cube imaging.
+
+When a script runs under ``mpicasa -n N casa ...`` the CASA client process
+can hand tclean's channel-parallel cube imaging to N-1 MPI servers by
+passing ``parallel=True``.  ``tclean_parallel()`` decides whether to do so
+(TCLEAN_PARALLEL: 'auto' (default) uses MPI whenever it is running, '1'
+requires it, '0' disables it), and ``write_timing()`` records the wall time
+of the tclean call together with per-rank activity parsed from the CASA
+log, so MPI runs can be compared against the serial chunk arrays.
+
+Per-rank timing is the first and last timestamp and the number of log
+lines posted by each MPIServer-<n> (and the MPIClient) during the call.
+
+Used by image_cubes.py and chunked_imaging/sgrb2_chunk_imaging.py; the
+SLURM scripts start CASA with mpicasa when USE_MPI=1, with the rank count
+taken from SLURM_CPUS_PER_TASK.
+"""
+
+import os
+import re
+import json
+from datetime import datetime
+
+# e.g. "2025-12-17 19:17:56     INFO    tclean::::MPIServer-3   ..."
+LOG_LINE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?)\s+\S+\s+\S*?(MPIServer-\d+|MPIClient)')
+
+
+def mpi_enabled():
+    """True if this CASA session was started with mpicasa."""
+    try:
+        from casampi.MPIEnvironment import MPIEnvironment
+    except ImportError:
+        return False
+    return bool(MPIEnvironment.is_mpi_enabled)
+
+
+def mpi_world_size():
+    """Number of MPI processes (client + servers), 1 without MPI."""
+    if not mpi_enabled():
+        return 1
+    from casampi.MPIEnvironment import MPIEnvironment
+    return int(MPIEnvironment.mpi_world_size)
+
+
+def tclean_parallel():
+    """Value for tclean's ``parallel`` argument, from TCLEAN_PARALLEL."""
+    mode = os.getenv('TCLEAN_PARALLEL', 'auto')
+    if mode == '0':
+        return False
+    enabled = mpi_enabled()
+    if mode == '1' and not enabled:
+        raise RuntimeError("TCLEAN_PARALLEL=1 but CASA was not started with mpicasa")
+    return enabled
+
+
+def parse_time(stamp):
+    """Epoch seconds of a CASA log timestamp ('YYYY-MM-DD HH:MM:SS[.f]')."""
+    fmt = '%Y-%m-%d %H:%M:%S.%f' if '.' in stamp else '%Y-%m-%d %H:%M:%S'
+    return datetime.strptime(stamp, fmt).timestamp()
+
+
+def rank_timing(logfile, t_start=None, t_end=None):
+    """
+    Per-rank activity from a CASA log.
+
+    Returns {rank: {'first', 'last', 'busy_s', 'lines'}}, restricted to log
+    lines between ``t_start`` and ``t_end`` (epoch seconds) if given.
+    """
+    ranks = {}
+    if not logfile or not os.path.exists(logfile):
+        return ranks
+    with open(logfile, errors='replace') as fh:
+        for line in fh:
+            match = LOG_LINE.match(line)
+            if match is None:
+                continue
+            stamp = parse_time(match.group(1))
+            if (t_start is not None and stamp < t_start - 1) or (t_end is not None and stamp > t_end + 1):
+                continue
+            entry = ranks.setdefault(match.group(2), {'first': stamp, 'last': stamp, 'lines': 0})
+            entry['first'] = min(entry['first'], stamp)
+            entry['last'] = max(entry['last'], stamp)
+            entry['lines'] += 1
+    for entry in ranks.values():
+        entry['busy_s'] = entry['last'] - entry['first']
+    return ranks
+
+
+def write_timing(path, imagename, t_start, t_end, logfile=None, parallel=False, **extra):
+    """Write <imagename> tclean timing (wall time, ranks, per-rank activity) as JSON."""
+    ranks = rank_timing(logfile, t_start, t_end) if parallel else {}
+    record = {
+        'imagename': imagename,
+        'mode': 'mpi' if parallel else 'serial',
+        'world_size': mpi_world_size() if parallel else 1,
+        'cpus_per_task': int(os.getenv('SLURM_CPUS_PER_TASK', '1')),
+        'slurm_job_id': os.getenv('SLURM_JOB_ID'),
+        'host': os.uname().nodename,
+        'start': t_start,
+        'end': t_end,
+        'wall_s': t_end - t_start,
+        'ranks': ranks,
+    }
+    record.update(extra)
+    with open(path, 'w') as fh:
+        json.dump(record, fh, indent=2)
+    print(f"tclean wall time {record['wall_s']:.0f}s ({record['mode']}, "
+          f"{record['world_size']} process(es)); timing written to {path}")
+    for rank in sorted(ranks):
+        print(f"  {rank}: active {ranks[rank]['busy_s']:.0f}s, {ranks[rank]['lines']} log lines")
+    return record
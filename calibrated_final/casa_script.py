@@ -0,0 +1,59 @@
+"""
+Command-line and worker-process helpers for the calibrated_final/ scripts.
+
+The scripts run both as ``casa -c <script> ...`` and as ``python <script>``,
+and split their work over worker processes that rerun the same script
+(``sys.executable <script> --<worker option> ...``) and print a JSON result
+as their last line of output.
+
+    script_args(name)      - the arguments after the script's name (casa -c
+                             puts its own options first)
+    script_path(name)      - path of a script in calibrated_final/
+    run_script(name, args) - run a script in a fresh interpreter and return
+                             the finished process (stdout and stderr merged)
+    json_result(proc)      - the JSON result on the last line of a worker's
+                             output, or None (the output tail is printed then)
+
+A script run with ``casa -c`` does not always have ``__file__``, but this
+module is imported, so it always knows where calibrated_final/ is.
+
+Usage:
+    from casa_script import script_args, run_script, json_result
+"""
+
+import os
+import sys
+import json
+import subprocess
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))  # calibrated_final/
+
+
+def script_args(name):
+    """Arguments after the script ``name`` (casa -c puts its own options first)."""
+    for i, arg in enumerate(sys.argv):
+        if arg.endswith(name):
+            return sys.argv[i + 1:]
+    return sys.argv[1:]
+
+
+def script_path(name):
+    """Path of the script ``name`` in calibrated_final/."""
+    return os.path.join(BASEDIR, name)
+
+
+def run_script(name, args):
+    """Run ``name`` with ``args`` in a fresh interpreter; return the CompletedProcess."""
+    return subprocess.run([sys.executable, script_path(name)] + [str(arg) for arg in args],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          universal_newlines=True)
+
+
+def json_result(proc):
+    """The JSON result on the worker's last output line, or None if there is none."""
+    lines = proc.stdout.strip().splitlines()
+    try:
+        return json.loads(lines[-1])
+    except (IndexError, ValueError):
+        print(proc.stdout[-2000:])
+        return None
@@ -1,13 +1,21 @@
 #!/bin/bash
+# Which of the 16 submit_cube_jobs.sh array tasks are queued or running.
+# For chunked imaging progress and ETAs use chunked_imaging/monitor_cubes.py.
+
+# One squeue call; array task IDs of all our jobs
+TASKS=$(squeue -h -r -u $USER -o "%i" | grep "_" | sed 's/.*_//' | sort -n | uniq)
+
 echo "Cube Status Summary"
 echo "==================="
 echo
 echo "Currently RUNNING:"
-squeue -u $USER -o "%i" | grep "_" | sed 's/.*_//' | sort -n | uniq | xargs -I{} echo "  Cube {}"
+for i in $TASKS; do
+  echo "  Cube $i"
+done
 echo
 echo "NOT running and need submission:"
 for i in {0..15}; do
-  if ! squeue -u $USER -o "%i" | grep -q "_${i}$"; then
+  if ! grep -qx "$i" <<< "$TASKS"; then
     echo "  Cube $i"
   fi
 done
@@ -73,8 +73,8 @@ echo
 echo "Checking available disk space..."
 DISK_AVAIL=$(df -h . | awk 'NR==2 {print $4}')
 echo "  Available space: $DISK_AVAIL"
-echo "  Note: Each cube requires ~100-500 GB"
-echo "  Total required: ~2-8 TB for all 16 cubes"
+echo "  Predicted footprint per cube (cube_footprint.py):"
+python3 cube_footprint.py all --free . | sed 's/^/    /'
 echo
 
 # Check 7: SLURM availability
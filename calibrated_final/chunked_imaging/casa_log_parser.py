@@ -0,0 +1,385 @@
+#!/usr/bin/env python
+"""
+Structured timing and convergence records from CASA tclean logs.
+
+Streams a CASA log (e.g. logs/casa_chunk_DS6_spw29_<jobid>.log, plain or
+.gz) line by line -- memory use does not depend on the log size -- and
+emits one record per event:
+
+    task      - one tclean call: start, end, duration_s
+    phase     - one contiguous tclean phase: setup, psf, major (cycle N),
+                minor, automask, restore, pb, ... with start, end, duration_s and
+                the number of log lines it produced
+    minor     - one channel's minor cycle: major cycle, chan, iterations,
+                model flux and peak residual before/after, stop reason, and
+                duration_s (time since the previous minor-cycle record,
+                i.e. 1 s resolution with the default CASA log timestamps;
+                for the first channel of a minor phase the time since the
+                phase opened, or empty if the record itself opened it)
+    automask  - one auto-multithresh summary row: cycle, chan, whether it
+                masked, median/RMS/peak/threshold and region counts
+    residual  - peak residual (within mask and over the full image) and
+                total model flux reported after each major cycle
+
+Phase boundaries come from tclean's banner lines ("---- Make PSF ----",
+"---- Run (Last) Major Cycle 2 ----", ...) and from the log origin of
+minor-cycle (SynthesisDeconvolver) and mask (SDMaskHandler) messages, so
+gridding (psf/major), masking (automask) and deconvolution (minor) time
+can be compared directly.
+
+Records are written as JSON lines (one object per line, written as they are
+parsed), or with --parquet as one Parquet file per record type
+(<prefix>.<type>.parquet, written in row groups of --batch records).
+Parquet needs pyarrow, which is optional.  A per-phase time summary is
+printed at the end.
+
+Usage:
+    python3 casa_log_parser.py <casa.log> [--out records.jsonl | --parquet PREFIX]
+                               [--batch N] [--quiet]
+
+Examples:
+    python3 casa_log_parser.py ../logs/casa_chunk_DS6_spw29_24848843.log
+    python3 casa_log_parser.py ../logs/casa_chunk_DS6_spw29_24848843.log --out ds6_29.jsonl
+    python3 casa_log_parser.py ../logs/casa_chunk_DS6_spw29_24848843.log --parquet ds6_29
+"""
+
+import os
+import re
+import sys
+import gzip
+import json
+import argparse
+
+# casa_mpi.py lives in calibrated_final/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from casa_mpi import parse_time
+
+# ===========================
+# Configuration
+# ===========================
+
+# "2025-12-17 19:17:56<TAB>INFO<TAB>origin<TAB>message"
+LOG_LINE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?)\t(\S+)\t([^\t]*)\t?(.*)$')
+TASK = re.compile(r'##### (Begin|End) Task: (\w+)')
+BANNER = re.compile(r'-{5,}\s*(\S.*?\S)\s*-{5,}')
+MAJOR = re.compile(r'Major Cycle (\d+)')
+# "[img:C12] iters=0->152 [152], model=0->0.123, peakres=0.05->0.01, Reached cyclethreshold."
+MINOR = re.compile(r'\[[^\]]*?:C(\d+)\]\s*iters=(\d+)->(\d+) \[(\d+)\], model=([-\d.eE+]+)->([-\d.eE+]+), '
+                   r'peakres=([-\d.eE+]+)->([-\d.eE+]+),?\s*(.*)$')
+# auto-multithresh summary row: "[C12] T 0.00012 0.0021 0.034 sidelobe 0.0105 3 1 2 0 0"
+AUTOMASK_ROW = re.compile(r'^\s*\[C(\d+)\]\s+([TF])\s+(.*)$')
+AUTOMASK_COLUMNS = ['median', 'rms', 'peak', 'thresh_type', 'thresh_value',
+                    'n_reg', 'n_pruned', 'n_grow', 'n_grow_pruned', 'n_neg_pix']
+RESIDUAL = re.compile(r'Peak residual \(max,min\) (?:within mask )?: \(([-\d.eE+]+),([-\d.eE+]+)\)'
+                      r'(?: over full image : \(([-\d.eE+]+),([-\d.eE+]+)\))?')
+MODEL_FLUX = re.compile(r'Total Model Flux : ([-\d.eE+]+)')
+
+# Banner text -> phase name (first match wins; anything else is lower-cased)
+PHASES = [
+    ('Make PSF', 'psf'),
+    ('Major Cycle', 'major'),
+    ('Minor Cycle', 'minor'),
+    ('Make PB', 'pb'),
+    ('Restor', 'restore'),
+]
+MINOR_ORIGINS = ('SynthesisDeconvolver', 'executeMinorCycle')
+MASK_ORIGINS = ('SDMaskHandler', 'autoMask')
+
+# Record fields (and Parquet types) per record type
+RECORD_FIELDS = {
+    'task': [('task', 'string'), ('start', 'float64'), ('end', 'float64'), ('duration_s', 'float64')],
+    'phase': [('phase', 'string'), ('cycle', 'int64'), ('start', 'float64'), ('end', 'float64'),
+              ('duration_s', 'float64'), ('lines', 'int64')],
+    'minor': [('cycle', 'int64'), ('chan', 'int64'), ('iters_start', 'int64'), ('iters_end', 'int64'),
+              ('niter', 'int64'), ('model_start', 'float64'), ('model_end', 'float64'),
+              ('peakres_start', 'float64'), ('peakres_end', 'float64'), ('stop', 'string'),
+              ('time', 'float64'), ('duration_s', 'float64')],
+    'automask': [('cycle', 'int64'), ('chan', 'int64'), ('masking', 'bool'), ('median', 'float64'),
+                 ('rms', 'float64'), ('peak', 'float64'), ('thresh_type', 'string'),
+                 ('thresh_value', 'float64'), ('n_reg', 'int64'), ('n_pruned', 'int64'),
+                 ('n_grow', 'int64'), ('n_grow_pruned', 'int64'), ('n_neg_pix', 'int64'),
+                 ('time', 'float64')],
+    'residual': [('cycle', 'int64'), ('peak_max', 'float64'), ('peak_min', 'float64'),
+                 ('full_max', 'float64'), ('full_min', 'float64'), ('model_flux', 'float64'),
+                 ('time', 'float64')],
+}
+
+
+# ===========================
+# Parsing
+# ===========================
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', errors='replace')
+    return open(path, errors='replace')
+
+
+def phase_of_banner(text):
+    for key, phase in PHASES:
+        if key in text:
+            return phase
+    return text.lower().replace(' ', '_')
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        try:
+            return float(value)
+        except ValueError:
+            return value
+
+
+class TcleanLogParser:
+    """
+    State machine over CASA log lines.
+
+    ``feed(line)`` yields the records completed by that line; ``finish()``
+    yields whatever is still open at the end of the log.  Only the current
+    task and phase are kept, so memory is constant.
+    """
+
+    def __init__(self):
+        self.task = None          # (name, start)
+        self.phase = None         # dict of the open phase
+        self.cycle = 0            # current major cycle (0 = before the first)
+        self.last_time = None
+        self.last_minor = None
+        self.residual = None
+
+    def _open_phase(self, name, stamp):
+        records = list(self._close_phase(stamp))
+        self.phase = {'phase': name, 'cycle': self.cycle, 'start': stamp, 'lines': 0}
+        self.last_minor = None
+        return records
+
+    def _close_phase(self, stamp):
+        if self.phase is not None:
+            record = dict(self.phase, end=stamp, duration_s=stamp - self.phase['start'])
+            self.phase = None
+            yield 'phase', record
+        if self.residual is not None:
+            yield 'residual', self.residual
+            self.residual = None
+
+    def feed(self, line):
+        match = LOG_LINE.match(line)
+        if match is None:
+            # Multi-line messages (e.g. the automask summary table) continue
+            # without a timestamp
+            if self.last_time is not None:
+                yield from self._message(self.last_time, '', line.rstrip('\n'))
+            return
+        stamp = parse_time(match.group(1))
+        self.last_time = stamp
+        yield from self._message(stamp, match.group(3), match.group(4))
+
+    def _message(self, stamp, origin, message):
+        task = TASK.search(message)
+        if task is not None:
+            if task.group(1) == 'Begin' and task.group(2) == 'tclean':
+                self.task, self.cycle = ('tclean', stamp), 0
+                # Data selection and imager setup until the first banner
+                yield from self._open_phase('setup', stamp)
+            elif task.group(1) == 'End' and self.task is not None and task.group(2) == self.task[0]:
+                yield from self._close_phase(stamp)
+                yield 'task', {'task': self.task[0], 'start': self.task[1], 'end': stamp,
+                               'duration_s': stamp - self.task[1]}
+                self.task = None
+            return
+        if self.task is None:
+            return
+
+        banner = BANNER.search(message)
+        if banner is not None:
+            name = phase_of_banner(banner.group(1))
+            if name == 'major':
+                major = MAJOR.search(banner.group(1))
+                self.cycle = int(major.group(1)) if major else self.cycle + 1
+            for record in self._open_phase(name, stamp):
+                yield record
+        elif any(key in origin for key in MASK_ORIGINS) and (self.phase is None or self.phase['phase'] != 'automask'):
+            yield from self._open_phase('automask', stamp)
+        elif any(key in origin for key in MINOR_ORIGINS) and (self.phase is None or self.phase['phase'] != 'minor'):
+            yield from self._open_phase('minor', stamp)
+        if self.phase is not None:
+            self.phase['lines'] += 1
+
+        minor = MINOR.search(message)
+        if minor is not None:
+            g = minor.groups()
+            start = self.last_minor
+            if start is None and self.phase is not None and self.phase['start'] < stamp:
+                # First channel: from the start of the minor phase, unless
+                # this record opened it (then its start time is unknown)
+                start = self.phase['start']
+            yield 'minor', {
+                'cycle': self.cycle, 'chan': int(g[0]), 'iters_start': int(g[1]), 'iters_end': int(g[2]),
+                'niter': int(g[3]), 'model_start': float(g[4]), 'model_end': float(g[5]),
+                'peakres_start': float(g[6]), 'peakres_end': float(g[7]), 'stop': g[8].strip() or None,
+                'time': stamp, 'duration_s': stamp - start if start is not None else None,
+            }
+            self.last_minor = stamp
+            return
+
+        row = AUTOMASK_ROW.match(message)
+        if row is not None:
+            values = row.group(3).split()
+            record = {'cycle': self.cycle, 'chan': int(row.group(1)), 'masking': row.group(2) == 'T',
+                      'time': stamp}
+            record.update({key: _number(value) for key, value in zip(AUTOMASK_COLUMNS, values)})
+            yield 'automask', record
+            return
+
+        residual = RESIDUAL.search(message)
+        if residual is not None:
+            values = [float(v) if v is not None else None for v in residual.groups()]
+            self.residual = dict(zip(['peak_max', 'peak_min', 'full_max', 'full_min'], values),
+                                 cycle=self.cycle, model_flux=None, time=stamp)
+            return
+        flux = MODEL_FLUX.search(message)
+        if flux is not None and self.residual is not None:
+            self.residual['model_flux'] = float(flux.group(1))
+
+    def finish(self):
+        """Close a phase left open by a truncated (still running or killed) log."""
+        if self.last_time is not None:
+            yield from self._close_phase(self.last_time)
+        if self.task is not None:
+            yield 'task', {'task': self.task[0], 'start': self.task[1], 'end': None, 'duration_s': None}
+
+
+def parse_log(path):
+    """Yield (record_type, record) from a CASA log, streaming."""
+    parser = TcleanLogParser()
+    with open_log(path) as fh:
+        for line in fh:
+            yield from parser.feed(line)
+    yield from parser.finish()
+
+
+# ===========================
+# Output
+# ===========================
+
+class JsonlSink:
+    def __init__(self, path):
+        self.fh = sys.stdout if path in (None, '-') else open(path, 'w')
+
+    def write(self, rtype, record):
+        self.fh.write(json.dumps(dict(record, type=rtype)) + '\n')
+
+    def close(self):
+        if self.fh is not sys.stdout:
+            self.fh.close()
+
+
+class ParquetSink:
+    """One Parquet file per record type, written in row groups of ``batch`` records."""
+
+    def __init__(self, prefix, batch=10000):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa, self.pq = pyarrow, pyarrow.parquet
+        self.prefix, self.batch = prefix, batch
+        self.buffers = {rtype: [] for rtype in RECORD_FIELDS}
+        self.writers = {}
+
+    def _flush(self, rtype):
+        rows = self.buffers[rtype]
+        if not rows:
+            return
+        schema = self.pa.schema([(name, getattr(self.pa, kind)()) for name, kind in RECORD_FIELDS[rtype]])
+        table = self.pa.Table.from_pylist([{name: row.get(name) for name in schema.names} for row in rows],
+                                          schema=schema)
+        if rtype not in self.writers:
+            self.writers[rtype] = self.pq.ParquetWriter(f'{self.prefix}.{rtype}.parquet', schema)
+        self.writers[rtype].write_table(table)
+        rows.clear()
+
+    def write(self, rtype, record):
+        self.buffers[rtype].append(record)
+        if len(self.buffers[rtype]) >= self.batch:
+            self._flush(rtype)
+
+    def close(self):
+        for rtype in self.buffers:
+            self._flush(rtype)
+        for writer in self.writers.values():
+            writer.close()
+
+
+class Summary:
+    """Running per-phase totals for the closing table."""
+
+    def __init__(self):
+        self.phases = {}
+        self.counts = {rtype: 0 for rtype in RECORD_FIELDS}
+        self.tclean_s = 0.
+        self.iterations = 0
+
+    def add(self, rtype, record):
+        self.counts[rtype] += 1
+        if rtype == 'phase':
+            entry = self.phases.setdefault(record['phase'], [0, 0.])
+            entry[0] += 1
+            entry[1] += record['duration_s']
+        elif rtype == 'task' and record['duration_s'] is not None:
+            self.tclean_s += record['duration_s']
+        elif rtype == 'minor':
+            self.iterations += record['niter']
+
+    def print(self, out=sys.stderr):
+        print(f"{self.counts['task']} tclean call(s), {self.tclean_s / 3600.:.2f} h; "
+              f"{self.counts['minor']} channel minor cycles, {self.iterations} iterations; "
+              f"{self.counts['automask']} automask rows", file=out)
+        print(f"{'Phase':12s} {'count':>6s} {'time [h]':>9s} {'fraction':>9s}", file=out)
+        print("-" * 40, file=out)
+        for phase, (count, seconds) in sorted(self.phases.items(), key=lambda item: -item[1][1]):
+            fraction = seconds / self.tclean_s if self.tclean_s else 0.
+            print(f"{phase:12s} {count:6d} {seconds / 3600.:9.2f} {fraction:9.1%}", file=out)
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Structured tclean timing records from a CASA log')
+    parser.add_argument('logfile', help='CASA log (plain or .gz)')
+    parser.add_argument('--out', help='JSON-lines output file (default: stdout)')
+    parser.add_argument('--parquet', metavar='PREFIX',
+                        help='Write <PREFIX>.<type>.parquet files instead (needs pyarrow)')
+    parser.add_argument('--batch', type=int, default=10000, help='Parquet row group size')
+    parser.add_argument('--quiet', action='store_true', help='Do not print the phase summary')
+    args = parser.parse_args(argv)
+
+    if not os.path.exists(args.logfile):
+        print(f"ERROR: {args.logfile} does not exist", file=sys.stderr)
+        return 1
+    if args.parquet:
+        try:
+            sink = ParquetSink(args.parquet, args.batch)
+        except ImportError:
+            print("ERROR: --parquet needs pyarrow (pip install pyarrow); use --out for JSON lines",
+                  file=sys.stderr)
+            return 1
+    else:
+        sink = JsonlSink(args.out)
+
+    summary = Summary()
+    try:
+        for rtype, record in parse_log(args.logfile):
+            sink.write(rtype, record)
+            summary.add(rtype, record)
+    finally:
+        sink.close()
+    if not args.quiet:
+        summary.print()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,186 @@
+"""
+Per-channel beam tables and the common beam for SgrB2 chunked imaging.
+
+The merge used to need a merged .psf before it could call
+``ia.restoringbeam()``, and then took the median major/minor/PA of the
+per-channel beams -- which is not a beam that every channel can be
+convolved to.  This module instead reads the per-channel beams directly
+from each chunk's .psf header (no pixel data is read and nothing has to be
+merged first), holds them as numpy arrays, and computes the smallest
+ellipse that encloses every channel beam.
+
+The beam table is cached in a JSON sidecar (<basename>.cube.I.beams.json)
+together with the modification times of the .psf images it came from, so
+later merges reuse it as long as no chunk .psf has changed.
+"""
+
+import os
+import json
+
+import numpy as np
+
+
+def read_beams(imagename):
+    """
+    Return per-channel beams of a CASA image as arrays.
+
+    Returns (major, minor, pa) in (arcsec, arcsec, deg), one entry per
+    channel; a single-beam image gives one-element arrays.
+    """
+    from casatools import image, quanta
+    qa = quanta()
+    ia = image()
+    ia.open(imagename)
+    beam_info = ia.restoringbeam()
+    ia.close()
+    ia.done()
+
+    if 'beams' in beam_info:
+        # Per-channel beams are stored as beams['*<chan>']['*<stokes>']
+        nchan = len(beam_info['beams'])
+        beams = [beam_info['beams'][f'*{ii}']['*0'] for ii in range(nchan)]
+    else:
+        beams = [beam_info]
+
+    major = np.array([qa.convert(b['major'], 'arcsec')['value'] for b in beams])
+    minor = np.array([qa.convert(b['minor'], 'arcsec')['value'] for b in beams])
+    pa = np.array([qa.convert(b.get('positionangle', b.get('pa')), 'deg')['value'] for b in beams])
+    return major, minor, pa
+
+
+def _covariance(major, minor, pa):
+    """
+    Second-moment matrices (in the north/east frame) of Gaussian beams.
+
+    Returns arrays (sxx, syy, sxy) where x is along north and y along east,
+    in units of arcsec**2 (FWHM**2, the constant factor does not matter).
+    """
+    pa_rad = np.deg2rad(pa)
+    cos, sin = np.cos(pa_rad), np.sin(pa_rad)
+    sxx = major**2 * cos**2 + minor**2 * sin**2
+    syy = major**2 * sin**2 + minor**2 * cos**2
+    sxy = (major**2 - minor**2) * cos * sin
+    return sxx, syy, sxy
+
+
+def common_beam(major, minor, pa, npa=180, na=400, epsilon=5e-4):
+    """
+    Smallest-area beam that encloses every input beam.
+
+    Every input beam must be deconvolvable from the result, i.e. the
+    result's covariance minus each beam's covariance is positive
+    semi-definite.  For each trial orientation of the common beam's major
+    axis the smallest enclosing ellipse has a closed form for the minor
+    axis given the major axis, so the search is a vectorized grid over
+    orientation and major axis.  The result is inflated by ``epsilon`` so
+    each channel stays strictly deconvolvable.
+
+    Returns (major, minor, pa) in the input units.
+    """
+    major = np.atleast_1d(np.asarray(major, dtype=float))
+    minor = np.atleast_1d(np.asarray(minor, dtype=float))
+    pa = np.atleast_1d(np.asarray(pa, dtype=float))
+
+    # If the largest beam already encloses all the others, it is the answer
+    imax = np.argmax(major * minor)
+    sxx, syy, sxy = _covariance(major, minor, pa)
+    cxx, cyy, cxy = _covariance(major[imax], minor[imax], pa[imax])
+    dxx, dyy, dxy = cxx - sxx, cyy - syy, cxy - sxy
+    if np.all((dxx >= -1e-12) & (dyy >= -1e-12) & (dxx * dyy - dxy**2 >= -1e-12)):
+        return (major[imax] * (1 + epsilon), minor[imax] * (1 + epsilon), pa[imax])
+
+    best = (np.inf, None)
+    angles = np.linspace(0., 180., npa, endpoint=False)
+    for theta in angles:
+        # Rotate every beam into the frame of the trial major axis
+        t = np.deg2rad(theta)
+        cos, sin = np.cos(t), np.sin(t)
+        p = sxx * cos**2 + 2 * sxy * cos * sin + syy * sin**2   # along trial major
+        r = sxx * sin**2 - 2 * sxy * cos * sin + syy * cos**2   # along trial minor
+        q = (syy - sxx) * cos * sin + sxy * (cos**2 - sin**2)
+
+        # For major-axis variance a > max(p), the minimum minor-axis variance
+        # is b(a) = max_i(r_i + q_i**2 / (a - p_i))
+        amin = p.max()
+        a = amin * (1 + np.geomspace(1e-6, 4., na))
+        b = np.max(r[None, :] + q[None, :]**2 / (a[:, None] - p[None, :]), axis=1)
+        b = np.maximum(b, r.max())
+        area = a * b
+        ii = np.argmin(area)
+        if area[ii] < best[0]:
+            best = (area[ii], (a[ii], b[ii], theta))
+
+    a, b, theta = best[1]
+    if b > a:
+        a, b, theta = b, a, theta + 90.
+    theta = (theta + 90.) % 180. - 90.
+    return (np.sqrt(a) * (1 + epsilon), np.sqrt(b) * (1 + epsilon), theta)
+
+
+def beam_dict(major, minor, pa):
+    """Format a beam as the quantity dict used by the merge/restore code."""
+    return {
+        'major': {'value': float(major), 'unit': 'arcsec'},
+        'minor': {'value': float(minor), 'unit': 'arcsec'},
+        'pa': {'value': float(pa), 'unit': 'deg'},
+    }
+
+
+def sidecar_path(basename):
+    return f'{basename}.cube.I.beams.json'
+
+
+def chunk_beam_table(basename, chunk_bases, log=print):
+    """
+    Beam table for a chunked cube, read from the chunk .psf headers.
+
+    Uses the cached sidecar when every chunk .psf is unchanged since it was
+    written; otherwise rereads the headers and rewrites the sidecar.
+
+    Returns a dict with per-chunk arrays (as lists) and the common beam:
+        {'chunks': {chunk_base: {'mtime', 'major', 'minor', 'pa'}},
+         'common_beam': {'major', 'minor', 'pa'}}
+    """
+    path = sidecar_path(basename)
+    cached = {'chunks': {}}
+    if os.path.exists(path):
+        with open(path) as fh:
+            cached = json.load(fh)
+
+    table = {'chunks': {}}
+    reread = 0
+    for cb in chunk_bases:
+        psf = f'{cb}.psf'
+        entry = cached['chunks'].get(cb)
+        if not os.path.exists(psf):
+            # Chunk .psf already cleaned up after an incremental merge:
+            # keep the beams recorded while it existed
+            if entry is not None:
+                table['chunks'][cb] = entry
+            continue
+        mtime = os.path.getmtime(psf)
+        if entry is None or entry['mtime'] != mtime:
+            major, minor, pa = read_beams(psf)
+            entry = {'mtime': mtime, 'major': major.tolist(),
+                     'minor': minor.tolist(), 'pa': pa.tolist()}
+            reread += 1
+        table['chunks'][cb] = entry
+
+    if not table['chunks']:
+        raise FileNotFoundError(f"No chunk .psf found for {basename}")
+
+    if reread == 0 and 'common_beam' in cached and set(cached['chunks']) == set(table['chunks']):
+        log(f"  Using cached beam table {path}")
+        return cached
+
+    major = np.concatenate([table['chunks'][cb]['major'] for cb in table['chunks']])
+    minor = np.concatenate([table['chunks'][cb]['minor'] for cb in table['chunks']])
+    pa = np.concatenate([table['chunks'][cb]['pa'] for cb in table['chunks']])
+    table['common_beam'] = beam_dict(*common_beam(major, minor, pa))
+    log(f"  Read beams from {reread} chunk .psf headers ({len(major)} channels)")
+
+    with open(f'{path}.tmp', 'w') as fh:
+        json.dump(table, fh, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+    return table
@@ -0,0 +1,397 @@
+#!/usr/bin/env python
+"""
+Per-chunk throughput benchmark for SgrB2 chunked cube imaging.
+
+Collects, for every chunk job that has run:
+
+    logs/chunk_*_<A>_<a>.log        - field, SPW, STARTCHAN, NCHAN_CHUNK, exit
+                                      status (slurm_chunk_job.sh header)
+    logs/casa_chunk_*_<jobid>.log   - tclean begin/end timestamps
+    <WORK_DIR>/*.timing.json        - tclean wall time, MPI/serial mode
+                                      (casa_mpi.write_timing)
+    sacct                           - queue wait, elapsed time, CPU time,
+                                      peak RSS and requested memory (one call
+                                      for all jobs)
+
+and writes one CSV row per chunk job (chunk_benchmark.csv) plus a
+per-field/SPW summary (chunk_benchmark_summary.csv, also printed) with
+channels per hour, wall time, peak RSS, CPU efficiency and queue wait.
+
+With --calibration-out, the chunk planner's runtime coefficients are
+fitted to the measured tclean wall times (least squares over
+setup + read*Mrows + nchan*(grid*Mrows + image*Mpix), using the MS catalog
+row counts) and the median queue wait, and written as a JSON file that
+chunk_planner.py --calibration accepts.
+
+Pure python (numpy for the fit); sacct is optional (--no-sacct, or when it
+is not on PATH, leaves the accounting columns empty).
+
+Usage:
+    python3 chunk_benchmark.py [--log-dir DIR] [--out-dir DIR] [--field F] [--spw S]
+                               [--calibration-out calib.json] [--no-sacct]
+
+Examples:
+    python3 chunk_benchmark.py
+    python3 chunk_benchmark.py --field DS6 --calibration-out ../logs/planner_calibration.json
+    python3 chunk_planner.py DS6 29 --calibration ../logs/planner_calibration.json
+"""
+
+import os
+import re
+import csv
+import sys
+import glob
+import json
+import argparse
+import subprocess
+from statistics import median
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import chunk_planner
+
+# casa_mpi.py lives in calibrated_final/
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+import casa_mpi
+
+# ===========================
+# Configuration
+# ===========================
+
+BASEDIR = os.path.dirname(SCRIPT_DIR)  # calibrated_final/
+LOG_DIR = os.path.join(BASEDIR, 'logs')
+WORK_BASE = os.path.join(BASEDIR, 'working_chunks')
+
+CHUNK_LOG = re.compile(r'chunk_.*?(\d+)_(\d+)\.log$')
+HEADER = re.compile(r'^\s+(FIELD|SPW|STARTCHAN|NCHAN_CHUNK|WORK_DIR|SLURM_JOB_ID|QUICKLOOK)=(.*)$')
+CASA_TASK = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d(?:\.\d+)?)\s.*##### (Begin|End) Task: tclean')
+
+SACCT_FIELDS = ['JobID', 'State', 'Submit', 'Start', 'End', 'ElapsedRaw', 'TotalCPU',
+                'AllocCPUS', 'MaxRSS', 'ReqMem', 'NodeList']
+
+COLUMNS = ['field', 'spw', 'startchan', 'nchan', 'job_id', 'slurm_job_id', 'state', 'node',
+           'mode', 'quicklook', 'queue_wait_s', 'elapsed_s', 'tclean_s', 'chan_per_hour',
+           'maxrss_gb', 'reqmem_gb', 'alloc_cpus', 'cpu_eff', 'mrows', 'log']
+
+GB = 1024**3
+
+
+# ===========================
+# Parsing
+# ===========================
+
+def parse_time(stamp):
+    """Epoch seconds of a CASA log or sacct ('YYYY-MM-DDTHH:MM:SS') stamp, None if unset."""
+    if not stamp or stamp in ('Unknown', 'None'):
+        return None
+    return casa_mpi.parse_time(stamp.replace('T', ' '))
+
+
+def parse_duration(value):
+    """Seconds of a SLURM duration, e.g. '1-02:03:04', '02:03:04.5' or '03:04.123' (None if unset)."""
+    if not value or value in ('INVALID', 'UNLIMITED'):
+        return None
+    days = 0
+    if '-' in value:
+        days, value = value.split('-', 1)
+    parts = [float(part) for part in value.split(':')]
+    while len(parts) < 3:
+        parts.insert(0, 0.)
+    return int(days) * 86400 + parts[0] * 3600 + parts[1] * 60 + parts[2]
+
+
+def parse_size_gb(value):
+    """GB of a sacct size such as '12345K', '32G' or '32Gn' (per-node suffix)."""
+    if not value:
+        return None
+    value = value.rstrip('nc')
+    units = {'K': 1. / 1024**2, 'M': 1. / 1024, 'G': 1., 'T': 1024.}
+    if value[-1] in units:
+        return float(value[:-1]) * units[value[-1]]
+    return float(value) / GB
+
+
+def parse_chunk_log(path):
+    """Header values and exit status of one slurm_chunk_job.sh log."""
+    match = CHUNK_LOG.search(os.path.basename(path))
+    info = {'log': path, 'job_id': f"{match.group(1)}_{match.group(2)}"}
+    with open(path, errors='replace') as fh:
+        for line in fh:
+            header = HEADER.match(line)
+            if header and header.group(1).lower() not in info:
+                info[header.group(1).lower()] = header.group(2).strip()
+            elif 'Chunk imaging completed successfully' in line:
+                info['exit'] = 0
+            elif line.startswith('CASA exited with code'):
+                info['exit'] = int(line.split()[-1])
+    return info
+
+
+def tclean_seconds(casa_log):
+    """Wall time of the (last) tclean call in a CASA log, or None."""
+    begin = end = None
+    with open(casa_log, errors='replace') as fh:
+        for line in fh:
+            match = CASA_TASK.match(line)
+            if match is None:
+                continue
+            if match.group(2) == 'Begin':
+                begin, end = parse_time(match.group(1)), None
+            else:
+                end = parse_time(match.group(1))
+    if begin is None or end is None:
+        return None
+    return end - begin
+
+
+def load_timings(work_base):
+    """{slurm_job_id: timing record} from every <imagename>.timing.json."""
+    timings = {}
+    for path in glob.glob(os.path.join(work_base, '**', '*.timing.json'), recursive=True):
+        try:
+            with open(path) as fh:
+                record = json.load(fh)
+        except (OSError, ValueError):
+            continue
+        if record.get('slurm_job_id'):
+            timings[str(record['slurm_job_id'])] = record
+    return timings
+
+
+def sacct_records(job_ids):
+    """
+    Accounting for array tasks, from one sacct call.
+
+    Returns {'<A>_<a>': {...}}; MaxRSS comes from the .batch step.
+    """
+    if not job_ids:
+        return {}
+    array_ids = sorted({job_id.split('_')[0] for job_id in job_ids})
+    cmd = ['sacct', '-P', '-n', '-j', ','.join(array_ids), f"--format={','.join(SACCT_FIELDS)}"]
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        print("WARNING: sacct not available; accounting columns left empty")
+        return {}
+    records = {}
+    for line in out.splitlines():
+        values = dict(zip(SACCT_FIELDS, line.split('|')))
+        job_id, _, step = values['JobID'].partition('.')
+        entry = records.setdefault(job_id, {})
+        if step == '':
+            entry.update(values)
+        elif step == 'batch':
+            entry['MaxRSS'] = values['MaxRSS']
+    return records
+
+
+# ===========================
+# Report
+# ===========================
+
+def collect(log_dir=LOG_DIR, work_base=WORK_BASE, use_sacct=True, field=None, spw=None):
+    """One row per chunk job found in log_dir."""
+    infos = [parse_chunk_log(path) for path in sorted(glob.glob(os.path.join(log_dir, 'chunk_*.log')))
+             if CHUNK_LOG.search(os.path.basename(path))]
+    infos = [info for info in infos if 'field' in info and 'spw' in info
+             and (field is None or info['field'] == field) and (spw is None or info['spw'] == spw)]
+    accounting = sacct_records([info['job_id'] for info in infos]) if use_sacct else {}
+    timings = load_timings(work_base)
+    rows_cache = {}
+
+    rows = []
+    for info in infos:
+        key = (info['field'], info['spw'])
+        if key not in rows_cache:
+            ms_rows = chunk_planner.catalog_rows(*key)
+            rows_cache[key] = sum(ms_rows or [chunk_planner.DEFAULT_ROWS_PER_MS] * chunk_planner.NMS) / 1e6
+        totalnchan = chunk_planner.TOTALNCHAN.get(info['spw'], 0)
+        startchan = int(info.get('startchan', 0))
+        nchan = max(0, min(int(info.get('nchan_chunk', 0)), totalnchan - startchan))
+
+        acct = accounting.get(info['job_id'], {})
+        timing = timings.get(info.get('slurm_job_id', ''), {})
+        tclean = timing.get('wall_s')
+        casa_logs = glob.glob(os.path.join(log_dir, f"casa_chunk_{info['field']}_spw{info['spw']}_"
+                                                    f"{info.get('slurm_job_id', 'none')}.log"))
+        if tclean is None and casa_logs:
+            tclean = tclean_seconds(casa_logs[0])
+
+        submit, start = parse_time(acct.get('Submit')), parse_time(acct.get('Start'))
+        elapsed = float(acct['ElapsedRaw']) if acct.get('ElapsedRaw') else None
+        cpu = parse_duration(acct.get('TotalCPU'))
+        ncpu = int(acct['AllocCPUS']) if acct.get('AllocCPUS') else None
+        duration = tclean or elapsed
+        state = acct.get('State') or ('COMPLETED' if info.get('exit') == 0 else
+                                      f"EXIT {info['exit']}" if 'exit' in info else 'UNKNOWN')
+        rows.append({
+            'field': info['field'],
+            'spw': info['spw'],
+            'startchan': startchan,
+            'nchan': nchan,
+            'job_id': info['job_id'],
+            'slurm_job_id': info.get('slurm_job_id'),
+            'state': state.split()[0] if state.startswith('CANCELLED') else state,
+            'node': acct.get('NodeList'),
+            'mode': timing.get('mode'),
+            'quicklook': info.get('quicklook', '0') == '1',
+            'queue_wait_s': start - submit if submit and start else None,
+            'elapsed_s': elapsed,
+            'tclean_s': tclean,
+            'chan_per_hour': nchan / duration * 3600. if duration else None,
+            'maxrss_gb': parse_size_gb(acct.get('MaxRSS')),
+            'reqmem_gb': parse_size_gb(acct.get('ReqMem')),
+            'alloc_cpus': ncpu,
+            'cpu_eff': cpu / (elapsed * ncpu) if cpu is not None and elapsed and ncpu else None,
+            'mrows': rows_cache[key],
+            'log': info['log'],
+        })
+    return rows
+
+
+def _median(values):
+    values = [value for value in values if value is not None]
+    return median(values) if values else None
+
+
+def _hours(seconds):
+    return seconds / 3600. if seconds is not None else None
+
+
+def summarize(rows):
+    """Per-field/SPW summary of successful chunk jobs."""
+    groups = {}
+    for row in rows:
+        groups.setdefault((row['field'], row['spw'], row['nchan']), []).append(row)
+    summary = []
+    for (field, spw, nchan), group in sorted(groups.items()):
+        ok = [row for row in group if row['state'] == 'COMPLETED']
+        rss = [row['maxrss_gb'] for row in ok if row['maxrss_gb'] is not None]
+        summary.append({
+            'field': field,
+            'spw': spw,
+            'nchan': nchan,
+            'jobs': len(group),
+            'completed': len(ok),
+            'median_chan_per_hour': _median(row['chan_per_hour'] for row in ok),
+            'median_wall_h': _hours(_median(row['tclean_s'] or row['elapsed_s'] for row in ok)),
+            'max_rss_gb': max(rss) if rss else None,
+            'reqmem_gb': _median(row['reqmem_gb'] for row in group),
+            'median_cpu_eff': _median(row['cpu_eff'] for row in ok),
+            'median_queue_wait_h': _hours(_median(row['queue_wait_s'] for row in group)),
+        })
+    return summary
+
+
+def fit_calibration(rows, imsize=chunk_planner.IMSIZE):
+    """
+    Fit the planner's runtime coefficients to measured tclean wall times.
+
+    Returns a dict with the fitted keys of chunk_planner.COST_MODEL (negative
+    fits fall back to the current defaults) and the number of jobs used.
+    The read rate is only fitted when the jobs' row counts differ.
+    """
+    import numpy as np
+    mpix = imsize[0] * imsize[1] / 1e6
+    ok = [row for row in rows if row['state'] == 'COMPLETED' and row['tclean_s'] and not row['quicklook']]
+    if len(ok) < 4:
+        raise ValueError(f"Need at least 4 completed full-resolution chunk jobs, have {len(ok)}")
+    mrows = np.array([row['mrows'] for row in ok])
+    nchan = np.array([row['nchan'] for row in ok], dtype=float)
+    wall = np.array([row['tclean_s'] for row in ok])
+    model = chunk_planner.COST_MODEL
+    calib = {}
+    if np.ptp(mrows) > 0.05 * mrows.mean():
+        design = np.column_stack([np.ones_like(mrows), mrows, nchan * mrows, nchan * mpix])
+        coeffs, *_ = np.linalg.lstsq(design, wall, rcond=None)
+        keys = ['setup_s', 'read_s_per_mrow', 'grid_s_per_mrow', 'image_s_per_mpix']
+    else:
+        # All jobs read the same visibilities: only the fixed and per-channel
+        # costs are separable.  Keep the read rate, and split the per-channel
+        # cost between gridding and imaging in the current model's ratio.
+        (fixed, per_chan), *_ = np.linalg.lstsq(np.column_stack([np.ones_like(nchan), nchan]), wall, rcond=None)
+        m = mrows.mean()
+        grid, image = model['grid_s_per_mrow'] * m, model['image_s_per_mpix'] * mpix
+        scale = per_chan / (grid + image)
+        coeffs = [fixed - model['read_s_per_mrow'] * m, model['grid_s_per_mrow'] * scale,
+                  model['image_s_per_mpix'] * scale]
+        keys = ['setup_s', 'grid_s_per_mrow', 'image_s_per_mpix']
+    for key, value in zip(keys, coeffs):
+        calib[key] = float(value) if value > 0 else model[key]
+    waits = [row['queue_wait_s'] for row in rows if row['queue_wait_s'] is not None]
+    if waits:
+        calib['queue_s'] = float(median(waits))
+    calib['fitted_jobs'] = len(ok)
+    return calib
+
+
+def write_csv(path, rows, columns):
+    with open(path, 'w', newline='') as fh:
+        writer = csv.DictWriter(fh, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({key: (f'{value:.4g}' if isinstance(value, float) else value)
+                             for key, value in row.items()})
+
+
+def _fmt(value, spec):
+    return format(value, spec) if value is not None else format('-', '>' + spec.split('.')[0])
+
+
+def print_summary(summary):
+    print("{:15s} {:>4s} {:>6s} {:>5s} {:>5s} {:>8s} {:>8s} {:>8s} {:>8s} {:>6s} {:>8s}".format(
+        "Field", "SPW", "nchan", "jobs", "ok", "chan/h", "wall[h]", "RSS[GB]", "req[GB]", "CPUeff", "queue[h]"))
+    print("-" * 96)
+    for entry in summary:
+        print(f"{entry['field']:15s} {entry['spw']:>4s} {entry['nchan']:6d} {entry['jobs']:5d} "
+              f"{entry['completed']:5d} {_fmt(entry['median_chan_per_hour'], '8.1f')} "
+              f"{_fmt(entry['median_wall_h'], '8.2f')} {_fmt(entry['max_rss_gb'], '8.1f')} "
+              f"{_fmt(entry['reqmem_gb'], '8.0f')} {_fmt(entry['median_cpu_eff'], '6.2f')} "
+              f"{_fmt(entry['median_queue_wait_h'], '8.2f')}")
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Per-chunk throughput benchmark from job logs and sacct')
+    parser.add_argument('--log-dir', default=LOG_DIR)
+    parser.add_argument('--work-base', default=WORK_BASE, help='Where to look for *.timing.json')
+    parser.add_argument('--out-dir', default=None, help='Directory for the CSVs (default: --log-dir)')
+    parser.add_argument('--field', help='Only this field')
+    parser.add_argument('--spw', help='Only this SPW')
+    parser.add_argument('--no-sacct', action='store_true', help='Do not query SLURM accounting')
+    parser.add_argument('--calibration-out', metavar='JSON',
+                        help='Fit planner runtime coefficients and write them here')
+    args = parser.parse_args(argv)
+
+    rows = collect(args.log_dir, args.work_base, use_sacct=not args.no_sacct,
+                   field=args.field, spw=args.spw)
+    if not rows:
+        print(f"No chunk job logs found in {args.log_dir}")
+        return 1
+
+    out_dir = args.out_dir or args.log_dir
+    os.makedirs(out_dir, exist_ok=True)
+    summary = summarize(rows)
+    write_csv(os.path.join(out_dir, 'chunk_benchmark.csv'), rows, COLUMNS)
+    write_csv(os.path.join(out_dir, 'chunk_benchmark_summary.csv'), summary, list(summary[0]))
+
+    print_summary(summary)
+    print(f"\n{len(rows)} chunk jobs; wrote chunk_benchmark.csv and chunk_benchmark_summary.csv to {out_dir}")
+
+    if args.calibration_out:
+        calib = fit_calibration(rows)
+        with open(args.calibration_out, 'w') as fh:
+            json.dump(calib, fh, indent=2)
+        print(f"Fitted cost model from {calib['fitted_jobs']} jobs: "
+              + ", ".join(f"{key}={value:.1f}" for key, value in calib.items() if key != 'fitted_jobs'))
+        print(f"Wrote {args.calibration_out} (use with chunk_planner.py --calibration)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,268 @@
+"""
+Lease files for SgrB2 chunk jobs, so crashed chunks can be reclaimed.
+
+A chunk job holds <imagename>.lease while it images, a small JSON file with
+the host, SLURM job ID, pid and a heartbeat timestamp.  The heartbeat is
+refreshed by a separate process (this file, run with ``heartbeat``) rather
+than a thread, because tclean does not release the GIL and a thread would
+stall for the whole run.  The heartbeat process exits when the job process
+dies, so the lease of a crashed or preempted job stops being refreshed and
+expires after LEASE_TIMEOUT seconds.
+
+On startup a chunk job that finds partial products (.psf without a .done
+marker) checks the lease:
+
+    fresh lease    - another job is working on the chunk: exit 1
+    expired lease  - the previous job is gone: take over its lease, then
+                     remove its partial products
+    no lease       - products from a job without a lease: treated as
+                     expired once the newest product is older than
+                     LEASE_TIMEOUT
+
+The lease is created atomically (a hard link of a temporary file, which
+fails if the lease exists, also on NFS), and an expired lease is moved aside
+with a rename that only one job can win.  When several jobs reclaim the
+same chunk, exactly one gets the lease; acquire_lease returns None to the
+others.
+
+With LEASE_REUSE_PSF=1 a complete-looking PSF (.psf, .sumwt, .pb and
+.weight present) is kept and tclean is rerun with calcpsf=False.
+
+Environment variables:
+
+    LEASE_TIMEOUT   - seconds without a heartbeat before a lease is expired
+                      (default: 900)
+    LEASE_HEARTBEAT - seconds between heartbeats (default: 60)
+    LEASE_REUSE_PSF - '1' to keep the PSF products of a reclaimed chunk
+
+Usage (heartbeat process, started by ``acquire_lease``):
+    python chunk_lease.py heartbeat <lease_path> <owner_pid> <interval>
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import subprocess
+
+CHUNK_PRODUCTS = (".residual", ".model", ".mask", ".pb", ".psf", ".weight", ".sumwt", ".image")
+PSF_PRODUCTS = (".psf", ".sumwt", ".pb", ".weight")
+
+
+def lease_timeout():
+    return float(os.getenv('LEASE_TIMEOUT', '900'))
+
+
+def heartbeat_interval():
+    return float(os.getenv('LEASE_HEARTBEAT', '60'))
+
+
+def lease_path(imagename):
+    return f'{imagename}.lease'
+
+
+def read_lease(imagename):
+    """Return the lease dict for a chunk, or None if there is none (or it is unreadable)."""
+    try:
+        with open(lease_path(imagename)) as fh:
+            return json.load(fh)
+    except (OSError, ValueError):
+        return None
+
+
+def _write_lease(path, lease):
+    with open(f'{path}.tmp.{os.getpid()}', 'w') as fh:
+        json.dump(lease, fh)
+    os.replace(f'{path}.tmp.{os.getpid()}', path)
+
+
+def _create_lease(path, lease):
+    """Create the lease file only if there is none; True if this process created it."""
+    tmp = f'{path}.tmp.{socket.gethostname()}.{os.getpid()}'
+    with open(tmp, 'w') as fh:
+        json.dump(lease, fh)
+    try:
+        os.link(tmp, path)
+        return True
+    except FileExistsError:
+        return False
+    finally:
+        os.remove(tmp)
+
+
+def _expired(lease, timeout=None):
+    if timeout is None:
+        timeout = lease_timeout()
+    return time.time() - lease['heartbeat'] >= lease.get('timeout', timeout)
+
+
+def product_age(imagename):
+    """Seconds since any product of the chunk was last modified (None if there are none)."""
+    mtimes = [os.path.getmtime(f'{imagename}{sfx}') for sfx in CHUNK_PRODUCTS
+              if os.path.exists(f'{imagename}{sfx}')]
+    if not mtimes:
+        return None
+    return time.time() - max(mtimes)
+
+
+def lease_state(imagename, timeout=None):
+    """
+    Classify the chunk's lease as 'fresh', 'expired' or 'none'.
+
+    Without a lease file the chunk's products are used as the heartbeat:
+    'fresh' if they were modified within the timeout, else 'expired'
+    ('none' only if there are no products either).
+    """
+    if timeout is None:
+        timeout = lease_timeout()
+    lease = read_lease(imagename)
+    if lease is not None:
+        return 'expired' if _expired(lease, timeout) else 'fresh'
+    age = product_age(imagename)
+    if age is None:
+        return 'none'
+    return 'fresh' if age < timeout else 'expired'
+
+
+def describe_lease(imagename):
+    lease = read_lease(imagename)
+    if lease is None:
+        return "no lease"
+    age = time.time() - lease['heartbeat']
+    return (f"job {lease['job_id']} on {lease['host']} (pid {lease['pid']}), "
+            f"last heartbeat {age:.0f}s ago")
+
+
+def reclaim_chunk(imagename, reuse_psf=None, log=print):
+    """
+    Remove the partial products of an abandoned chunk.  Call it holding
+    the chunk's lease (``acquire_lease``), which is left in place.
+
+    Returns True if the PSF products were kept for reuse (tclean can then
+    run with calcpsf=False).
+    """
+    if reuse_psf is None:
+        reuse_psf = os.getenv('LEASE_REUSE_PSF', '0') == '1'
+    keep = ()
+    if reuse_psf and all(os.path.exists(f'{imagename}{sfx}') for sfx in PSF_PRODUCTS):
+        keep = PSF_PRODUCTS
+    for sfx in CHUNK_PRODUCTS:
+        # .tmp_copy: interrupted copy-back from scratch (chunk_staging.py)
+        for path in (f'{imagename}{sfx}.tmp_copy', f'{imagename}{sfx}'):
+            if (sfx in keep and path == f'{imagename}{sfx}') or not os.path.exists(path):
+                continue
+            log(f"  Removing partial product {path}")
+            shutil.rmtree(path)
+    return bool(keep)
+
+
+def acquire_lease(imagename):
+    """
+    Take the lease for a chunk and start its heartbeat process.
+
+    An existing lease is only taken over once it has expired.  Returns the
+    heartbeat ``subprocess.Popen`` (pass it to ``release_lease``), or None
+    if another job holds the lease or took it over first.
+    """
+    now = time.time()
+    job_id = os.getenv('SLURM_JOB_ID', f'pid{os.getpid()}')
+    if os.getenv('SLURM_ARRAY_TASK_ID'):
+        job_id = f"{os.getenv('SLURM_ARRAY_JOB_ID', job_id)}_{os.getenv('SLURM_ARRAY_TASK_ID')}"
+    lease = {'host': socket.gethostname(),
+             'job_id': job_id,
+             'pid': os.getpid(),
+             'started': now,
+             'heartbeat': now,
+             'timeout': lease_timeout()}
+    path = lease_path(imagename)
+    if not _create_lease(path, lease):
+        held = read_lease(imagename)
+        if held is not None and not _expired(held):
+            return None
+        # Move the expired lease aside; only one job's rename succeeds
+        stale = f'{path}.stale.{socket.gethostname()}.{os.getpid()}'
+        try:
+            os.rename(path, stale)
+        except FileNotFoundError:
+            return None
+        try:
+            with open(stale) as fh:
+                moved = json.load(fh)
+        except (OSError, ValueError):
+            moved = None
+        if moved is not None and not _expired(moved):
+            # Another job took over between our check and the rename: put its lease back
+            try:
+                os.link(stale, path)
+            except FileExistsError:
+                pass
+            os.remove(stale)
+            return None
+        os.remove(stale)
+        if not _create_lease(path, lease):
+            return None
+    held = read_lease(imagename)
+    if held is None or (held['job_id'], held['pid'], held['host']) != (job_id, lease['pid'], lease['host']):
+        return None
+    return subprocess.Popen([sys.executable, os.path.abspath(__file__), 'heartbeat',
+                             os.path.abspath(path), str(os.getpid()),
+                             str(heartbeat_interval())])
+
+
+def release_lease(imagename, heartbeat):
+    """Stop the heartbeat process and remove the lease."""
+    heartbeat.terminate()
+    heartbeat.wait()
+    if os.path.exists(lease_path(imagename)):
+        os.remove(lease_path(imagename))
+
+
+def abandon_lease(imagename, heartbeat):
+    """
+    Stop the heartbeat after a failure and expire the lease immediately.
+
+    The lease file is kept (with a zero heartbeat) so the partial products
+    are reclaimed by the next job instead of being mistaken for output of a
+    job that predates leases.
+    """
+    heartbeat.terminate()
+    heartbeat.wait()
+    lease = read_lease(imagename)
+    if lease is not None:
+        lease['heartbeat'] = 0.
+        _write_lease(lease_path(imagename), lease)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def heartbeat_loop(path, owner_pid, interval):
+    """Refresh the lease heartbeat while the owning process is alive and still owns it."""
+    while _pid_alive(owner_pid):
+        try:
+            with open(path) as fh:
+                lease = json.load(fh)
+        except (OSError, ValueError):
+            return
+        if lease['pid'] != owner_pid or lease['host'] != socket.gethostname():
+            # Another job reclaimed the chunk
+            return
+        lease['heartbeat'] = time.time()
+        _write_lease(path, lease)
+        time.sleep(interval)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 5 or sys.argv[1] != 'heartbeat':
+        print("Usage: python chunk_lease.py heartbeat <lease_path> <owner_pid> <interval>")
+        sys.exit(1)
+    heartbeat_loop(sys.argv[2], int(sys.argv[3]), float(sys.argv[4]))
@@ -0,0 +1,243 @@
+"""
+Concatenation helpers for the SgrB2 chunked imaging merge stage.
+
+``ia.imageconcat(mode='p')`` physically copies every chunk, so merging a
+cube temporarily needs twice its size on disk.  Products that are rarely
+read (by default .psf, .weight, .sumwt and .mask) are instead merged with
+``mode='n'``: a virtual concatenation that references the chunk images in
+place.  Physical copies can be made later with ``materialize_product``.
+
+Every merge also writes a channel-to-chunk index
+(<basename>.cube.I.chunk_index.json) recording which chunk holds which
+channels and which merged products are virtual, so cleanup knows which
+chunk files are still referenced.
+
+Incremental merging (``incremental_merge_step``) consumes chunks as they
+complete instead of waiting for the whole array.  Each step appends the
+newly finished contiguous run of chunks after a persistent per-product
+cursor (<basename>.cube.I.merge_cursor.json) as a physical segment, and
+restores finished chunks once the common beam is known (i.e. once every
+chunk has written its .psf).  The final step only has to handle the tail:
+the segments are combined with ``imageconcat(mode='m')``, which moves them
+into the output instead of copying them again.
+
+Environment variables read by sgrb2_chunk_imaging.py:
+
+    VIRTUAL_PRODUCTS    - comma-separated suffixes to merge virtually
+                          (default: '.psf,.weight,.sumwt,.mask'; '' = none)
+    MATERIALIZE_VIRTUAL - '1' to turn existing virtual products into
+                          physical images (and then allow chunk cleanup)
+    INCREMENTAL_MERGE   - '1' to run one incremental merge step
+    FINALIZE_MERGE      - '1' to fail if the incremental merge cannot be
+                          finalized (used by the merge job that runs after
+                          the whole array)
+"""
+
+import os
+import json
+import shutil
+import fcntl
+import contextlib
+
+PRODUCTS = (".residual", ".model", ".mask", ".pb", ".psf", ".weight", ".sumwt")
+
+DEFAULT_VIRTUAL_PRODUCTS = '.psf,.weight,.sumwt,.mask'
+
+
+def virtual_products():
+    """Suffixes to merge virtually, from VIRTUAL_PRODUCTS."""
+    value = os.getenv('VIRTUAL_PRODUCTS', DEFAULT_VIRTUAL_PRODUCTS)
+    return [sfx.strip() for sfx in value.split(',') if sfx.strip()]
+
+
+def index_path(basename):
+    return f'{basename}.cube.I.chunk_index.json'
+
+
+def load_index(basename):
+    """Return the channel-to-chunk index for a merge, or an empty one."""
+    path = index_path(basename)
+    if os.path.exists(path):
+        with open(path) as fh:
+            return json.load(fh)
+    return {'chunks': [], 'virtual': []}
+
+
+def save_index(basename, index):
+    path = index_path(basename)
+    with open(f'{path}.tmp', 'w') as fh:
+        json.dump(index, fh, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def chunk_table(basename, totalnchan, nchan_chunk):
+    """Channel ranges of every chunk, in channel order."""
+    return [{'chunk': ii // nchan_chunk,
+             'startchan': ii,
+             'nchan': min(nchan_chunk, totalnchan - ii),
+             'chunk_base': f'{basename}.{ii:04d}+{nchan_chunk:03d}.cube.I'}
+            for ii in range(0, totalnchan, nchan_chunk)]
+
+
+def concat_product(ia, outfile, infiles, virtual):
+    """
+    Concatenate chunk images along the spectral axis.
+
+    With ``virtual=True`` the output only references the (absolute) input
+    paths, so the chunk images must be kept.
+    """
+    if virtual:
+        infiles = [os.path.abspath(f) for f in infiles]
+        merged = ia.imageconcat(outfile=outfile, infiles=infiles, mode='n', relax=True)
+    else:
+        merged = ia.imageconcat(outfile=outfile, infiles=infiles, mode='p', relax=True)
+    merged.done()
+
+
+def materialize_product(ia, outfile):
+    """Replace a virtual concatenation with a physical (paged) copy."""
+    tmpfile = f'{outfile}.materialize'
+    if os.path.exists(tmpfile):
+        shutil.rmtree(tmpfile)
+    ia.open(outfile)
+    sub = ia.subimage(outfile=tmpfile, dropdeg=False)
+    sub.done()
+    ia.close()
+    shutil.rmtree(outfile)
+    os.rename(tmpfile, outfile)
+
+
+def done_marker(chunk_base):
+    """Marker written by a chunk job after tclean returned successfully."""
+    return f'{chunk_base}.done'
+
+
+def cursor_path(basename):
+    return f'{basename}.cube.I.merge_cursor.json'
+
+
+def load_cursor(basename, nchan_chunk):
+    path = cursor_path(basename)
+    if os.path.exists(path):
+        with open(path) as fh:
+            cursor = json.load(fh)
+        if cursor['nchan_chunk'] != nchan_chunk:
+            raise ValueError(f"{path} was written for NCHAN_CHUNK={cursor['nchan_chunk']}, "
+                             f"not {nchan_chunk}")
+        return cursor
+    return {'nchan_chunk': nchan_chunk, 'common_beam': None, 'products': {}}
+
+
+def save_cursor(basename, cursor):
+    path = cursor_path(basename)
+    with open(f'{path}.tmp', 'w') as fh:
+        json.dump(cursor, fh, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+@contextlib.contextmanager
+def merge_lock(basename):
+    """Serialize merge steps for one cube (incremental steps and the final merge)."""
+    with open(f'{basename}.cube.I.merge.lock', 'w') as fh:
+        fcntl.flock(fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+
+def incremental_merge_step(ia, basename, totalnchan, nchan_chunk, cleanup=False, log=print):
+    """
+    Merge whatever new contiguous chunks have completed since the last step.
+
+    Returns True once every product has been merged into its final
+    <basename>.cube.I<suffix> (including the restored .image).
+    """
+    from chunk_beams import chunk_beam_table
+    from chunk_restore import restore_chunks
+
+    chunks = chunk_table(basename, totalnchan, nchan_chunk)
+    bases = [c['chunk_base'] for c in chunks]
+    nchunks = len(chunks)
+    done = [os.path.exists(done_marker(cb)) for cb in bases]
+    log(f"Incremental merge: {sum(done)}/{nchunks} chunks complete")
+
+    cursor = load_cursor(basename, nchan_chunk)
+    virtual_suffixes = virtual_products()
+    physical = [sfx for sfx in PRODUCTS if sfx not in virtual_suffixes] + ['.image']
+    for suffix in physical:
+        cursor['products'].setdefault(suffix, {'next': 0, 'segments': []})
+
+    # The common beam is fixed once every chunk has computed its PSF
+    if cursor['common_beam'] is None:
+        if all(os.path.exists(f'{cb}.psf') or done[ii] for ii, cb in enumerate(bases)):
+            cursor['common_beam'] = chunk_beam_table(basename, bases, log=log)['common_beam']
+            save_cursor(basename, cursor)
+        else:
+            log("  Common beam not known yet (some chunks have no .psf); not restoring")
+
+    image_next = cursor['products']['.image']['next']
+    if cursor['common_beam'] is not None:
+        to_restore = [cb for ii, cb in enumerate(bases)
+                      if ii >= image_next and done[ii] and not os.path.exists(f'{cb}.image')]
+        if to_restore:
+            restore_chunks(to_restore, cursor['common_beam'], log=log)
+
+    for suffix in physical:
+        state = cursor['products'][suffix]
+        first = jj = state['next']
+        while jj < nchunks and done[jj] and os.path.exists(f'{bases[jj]}{suffix}'):
+            jj += 1
+        if jj == first:
+            continue
+        segment = f'{basename}.cube.I{suffix}.seg{first:04d}'
+        if os.path.exists(segment):
+            shutil.rmtree(segment)
+        log(f"  Appending chunks {first}-{jj - 1} to {suffix} as {segment}")
+        concat_product(ia, segment, [f'{cb}{suffix}' for cb in bases[first:jj]], virtual=False)
+        state['segments'].append([first, jj - 1, segment])
+        state['next'] = jj
+        save_cursor(basename, cursor)
+
+    if cleanup:
+        image_next = cursor['products']['.image']['next']
+        for suffix in physical:
+            upto = cursor['products'][suffix]['next']
+            if suffix in ('.model', '.residual'):
+                # still needed to restore chunks that are not in an .image segment
+                upto = min(upto, image_next)
+            for cb in bases[:upto]:
+                if os.path.exists(f'{cb}{suffix}'):
+                    shutil.rmtree(f'{cb}{suffix}')
+
+    if any(cursor['products'][sfx]['next'] < nchunks for sfx in physical):
+        missing = [ii for ii in range(nchunks) if not done[ii]]
+        if missing:
+            log(f"  Waiting for {len(missing)} chunks, first missing: {missing[0]}")
+        return False
+
+    # Finalize: move segments into the merged products, reference virtual ones
+    for suffix in physical:
+        outfile = f'{basename}.cube.I{suffix}'
+        if os.path.exists(outfile):
+            continue
+        segments = [seg[2] for seg in cursor['products'][suffix]['segments']]
+        log(f"  Finalizing {outfile} from {len(segments)} segment(s)")
+        if len(segments) == 1:
+            os.rename(segments[0], outfile)
+        else:
+            merged = ia.imageconcat(outfile=outfile, infiles=segments, mode='m', relax=True)
+            merged.done()
+    index = load_index(basename)
+    index['chunks'] = chunks
+    for suffix in virtual_suffixes:
+        outfile = f'{basename}.cube.I{suffix}'
+        infiles = [f'{cb}{suffix}' for cb in bases if os.path.exists(f'{cb}{suffix}')]
+        if os.path.exists(outfile) or not infiles:
+            continue
+        log(f"  Merging {len(infiles)} files into {outfile} (virtual, references chunk files)")
+        concat_product(ia, outfile, infiles, virtual=True)
+        if suffix not in index['virtual']:
+            index['virtual'].append(suffix)
+    save_index(basename, index)
+    return True
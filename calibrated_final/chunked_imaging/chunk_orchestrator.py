@@ -0,0 +1,760 @@
+#!/usr/bin/env python
+"""
+Resumable orchestrator for SgrB2 chunked cube imaging.
+
+Replaces submit_chunked_jobs.sh and resubmit_failed_chunks.sh.  Chunk state
+is kept in a SQLite database (status, attempts, job IDs, timings and output
+sizes per chunk) instead of being re-derived from directory listings with
+bash loops, and only the chunks that are missing or failed are submitted.
+
+State is refreshed ("synced") from a single scan of each work directory plus
+one query of the backend for active jobs:
+
+    done       - the chunk's .done marker exists, or its .residual without a
+                 lease (chunks from before leases), or the merged cube does
+    running    - the chunk's job is active and its .psf or lease exists
+    submitted  - the chunk's job is active but has not started writing
+    failed     - the chunk was submitted, its job is no longer active and
+                 there is no .residual, or its lease has expired (see
+                 chunk_lease.py; the next job reclaims its partial products)
+    pending    - never submitted
+
+Backends:
+    slurm - sbatch array jobs running slurm_chunk_job.sh, with the merge job
+            chained with --dependency=afterok (production)
+    local - runs the chunk script directly in a local process pool, then the
+            merge (testing / small runs)
+
+With --incremental, chunks are merged as they complete (INCREMENTAL_MERGE=1,
+see chunk_merge.py): each chunk job queues a merge step, and the final merge
+waits on the array with afterany (so one failed chunk does not cancel it)
+and only finalizes the tail.
+
+With --vis-cache, a staging job first writes per-chunk channel slices of
+the MSs (stage_chunk_vis.py) and the chunk array, run with VIS_CACHE=1,
+depends on it.
+
+With --quicklook, quick-look previews (QUICKLOOK=1, see ../quicklook.py:
+binned channels, coarse cell, small image, dirty) are made instead, with
+their own work directories and state database under working_chunks/quicklook/
+and chunk sizes planned for the quick-look image size in multiples of
+QUICKLOOK_BIN.
+
+NOISE_NSIGMA set in the environment is passed on to the chunk jobs, which
+then clean to that many times the measured RMS (../noise_estimator.py).
+
+Chunk sizes and resource requests come from chunk_planner.py.  Before
+submitting, the cube's footprint (cube_footprint.py) is checked: submission
+is refused when the work directory's filesystem lacks the free space for
+the remaining chunks and the merge.  The memory request is checked against
+the node limit (chunk_planner.MAX_MEM_GB; the plan is redone if no chunk has
+run yet) and against the peak MaxRSS sacct reports for the chunks that
+have run (--mem is raised, or submission refused if that would exceed the
+node limit).  --ignore-footprint skips the check.
+
+Usage:
+    python3 chunk_orchestrator.py submit <FIELD> <SPW> [--backend slurm|local]
+    python3 chunk_orchestrator.py submit all
+    python3 chunk_orchestrator.py status [<FIELD> <SPW> | all]
+    python3 chunk_orchestrator.py sync [<FIELD> <SPW> | all]
+
+Examples:
+    python3 chunk_orchestrator.py submit DS9 23
+    python3 chunk_orchestrator.py submit DS9 23 --backend local --workers 2
+    python3 chunk_orchestrator.py submit DS6 29 --incremental
+    python3 chunk_orchestrator.py submit all --quicklook
+    python3 chunk_orchestrator.py status all
+"""
+
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import chunk_planner
+import chunk_lease
+
+# cube_footprint.py lives in calibrated_final/
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+import cube_footprint
+import quicklook
+
+# ===========================
+# Configuration
+# ===========================
+
+BASEDIR = os.path.dirname(SCRIPT_DIR)  # calibrated_final/
+WORK_BASE = os.path.join(BASEDIR, 'working_chunks')
+LOG_DIR = os.path.join(BASEDIR, 'logs')
+DEFAULT_DB = os.path.join(WORK_BASE, 'chunk_state.sqlite')
+QUICKLOOK = False  # set by --quicklook (see use_quicklook)
+
+CHUNK_JOB = os.path.join(SCRIPT_DIR, 'slurm_chunk_job.sh')
+MERGE_JOB = os.path.join(SCRIPT_DIR, 'slurm_merge_job.sh')
+STAGE_VIS_JOB = os.path.join(SCRIPT_DIR, 'slurm_stage_vis_job.sh')
+CHUNK_SCRIPT = os.path.join(SCRIPT_DIR, 'sgrb2_chunk_imaging.py')
+CASA_PATH = "/orange/adamginsburg/casa/casa-6.6.6-17-pipeline-2025.1.0.35-py3.10.el8/bin/casa"
+
+ALL_FIELDS = chunk_planner.ALL_FIELDS
+ALL_SPWS = chunk_planner.ALL_SPWS
+
+CHUNK_PRODUCTS = (".residual", ".model", ".mask", ".pb", ".psf", ".weight", ".sumwt")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    field TEXT NOT NULL,
+    spw TEXT NOT NULL,
+    chunk_id INTEGER NOT NULL,
+    startchan INTEGER NOT NULL,
+    nchan INTEGER NOT NULL,
+    nchan_chunk INTEGER NOT NULL,
+    work_dir TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    job_id TEXT,
+    backend TEXT,
+    submitted_at REAL,
+    started_at REAL,
+    finished_at REAL,
+    output_bytes INTEGER,
+    PRIMARY KEY (field, spw, chunk_id)
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    field TEXT NOT NULL,
+    spw TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    backend TEXT NOT NULL,
+    array_spec TEXT,
+    dependency TEXT,
+    submitted_at REAL NOT NULL
+);
+"""
+
+# ===========================
+# FUNCTIONS
+# ===========================
+
+
+def field_clean(field):
+    return field.replace('_', '')
+
+
+def work_dir_for(field, spw):
+    return os.path.join(WORK_BASE, f"{field_clean(field)}_spw{spw}")
+
+
+def basename_for(field, spw):
+    return f"oussid.SgrB2_{field_clean(field)}_sci.spw{spw}"
+
+
+def chunk_imagename(field, spw, startchan, nchan_chunk):
+    return f"{basename_for(field, spw)}.{startchan:04d}+{nchan_chunk:03d}.cube.I"
+
+
+def dir_size(path):
+    """Total size in bytes of all files below ``path``."""
+    total = 0
+    for root, _, files in os.walk(path):
+        for fn in files:
+            try:
+                total += os.path.getsize(os.path.join(root, fn))
+            except OSError:
+                pass
+    return total
+
+
+def connect(db_path):
+    os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+    db = sqlite3.connect(db_path, timeout=60)
+    db.row_factory = sqlite3.Row
+    db.executescript(SCHEMA)
+    return db
+
+
+def use_quicklook():
+    """Switch to quick-look imaging: separate work dirs and state DB."""
+    global WORK_BASE, QUICKLOOK
+    WORK_BASE = os.path.join(WORK_BASE, quicklook.SUBDIR)
+    QUICKLOOK = True
+    return os.path.join(WORK_BASE, 'chunk_state.sqlite')
+
+
+def new_plan(field, spw, rows=None, nchan_chunk=None):
+    """
+    Plan a field/SPW (for the quick-look image size and binning if QUICKLOOK).
+
+    With ``nchan_chunk`` only that chunk size is considered.
+    """
+    if rows is None:
+        rows = chunk_planner.catalog_rows(field, spw)
+    if not QUICKLOOK:
+        candidates = [nchan_chunk] if nchan_chunk else chunk_planner.CANDIDATE_NCHAN
+        return chunk_planner.plan_field_spw(field, spw, rows=rows, candidates=candidates)
+    # Chunks are in native channels and must hold whole quick-look bins
+    nbin = quicklook.chan_bin()
+    candidates = [nchan_chunk] if nchan_chunk else [nchan * nbin for nchan in chunk_planner.CANDIDATE_NCHAN]
+    return chunk_planner.plan_field_spw(field, spw, rows=rows, imsize=quicklook.IMSIZE,
+                                        candidates=candidates)
+
+
+def get_plan(field, spw):
+    """
+    Return the chunk plan for a field/SPW, creating it if necessary.
+
+    A work dir that already has chunk products but no plan keeps the chunk
+    size of those products, so finished chunks are not orphaned.
+    """
+    work_dir = work_dir_for(field, spw)
+    plan = chunk_planner.read_plan(work_dir)
+    if plan is None:
+        nchan_chunk = chunk_planner.existing_nchan_chunk(work_dir)
+        if nchan_chunk:
+            print(f"{field} SPW {spw}: keeping the existing {nchan_chunk}-channel chunks in {work_dir}")
+        plan = new_plan(field, spw, nchan_chunk=nchan_chunk)
+        chunk_planner.write_plan(plan, work_dir)
+    return plan
+
+
+def measured_peak_gb(db, field, spw):
+    """Largest sacct MaxRSS (GB) of the field/SPW's SLURM chunk jobs so far, or None."""
+    job_ids = [row['job_id'] for row in db.execute(
+        "SELECT job_id FROM jobs WHERE field=? AND spw=? AND kind='chunk'", (field, spw))
+        if not row['job_id'].startswith('local-')]
+    return cube_footprint.max_rss_gb(job_ids)
+
+
+def check_footprint(db, field, spw, plan):
+    """
+    Gate a submission on disk space and the plan's memory request.
+
+    Returns the (possibly updated) plan, or None if the submission must be
+    refused.
+    """
+    work_dir = work_dir_for(field, spw)
+    rows = db.execute("SELECT * FROM chunks WHERE field=? AND spw=?", (field, spw)).fetchall()
+    fp = cube_footprint.cube_footprint(field, spw, nchan_chunk=plan['nchan_chunk'], rows=plan['rows'],
+                                       imsize=plan['imsize'],
+                                       chan_bin=quicklook.chan_bin() if QUICKLOOK else 1)
+
+    # The plan's --mem comes from the planner's own model, so it is checked
+    # against what the model cannot know: the node limit and measured usage
+    requested = cube_footprint.parse_mem_gb(plan['mem'])
+    attempted = any(row['attempts'] for row in rows)
+    measured = measured_peak_gb(db, field, spw)
+    if requested > chunk_planner.MAX_MEM_GB:
+        if attempted:
+            print(f"  REFUSING: plan requests {plan['mem']}, above the {chunk_planner.MAX_MEM_GB}GB node "
+                  "limit, and chunks already exist (--ignore-footprint to submit anyway)")
+            return None
+        print(f"  Plan requests {plan['mem']}, above the {chunk_planner.MAX_MEM_GB}GB node limit: re-planning")
+        plan = new_plan(field, spw, rows=plan['rows'])
+        chunk_planner.write_plan(plan, work_dir)
+        with db:
+            db.execute("DELETE FROM chunks WHERE field=? AND spw=?", (field, spw))
+        ensure_chunks(db, field, spw, plan)
+        fp = cube_footprint.cube_footprint(field, spw, nchan_chunk=plan['nchan_chunk'],
+                                           rows=plan['rows'], imsize=plan['imsize'],
+                                           chan_bin=quicklook.chan_bin() if QUICKLOOK else 1)
+    elif measured is not None and chunk_planner.MEM_SAFETY * measured > requested:
+        # Chunks have run, so the chunk size is fixed: raise --mem
+        needed = int(-(-chunk_planner.MEM_SAFETY * measured // 4)) * 4
+        if needed > chunk_planner.MAX_MEM_GB:
+            print(f"  REFUSING: chunks peaked at {measured:.0f}GB (sacct MaxRSS), which needs "
+                  f"{needed}GB with headroom, above the {chunk_planner.MAX_MEM_GB}GB node limit; "
+                  "re-plan with smaller chunks (--ignore-footprint to submit anyway)")
+            return None
+        plan['mem'] = f"{needed}gb"
+        print(f"  Raising memory request to {plan['mem']} (chunks peaked at {measured:.0f}GB MaxRSS)")
+        chunk_planner.write_plan(plan, work_dir)
+
+    # Output of finished chunks is already on disk
+    on_disk = sum(row['output_bytes'] or 0 for row in rows)
+    needed_bytes = fp['peak_disk_bytes'] - on_disk
+    free = cube_footprint.free_bytes(work_dir)
+    print(f"{field} SPW {spw} footprint: peak {fp['peak_disk_bytes'] / cube_footprint.GB:.0f}GB on disk "
+          f"({on_disk / cube_footprint.GB:.0f}GB already written), {free / cube_footprint.GB:.0f}GB free; "
+          f"tclean ~{fp['memory_gb']:.0f}GB predicted"
+          + (f", {measured:.0f}GB measured" if measured is not None else "")
+          + f", requesting {plan['mem']}")
+    if free < needed_bytes:
+        print(f"  REFUSING: needs {needed_bytes / cube_footprint.GB:.0f}GB more disk than is free "
+              "(--ignore-footprint to submit anyway)")
+        return None
+    return plan
+
+
+def ensure_chunks(db, field, spw, plan):
+    """Create chunk rows for a field/SPW from its plan."""
+    nchan_chunk = plan['nchan_chunk']
+    totalnchan = plan['totalnchan']
+    existing = db.execute("SELECT DISTINCT nchan_chunk FROM chunks WHERE field=? AND spw=?",
+                          (field, spw)).fetchall()
+    if existing and any(row['nchan_chunk'] != nchan_chunk for row in existing):
+        raise ValueError(f"{field} SPW {spw}: state DB has chunks of {existing[0]['nchan_chunk']} "
+                         f"channels but the plan says {nchan_chunk}")
+    work_dir = work_dir_for(field, spw)
+    with db:
+        for chunk_id, startchan in enumerate(range(0, totalnchan, nchan_chunk)):
+            db.execute("INSERT OR IGNORE INTO chunks (field, spw, chunk_id, startchan, nchan, "
+                       "nchan_chunk, work_dir) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (field, spw, chunk_id, startchan,
+                        min(nchan_chunk, totalnchan - startchan), nchan_chunk, work_dir))
+
+
+def sync(db, backend, field, spw):
+    """Refresh chunk status for one field/SPW from the filesystem and backend."""
+    rows = db.execute("SELECT * FROM chunks WHERE field=? AND spw=? ORDER BY chunk_id",
+                      (field, spw)).fetchall()
+    if not rows:
+        return
+    work_dir = rows[0]['work_dir']
+    try:
+        entries = set(os.listdir(work_dir))
+    except FileNotFoundError:
+        entries = set()
+
+    merged = f"{basename_for(field, spw)}.cube.I.residual" in entries
+    active = backend.active_jobs()
+    now = time.time()
+
+    with db:
+        for row in rows:
+            imagename = chunk_imagename(field, spw, row['startchan'], row['nchan_chunk'])
+            status = row['status']
+            updates = {}
+            job_active = row['job_id'] is not None and backend.is_active(active, row['job_id'], row['chunk_id'])
+            # tclean writes .residual early: without a .done marker a residual
+            # only means done when no lease is held (chunks from before leases)
+            done = (f"{imagename}.done" in entries
+                    or (f"{imagename}.residual" in entries and f"{imagename}.lease" not in entries))
+            if merged or done:
+                if status != 'done':
+                    updates['status'] = 'done'
+                    residual = os.path.join(work_dir, f"{imagename}.residual")
+                    if os.path.exists(residual):
+                        updates['finished_at'] = os.path.getmtime(residual)
+                        updates['output_bytes'] = sum(dir_size(os.path.join(work_dir, f"{imagename}{sfx}"))
+                                                      for sfx in CHUNK_PRODUCTS
+                                                      if f"{imagename}{sfx}" in entries)
+                    else:
+                        updates['finished_at'] = now
+            elif (f"{imagename}.lease" in entries
+                  and chunk_lease.lease_state(os.path.join(work_dir, imagename)) == 'expired'):
+                if status != 'failed':
+                    print(f"  Chunk {row['chunk_id']}: lease expired "
+                          f"({chunk_lease.describe_lease(os.path.join(work_dir, imagename))})")
+                    updates['status'] = 'failed'
+                    updates['finished_at'] = now
+            elif job_active:
+                if f"{imagename}.psf" in entries or f"{imagename}.lease" in entries:
+                    if status != 'running':
+                        updates['status'] = 'running'
+                        updates['started_at'] = now
+                elif status not in ('submitted', 'running'):
+                    updates['status'] = 'submitted'
+            elif status in ('submitted', 'running'):
+                updates['status'] = 'failed'
+                updates['finished_at'] = now
+            if updates:
+                assignments = ", ".join(f"{key}=?" for key in updates)
+                db.execute(f"UPDATE chunks SET {assignments} WHERE field=? AND spw=? AND chunk_id=?",
+                           list(updates.values()) + [field, spw, row['chunk_id']])
+
+
+def submit(db, backend, field, spw, merge=True, dry_run=False, footprint=True):
+    """Submit all pending/failed chunks of a field/SPW (and the merge if all were submitted)."""
+    plan = get_plan(field, spw)
+    ensure_chunks(db, field, spw, plan)
+    sync(db, backend, field, spw)
+    if footprint:
+        plan = check_footprint(db, field, spw, plan)
+        if plan is None:
+            return None
+    work_dir = work_dir_for(field, spw)
+
+    rows = db.execute("SELECT * FROM chunks WHERE field=? AND spw=? ORDER BY chunk_id",
+                      (field, spw)).fetchall()
+    todo = [row['chunk_id'] for row in rows if row['status'] in ('pending', 'failed')]
+    counts = status_counts(rows)
+
+    print("=" * 80)
+    print(f"FIELD={field} SPW={spw}  ({plan['nchunks']} chunks of {plan['nchan_chunk']} chan)")
+    print(f"  Work dir: {work_dir}")
+    print("  Status: " + ", ".join(f"{key}={counts[key]}" for key in sorted(counts)))
+
+    if not todo:
+        print("  Nothing to submit")
+        print("=" * 80)
+        return None
+
+    print(f"  Submitting {len(todo)} chunks: {compress_ids(todo)}")
+    if dry_run:
+        print("  (dry run)")
+        print("=" * 80)
+        return None
+
+    os.makedirs(work_dir, exist_ok=True)
+    os.makedirs(LOG_DIR, exist_ok=True)
+    job_id = backend.submit_chunks(db, field, spw, todo, plan, work_dir)
+    print(f"  Chunk job: {job_id}")
+
+    if merge and (len(todo) == len(rows) or backend.incremental):
+        merge_id = backend.submit_merge(db, field, spw, plan, work_dir, dependency=job_id)
+        if merge_id is not None:
+            print(f"  Merge job: {merge_id} (depends on {job_id})")
+    elif merge:
+        print("  Note: partial resubmission; run ./submit_merge_if_complete.sh after chunks complete")
+    print("=" * 80)
+    return job_id
+
+
+def record_job(db, job_id, field, spw, kind, backend_name, array_spec=None, dependency=None):
+    with db:
+        db.execute("INSERT OR REPLACE INTO jobs VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                   (job_id, field, spw, kind, backend_name, array_spec, dependency, time.time()))
+
+
+def mark_submitted(db, field, spw, chunk_ids, job_id, backend_name):
+    now = time.time()
+    with db:
+        for chunk_id in chunk_ids:
+            db.execute("UPDATE chunks SET status='submitted', attempts=attempts+1, job_id=?, "
+                       "backend=?, submitted_at=?, started_at=NULL, finished_at=NULL "
+                       "WHERE field=? AND spw=? AND chunk_id=?",
+                       (job_id, backend_name, now, field, spw, chunk_id))
+
+
+def compress_ids(ids):
+    """Format sorted integers as a SLURM-style range list, e.g. 0-3,7,9-10."""
+    parts = []
+    ids = sorted(ids)
+    start = prev = ids[0]
+    for ii in ids[1:] + [None]:
+        if ii is not None and ii == prev + 1:
+            prev = ii
+            continue
+        parts.append(f"{start}" if start == prev else f"{start}-{prev}")
+        if ii is not None:
+            start = prev = ii
+    return ",".join(parts)
+
+
+def status_counts(rows):
+    counts = {}
+    for row in rows:
+        counts[row['status']] = counts.get(row['status'], 0) + 1
+    return counts
+
+
+def print_status(db, combos):
+    print("{:15s}  {:>4s}  {:>6s}  {:>5s}  {:>7s}  {:>9s}  {:>7s}  {:>7s}  {:>8s}  {:>9s}".format(
+        "Field", "SPW", "chunks", "done", "running", "submitted", "failed", "pending", "attempts", "out [GB]"))
+    print("-" * 96)
+    for field, spw in combos:
+        rows = db.execute("SELECT * FROM chunks WHERE field=? AND spw=?", (field, spw)).fetchall()
+        if not rows:
+            continue
+        counts = status_counts(rows)
+        attempts = sum(row['attempts'] for row in rows)
+        out_gb = sum(row['output_bytes'] or 0 for row in rows) / 1024**3
+        print(f"{field:15s}  {spw:>4s}  {len(rows):6d}  {counts.get('done', 0):5d}  "
+              f"{counts.get('running', 0):7d}  {counts.get('submitted', 0):9d}  "
+              f"{counts.get('failed', 0):7d}  {counts.get('pending', 0):7d}  {attempts:8d}  {out_gb:9.1f}")
+
+
+# ===========================
+# Backends
+# ===========================
+
+
+class SlurmBackend:
+    """Submit chunk arrays and merge jobs with sbatch; query state with squeue."""
+
+    name = 'slurm'
+
+    def __init__(self, throttle=chunk_planner.THROTTLE, incremental=False, scratch_staging=False,
+                 vis_cache=False, mpi=False):
+        self.throttle = throttle
+        self.mpi = mpi
+        self.incremental = incremental
+        self.scratch_staging = scratch_staging
+        self.vis_cache = vis_cache
+        self._active = None
+
+    def active_jobs(self):
+        """
+        Active (pending or running) array tasks from one squeue call.
+
+        Returns {job_id: set of task ids, or None for "all tasks"}.
+        """
+        if self._active is not None:
+            return self._active
+        active = {}
+        try:
+            out = subprocess.run(['squeue', '-h', '-u', os.getenv('USER', ''), '-o', '%i'],
+                                 stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                                 universal_newlines=True, check=True).stdout
+        except (OSError, subprocess.CalledProcessError):
+            print("WARNING: squeue failed; treating all jobs as inactive")
+            out = ''
+        for token in out.split():
+            job_id, _, task = token.partition('_')
+            tasks = active.setdefault(job_id, set())
+            if tasks is None:
+                continue
+            if not task:
+                active[job_id] = None
+            elif task.startswith('['):
+                # Pending array range, e.g. [3-10,12%16]
+                for part in task.strip('[]').split('%')[0].split(','):
+                    lo, _, hi = part.partition('-')
+                    tasks.update(range(int(lo), int(hi or lo) + 1))
+            else:
+                tasks.add(int(task))
+        self._active = active
+        return active
+
+    def is_active(self, active, job_id, chunk_id):
+        if job_id not in active:
+            return False
+        return active[job_id] is None or chunk_id in active[job_id]
+
+    def submit_stage_vis(self, db, field, spw, chunk_ids):
+        fc = field_clean(field)
+        cmd = ['sbatch', '--parsable',
+               f'--job-name=sgrb2_{fc}_spw{spw}_stagevis',
+               f"--export=FIELD={field},SPW={spw},CHUNKS={compress_ids(chunk_ids)}",
+               f'--output={LOG_DIR}/stagevis_{fc}_spw{spw}_%j.log',
+               f'--error={LOG_DIR}/stagevis_{fc}_spw{spw}_%j.err',
+               STAGE_VIS_JOB]
+        job_id = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True,
+                                check=True).stdout.strip().split(';')[0]
+        record_job(db, job_id, field, spw, 'stagevis', self.name)
+        print(f"  Visibility staging job: {job_id}")
+        return job_id
+
+    def submit_chunks(self, db, field, spw, chunk_ids, plan, work_dir):
+        array_spec = f"{compress_ids(chunk_ids)}%{self.throttle}"
+        fc = field_clean(field)
+        cmd = ['sbatch', '--parsable']
+        if self.vis_cache:
+            stage_id = self.submit_stage_vis(db, field, spw, chunk_ids)
+            cmd.append(f'--dependency=afterok:{stage_id}')
+        cmd += [f'--array={array_spec}',
+               f"--mem={plan['mem']}",
+               f"--time={plan['time']}",
+               f"--cpus-per-task={plan['cpus_per_task']}",
+               f'--job-name=sgrb2_{fc}_spw{spw}_chunk',
+               f"--export=FIELD={field},SPW={spw},NCHAN_CHUNK={plan['nchan_chunk']},WORK_DIR={work_dir},"
+               f"INCREMENTAL_MERGE={int(self.incremental)},SCRATCH_STAGING={int(self.scratch_staging)},"
+               f"VIS_CACHE={int(self.vis_cache)},USE_MPI={int(self.mpi)},"
+               f"QUICKLOOK={int(QUICKLOOK)},QUICKLOOK_BIN={quicklook.chan_bin()},"
+               f"QUICKLOOK_NITER={quicklook.niter()}"
+               + (f",NOISE_NSIGMA={os.environ['NOISE_NSIGMA']}" if os.getenv('NOISE_NSIGMA') else ""),
+               f'--output={LOG_DIR}/chunk_{fc}_spw{spw}_%A_%a.log',
+               f'--error={LOG_DIR}/chunk_{fc}_spw{spw}_%A_%a.err',
+               CHUNK_JOB]
+        job_id = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True,
+                                check=True).stdout.strip().split(';')[0]
+        record_job(db, job_id, field, spw, 'chunk', self.name, array_spec=array_spec)
+        mark_submitted(db, field, spw, chunk_ids, job_id, self.name)
+        self._active = None
+        return job_id
+
+    def submit_merge(self, db, field, spw, plan, work_dir, dependency=None):
+        fc = field_clean(field)
+        cmd = ['sbatch', '--parsable']
+        if dependency:
+            # Incremental: finalize even if some chunks failed (the merge job
+            # then exits nonzero and a resubmission queues a new final merge)
+            kind = 'afterany' if self.incremental else 'afterok'
+            cmd.append(f'--dependency={kind}:{dependency}')
+        flags = ",INCREMENTAL_MERGE=1,FINALIZE_MERGE=1" if self.incremental else ""
+        cmd += [f'--job-name=sgrb2_{fc}_spw{spw}_merge',
+                f"--export=FIELD={field},SPW={spw},NCHAN_CHUNK={plan['nchan_chunk']},"
+                f"WORK_DIR={work_dir},CLEANUP_CHUNKS=1{flags}",
+                f'--output={LOG_DIR}/merge_{fc}_spw{spw}_%j.log',
+                f'--error={LOG_DIR}/merge_{fc}_spw{spw}_%j.err',
+                MERGE_JOB]
+        job_id = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True,
+                                check=True).stdout.strip().split(';')[0]
+        record_job(db, job_id, field, spw, 'merge', self.name, dependency=dependency)
+        return job_id
+
+
+class LocalBackend:
+    """
+    Run chunks in a local process pool (one CASA process per chunk).
+
+    Submission blocks until all chunks have finished, so nothing is ever
+    "active" from the point of view of a later sync.
+    """
+
+    name = 'local'
+
+    def __init__(self, workers=1, casa=CASA_PATH, incremental=False, vis_cache=False):
+        self.workers = workers
+        self.casa = casa
+        self.incremental = incremental
+        self.vis_cache = vis_cache
+
+    def active_jobs(self):
+        return {}
+
+    def is_active(self, active, job_id, chunk_id):
+        return False
+
+    def _run(self, env_updates, logfile):
+        env = dict(os.environ)
+        env.update({key: str(value) for key, value in env_updates.items()})
+        cmd = [self.casa, f'--logfile={logfile}', '--nogui', '--nologger',
+               '-c', f"execfile('{CHUNK_SCRIPT}')"]
+        with open(f"{logfile}.out", 'w') as out:
+            return subprocess.run(cmd, env=env, stdout=out, stderr=subprocess.STDOUT).returncode
+
+    def submit_chunks(self, db, field, spw, chunk_ids, plan, work_dir):
+        job_id = f"local-{os.getpid()}-{int(time.time())}"
+        record_job(db, job_id, field, spw, 'chunk', self.name, array_spec=compress_ids(chunk_ids))
+        mark_submitted(db, field, spw, chunk_ids, job_id, self.name)
+        db_path = db.execute("PRAGMA database_list").fetchone()['file']
+        fc = field_clean(field)
+        if self.vis_cache:
+            import stage_chunk_vis
+            stage_chunk_vis.stage_field_spw(field, spw, chunk_ids, workers=self.workers)
+
+        def run_chunk(chunk_id):
+            startchan = chunk_id * plan['nchan_chunk']
+            # sqlite connections cannot be shared across threads
+            tdb = connect(db_path)
+            with tdb:
+                tdb.execute("UPDATE chunks SET status='running', started_at=? "
+                            "WHERE field=? AND spw=? AND chunk_id=?",
+                            (time.time(), field, spw, chunk_id))
+            logfile = os.path.join(LOG_DIR, f"casa_chunk_{field}_spw{spw}_{job_id}_{chunk_id}.log")
+            code = self._run({'FIELD': field, 'SPW': spw, 'STARTCHAN': startchan,
+                              'NCHAN_CHUNK': plan['nchan_chunk'], 'WORK_DIR': work_dir,
+                              'DOMERGE': 0, 'VIS_CACHE': int(self.vis_cache),
+                              'QUICKLOOK': int(QUICKLOOK)}, logfile)
+            imagename = chunk_imagename(field, spw, startchan, plan['nchan_chunk'])
+            done = code == 0 and os.path.exists(os.path.join(work_dir, f"{imagename}.done"))
+            out_bytes = sum(dir_size(os.path.join(work_dir, f"{imagename}{sfx}")) for sfx in CHUNK_PRODUCTS)
+            with tdb:
+                tdb.execute("UPDATE chunks SET status=?, finished_at=?, output_bytes=? "
+                            "WHERE field=? AND spw=? AND chunk_id=?",
+                            ('done' if done else 'failed', time.time(), out_bytes,
+                             field, spw, chunk_id))
+            tdb.close()
+            print(f"  [{fc} spw{spw}] chunk {chunk_id}: {'done' if done else f'FAILED (exit {code})'}")
+            if done and self.incremental:
+                # Steps serialize on the merge lock in the work directory
+                self._run({'FIELD': field, 'SPW': spw, 'STARTCHAN': 0,
+                           'NCHAN_CHUNK': plan['nchan_chunk'], 'WORK_DIR': work_dir,
+                           'DOMERGE': 1, 'INCREMENTAL_MERGE': 1,
+                           'CLEANUP_CHUNKS': os.getenv('CLEANUP_CHUNKS', '1')},
+                          os.path.join(LOG_DIR, f"casa_merge_{job_id}_{chunk_id}.log"))
+            return done
+
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            results = list(pool.map(run_chunk, chunk_ids))
+        print(f"  {sum(results)}/{len(results)} chunks completed")
+        return job_id
+
+    def submit_merge(self, db, field, spw, plan, work_dir, dependency=None):
+        rows = db.execute("SELECT status FROM chunks WHERE field=? AND spw=?", (field, spw)).fetchall()
+        if any(row['status'] != 'done' for row in rows):
+            print("  Not merging: some chunks did not complete")
+            return None
+        job_id = f"local-merge-{os.getpid()}-{int(time.time())}"
+        record_job(db, job_id, field, spw, 'merge', self.name, dependency=dependency)
+        logfile = os.path.join(LOG_DIR, f"casa_merge_{job_id}.log")
+        code = self._run({'FIELD': field, 'SPW': spw, 'STARTCHAN': 0,
+                          'NCHAN_CHUNK': plan['nchan_chunk'], 'WORK_DIR': work_dir,
+                          'DOMERGE': 1, 'CLEANUP_CHUNKS': os.getenv('CLEANUP_CHUNKS', '1'),
+                          'INCREMENTAL_MERGE': int(self.incremental),
+                          'FINALIZE_MERGE': int(self.incremental)}, logfile)
+        print(f"  Merge {'completed' if code == 0 else f'FAILED (exit {code})'}")
+        return job_id
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Resumable orchestration of chunked cube imaging')
+    parser.add_argument('command', choices=['submit', 'status', 'sync'])
+    parser.add_argument('field', nargs='?', default='all', help="Field name, or 'all'")
+    parser.add_argument('spw', nargs='?', help='Spectral window')
+    parser.add_argument('--db', default=DEFAULT_DB, help='State database path')
+    parser.add_argument('--backend', choices=['slurm', 'local'], default='slurm')
+    parser.add_argument('--workers', type=int, default=1, help='Concurrent chunks (local backend)')
+    parser.add_argument('--casa', default=CASA_PATH, help='CASA executable (local backend)')
+    parser.add_argument('--no-merge', action='store_true', help='Do not submit the merge job')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Merge chunks as they complete; the final merge only finalizes the tail')
+    parser.add_argument('--mpi', action='store_true',
+                        help='Run chunk tclean under mpicasa with one process per CPU (slurm backend)')
+    parser.add_argument('--vis-cache', action='store_true',
+                        help='Stage per-chunk channel slices of the MSs and image from them')
+    parser.add_argument('--scratch-staging', action='store_true',
+                        help='Image chunks in $SLURM_TMPDIR and copy products back (slurm backend)')
+    parser.add_argument('--quicklook', action='store_true',
+                        help='Quick-look previews (binned, coarse, dirty) in working_chunks/quicklook')
+    parser.add_argument('--dry-run', action='store_true', help='Show what would be submitted')
+    parser.add_argument('--ignore-footprint', action='store_true',
+                        help='Submit without checking free disk space and the memory request')
+    args = parser.parse_args(argv)
+
+    if args.quicklook:
+        if args.vis_cache:
+            print("ERROR: --vis-cache stages slices for the full-resolution work directories;"
+                  " it cannot be combined with --quicklook")
+            return 1
+        quicklook_db = use_quicklook()
+        if args.db == DEFAULT_DB:
+            args.db = quicklook_db
+
+    if args.field == 'all':
+        combos = [(field, spw) for field in ALL_FIELDS for spw in ALL_SPWS]
+    else:
+        if args.spw is None:
+            print("ERROR: Need FIELD and SPW, or 'all'")
+            return 1
+        if args.spw not in ALL_SPWS:
+            print(f"ERROR: Invalid SPW '{args.spw}'. Must be one of: {' '.join(ALL_SPWS)}")
+            return 1
+        combos = [(args.field, args.spw)]
+
+    if args.backend == 'local':
+        backend = LocalBackend(workers=args.workers, casa=args.casa, incremental=args.incremental,
+                               vis_cache=args.vis_cache)
+    else:
+        backend = SlurmBackend(incremental=args.incremental, scratch_staging=args.scratch_staging,
+                               vis_cache=args.vis_cache, mpi=args.mpi)
+
+    db = connect(args.db)
+
+    if args.command == 'submit':
+        for field, spw in combos:
+            submit(db, backend, field, spw, merge=not args.no_merge, dry_run=args.dry_run,
+                   footprint=not args.ignore_footprint)
+    else:
+        for field, spw in combos:
+            if args.command == 'sync' or args.field != 'all':
+                ensure_chunks(db, field, spw, get_plan(field, spw))
+            sync(db, backend, field, spw)
+        print_status(db, combos)
+
+    db.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
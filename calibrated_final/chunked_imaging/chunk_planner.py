@@ -0,0 +1,399 @@
+#!/usr/bin/env python
+"""
+Cost-model chunk planner for SgrB2 chunked cube imaging.
+
+Instead of a fixed NCHAN_CHUNK=32 for every field/SPW, this predicts the
+runtime and memory of a single chunk job from the image size, the number of
+channels, the visibility row counts of the input MSs and the products that
+tclean writes, then picks the chunk size that minimizes the total makespan
+of the array under the SLURM '%16' throttle.
+
+The plan also carries the matching array spec and resource request
+(--mem / --time / --cpus-per-task) so the submit scripts can pass them
+straight to sbatch.  Plans are written to <WORK_DIR>/chunk_plan.json so that
+resubmission and merge use the same chunk size as the original submission.
+A work dir that already holds chunks but no plan (imaged with the old fixed
+NCHAN_CHUNK) keeps the chunk size of those chunks.
+
+Without --rows, measured row counts are taken from the MS catalog
+(ms_catalog.json, see ms_catalog.py) when it covers the input MSs.
+
+Pure python (no CASA needed), so it can run on the login node.
+
+Usage:
+    python3 chunk_planner.py <FIELD> <SPW> [--rows N,N,...] [--shell]
+    python3 chunk_planner.py all
+    python3 chunk_planner.py --read-plan <WORK_DIR> --shell
+
+Examples:
+    python3 chunk_planner.py DS6 29
+    eval $(python3 chunk_planner.py DS6 29 --shell --write-plan working_chunks/DS6_spw29)
+"""
+
+import os
+import re
+import sys
+import json
+import math
+import argparse
+
+# ===========================
+# Configuration
+# ===========================
+
+# Channel counts per SPW (must match sgrb2_chunk_imaging.py)
+TOTALNCHAN = {
+    '23': 1916,
+    '25': 1920,
+    '27': 1920,
+    '29': 3840,
+}
+
+ALL_FIELDS = ['SgrB2S_DS1-5', 'DS6', 'DS7-DS8', 'DS9']
+ALL_SPWS = ['23', '25', '27', '29']
+
+IMSIZE = [2880, 2880]
+
+# Products written by the chunk tclean call (restoration=False, so no .image)
+# and the number of float32 planes per channel that each one holds.
+PRODUCTS = {
+    '.residual': 1,
+    '.model': 1,
+    '.mask': 1,
+    '.pb': 1,
+    '.psf': 1,
+    '.weight': 1,
+    '.sumwt': 0,  # one value per channel, negligible
+}
+
+# Number of MSs per field (10 execution blocks) and a conservative default
+# row count per MS, used when no measured row counts are given.
+NMS = 10
+DEFAULT_ROWS_PER_MS = 2.0e6
+
+# SLURM limits
+THROTTLE = 16
+CPUS_PER_TASK = 4
+MAX_MEM_GB = 128
+MAX_WALL_HOURS = 96
+
+# Chunk sizes to consider (the chunk imagename uses {nchan:03d}, so <= 999)
+CANDIDATE_NCHAN = [8, 12, 16, 24, 32, 40, 48, 64, 80, 96, 128, 160, 192, 256]
+
+# Chunk size of work dirs imaged before chunk_plan.json existed
+LEGACY_NCHAN_CHUNK = 32
+
+# Cost model coefficients.  These are deliberately simple and can be
+# overridden with --calibration <json> (same keys) once measured timings
+# are available.
+#   setup_s:            CASA startup, MS open, weighting setup per chunk
+#   read_s_per_mrow:    per-chunk selection/iteration over all MS rows
+#   grid_s_per_mrow:    per-channel gridding + degridding, per million rows
+#   image_s_per_mpix:   per-channel FFTs, minor cycle and automasking, per Mpix
+#   queue_s:            scheduling + node startup overhead per array task
+#   mem_base_gb:        CASA process baseline
+#   mem_plane_factor:   working planes held in memory per channel
+#   mem_fixed_planes:   padded complex grids and scratch planes per process
+#   mem_cache_frac:     fraction of the chunk's cube products resident in memory
+COST_MODEL = {
+    'setup_s': 900.,
+    'read_s_per_mrow': 60.,
+    'grid_s_per_mrow': 25.,
+    'image_s_per_mpix': 30.,
+    'queue_s': 300.,
+    'mem_base_gb': 16.,
+    'mem_plane_factor': 2.,
+    'mem_fixed_planes': 24.,
+    'mem_cache_frac': 0.25,
+}
+
+# Multiply predictions by this before turning them into a resource request
+MEM_SAFETY = 1.25
+TIME_SAFETY = 1.5
+
+# ===========================
+# FUNCTIONS
+# ===========================
+
+
+def load_calibration(path):
+    """Return COST_MODEL updated with the coefficients stored in ``path``."""
+    model = dict(COST_MODEL)
+    if path is None:
+        return model
+    with open(path) as fh:
+        calib = json.load(fh)
+    for key, value in calib.items():
+        if key in model:
+            model[key] = float(value)
+    return model
+
+
+def plane_bytes(imsize=IMSIZE):
+    """Size in bytes of a single float32 image plane."""
+    return imsize[0] * imsize[1] * 4
+
+
+def catalog_rows(field, spw):
+    """
+    Measured row counts of the chunk jobs' input MSs, from the MS catalog.
+
+    Returns None if the MSs are not in ms_catalog.json (see ms_catalog.py).
+    """
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    import ms_catalog
+    from stage_chunk_vis import source_vis
+    vis_list, _ = source_vis(field, spw)
+    return ms_catalog.catalog_rows(vis_list, field, spw)
+
+
+def predict_chunk(nchan, rows, imsize=IMSIZE, products=PRODUCTS, model=COST_MODEL):
+    """
+    Predict runtime (seconds) and peak memory (GB) of one chunk job.
+
+    Args:
+        nchan: channels in the chunk
+        rows: visibility row counts, one per input MS
+        imsize: [nx, ny]
+        products: mapping of product suffix to planes per channel
+        model: cost model coefficients
+    """
+    mrows = sum(rows) / 1e6
+    mpix = imsize[0] * imsize[1] / 1e6
+    runtime = (model['setup_s']
+               + model['read_s_per_mrow'] * mrows
+               + nchan * (model['grid_s_per_mrow'] * mrows
+                          + model['image_s_per_mpix'] * mpix))
+
+    planes = sum(products.values())
+    gb_per_plane = plane_bytes(imsize) / 1024**3
+    memory = (model['mem_base_gb']
+              + gb_per_plane * model['mem_fixed_planes']
+              + gb_per_plane * planes * model['mem_plane_factor'] * min(nchan, CPUS_PER_TASK))
+    # Image cache grows with the chunk: tclean keeps the chunk's cube
+    # products memory-mapped, so count a fraction of them as resident.
+    memory += gb_per_plane * planes * nchan * model['mem_cache_frac']
+
+    return runtime, memory
+
+
+def format_walltime(seconds):
+    """Format seconds as a SLURM HH:MM:SS walltime, rounded up to whole hours."""
+    hours = max(1, int(math.ceil(seconds / 3600.)))
+    return f"{hours:02d}:00:00"
+
+
+def plan_field_spw(field, spw, rows=None, imsize=IMSIZE, products=PRODUCTS,
+                   model=COST_MODEL, throttle=THROTTLE, candidates=CANDIDATE_NCHAN):
+    """
+    Pick the chunk size that minimizes makespan for one field/SPW.
+
+    Returns a plan dict with the chosen NCHAN_CHUNK, the array spec and the
+    sbatch resource request, plus the table of all candidates evaluated.
+    """
+    if spw not in TOTALNCHAN:
+        raise ValueError(f"Unknown SPW '{spw}'. Must be one of: {list(TOTALNCHAN.keys())}")
+    totalnchan = TOTALNCHAN[spw]
+    if rows is None:
+        rows = [DEFAULT_ROWS_PER_MS] * NMS
+
+    evaluated = []
+    for nchan in candidates:
+        if nchan > totalnchan:
+            continue
+        nchunks = (totalnchan + nchan - 1) // nchan
+        runtime, memory = predict_chunk(nchan, rows, imsize=imsize, products=products, model=model)
+        waves = (nchunks + throttle - 1) // throttle
+        # The last chunk can be short; it only shortens the final wave
+        last_nchan = totalnchan - (nchunks - 1) * nchan
+        last_runtime, _ = predict_chunk(last_nchan, rows, imsize=imsize, products=products, model=model)
+        if nchunks % throttle == 1 and waves > 1:
+            makespan = (waves - 1) * (runtime + model['queue_s']) + last_runtime + model['queue_s']
+        else:
+            makespan = waves * (runtime + model['queue_s'])
+
+        mem_request = MEM_SAFETY * memory
+        time_request = TIME_SAFETY * runtime
+        feasible = mem_request <= MAX_MEM_GB and time_request <= MAX_WALL_HOURS * 3600.
+        evaluated.append({
+            'nchan_chunk': nchan,
+            'nchunks': nchunks,
+            'chunk_runtime_h': runtime / 3600.,
+            'chunk_memory_gb': memory,
+            'makespan_h': makespan / 3600.,
+            'feasible': feasible,
+        })
+
+    feasible = [ev for ev in evaluated if ev['feasible']]
+    if not feasible:
+        raise ValueError(f"No chunk size for {field} SPW {spw} fits within "
+                         f"{MAX_MEM_GB}GB / {MAX_WALL_HOURS}h")
+
+    # Minimize makespan; among near-ties (within 2%) prefer fewer, larger chunks
+    # since every task also costs scheduler and merge overhead.
+    best_makespan = min(ev['makespan_h'] for ev in feasible)
+    best = max((ev for ev in feasible if ev['makespan_h'] <= 1.02 * best_makespan),
+               key=lambda ev: ev['nchan_chunk'])
+
+    mem_gb = int(math.ceil(MEM_SAFETY * best['chunk_memory_gb'] / 4.)) * 4
+    mem_gb = max(mem_gb, 8)
+
+    return {
+        'field': field,
+        'spw': spw,
+        'totalnchan': totalnchan,
+        'imsize': list(imsize),
+        'rows': list(rows),
+        'nchan_chunk': best['nchan_chunk'],
+        'nchunks': best['nchunks'],
+        'array_spec': f"0-{best['nchunks'] - 1}%{throttle}",
+        'mem': f"{mem_gb}gb",
+        'time': format_walltime(TIME_SAFETY * best['chunk_runtime_h'] * 3600.),
+        'cpus_per_task': CPUS_PER_TASK,
+        'predicted_chunk_runtime_h': best['chunk_runtime_h'],
+        'predicted_chunk_memory_gb': best['chunk_memory_gb'],
+        'predicted_makespan_h': best['makespan_h'],
+        'candidates': evaluated,
+    }
+
+
+def existing_nchan_chunk(work_dir):
+    """
+    Chunk size of the chunk products already in a work dir, or None if there
+    are none.  A work dir without chunk_plan.json holds chunks of the old
+    fixed size, which is assumed if a product name cannot be parsed.
+    """
+    try:
+        names = [name for name in os.listdir(work_dir) if '+' in name and '.cube.I.' in name]
+    except FileNotFoundError:
+        return None
+    sizes = {}
+    for name in names:
+        match = re.search(r'\.\d{4}\+(\d{3})\.cube\.I\.', name)
+        size = int(match.group(1)) if match else LEGACY_NCHAN_CHUNK
+        sizes[size] = sizes.get(size, 0) + 1
+    return max(sizes, key=sizes.get) if sizes else None
+
+
+def write_plan(plan, work_dir):
+    """Store the plan in <work_dir>/chunk_plan.json."""
+    os.makedirs(work_dir, exist_ok=True)
+    path = os.path.join(work_dir, 'chunk_plan.json')
+    with open(path, 'w') as fh:
+        json.dump(plan, fh, indent=2)
+    return path
+
+
+def read_plan(work_dir):
+    """Return the stored plan for a work dir, or None if there is none."""
+    path = os.path.join(work_dir, 'chunk_plan.json')
+    if not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def shell_exports(plan):
+    """Format a plan as shell assignments suitable for eval."""
+    return "\n".join([
+        f"NCHAN_CHUNK={plan['nchan_chunk']}",
+        f"NCHUNKS={plan['nchunks']}",
+        f"ARRAY_SPEC='{plan['array_spec']}'",
+        f"PLAN_MEM={plan['mem']}",
+        f"PLAN_TIME={plan['time']}",
+        f"PLAN_CPUS={plan['cpus_per_task']}",
+    ])
+
+
+def print_plan(plan):
+    print("=" * 80)
+    print(f"Chunk plan: FIELD={plan['field']} SPW={plan['spw']}")
+    print(f"  Total channels: {plan['totalnchan']}")
+    print(f"  Visibility rows: {sum(plan['rows'])/1e6:.1f}M in {len(plan['rows'])} MSs")
+    print()
+    print("{:>6s}  {:>7s}  {:>10s}  {:>9s}  {:>10s}".format(
+        "nchan", "chunks", "chunk [h]", "mem [GB]", "total [h]"))
+    print("-" * 80)
+    for ev in plan['candidates']:
+        flag = "" if ev['feasible'] else "  (exceeds limits)"
+        star = " *" if ev['nchan_chunk'] == plan['nchan_chunk'] else ""
+        print(f"{ev['nchan_chunk']:6d}  {ev['nchunks']:7d}  {ev['chunk_runtime_h']:10.1f}  "
+              f"{ev['chunk_memory_gb']:9.1f}  {ev['makespan_h']:10.1f}{flag}{star}")
+    print("-" * 80)
+    print(f"  Chosen NCHAN_CHUNK: {plan['nchan_chunk']} ({plan['nchunks']} chunks)")
+    print(f"  Array spec: {plan['array_spec']}")
+    print(f"  Request: --mem={plan['mem']} --time={plan['time']} --cpus-per-task={plan['cpus_per_task']}")
+    print(f"  Predicted makespan: {plan['predicted_makespan_h']:.1f} h")
+    print("=" * 80)
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Plan chunk sizes and resource requests for chunked cube imaging')
+    parser.add_argument('field', nargs='?', help="Field name, or 'all'")
+    parser.add_argument('spw', nargs='?', help='Spectral window')
+    parser.add_argument('--rows', default=None,
+                        help='Comma-separated visibility row counts, one per MS')
+    parser.add_argument('--imsize', type=int, default=IMSIZE[0], help='Image size in pixels (square)')
+    parser.add_argument('--throttle', type=int, default=THROTTLE, help='Array throttle (%%N)')
+    parser.add_argument('--calibration', default=None, help='JSON file with cost model coefficients')
+    parser.add_argument('--write-plan', default=None, metavar='WORK_DIR',
+                        help='Write chunk_plan.json into WORK_DIR')
+    parser.add_argument('--read-plan', default=None, metavar='WORK_DIR',
+                        help='Read an existing chunk_plan.json instead of planning')
+    parser.add_argument('--shell', action='store_true', help='Emit shell assignments for eval')
+    parser.add_argument('--json', action='store_true', help='Emit the plan as JSON')
+    args = parser.parse_args(argv)
+
+    if args.read_plan:
+        plan = read_plan(args.read_plan)
+        if plan is None:
+            print(f"ERROR: no chunk_plan.json in {args.read_plan}", file=sys.stderr)
+            return 1
+        plans = [plan]
+    else:
+        if args.field is None:
+            parser.print_usage()
+            return 1
+        rows = [float(x) for x in args.rows.split(',')] if args.rows else None
+        model = load_calibration(args.calibration)
+        imsize = [args.imsize, args.imsize]
+        if args.field == 'all':
+            combos = [(field, spw) for field in ALL_FIELDS for spw in ALL_SPWS]
+        else:
+            if args.spw is None:
+                print("ERROR: Need FIELD and SPW, or 'all'", file=sys.stderr)
+                return 1
+            combos = [(args.field, args.spw)]
+        # Chunks already imaged without a plan fix the chunk size
+        nchan_chunk = existing_nchan_chunk(args.write_plan) if args.write_plan else None
+        if nchan_chunk:
+            print(f"Keeping the existing {nchan_chunk}-channel chunks in {args.write_plan}", file=sys.stderr)
+        candidates = [nchan_chunk] if nchan_chunk else CANDIDATE_NCHAN
+        plans = [plan_field_spw(field, spw, rows=rows or catalog_rows(field, spw),
+                                imsize=imsize, model=model, throttle=args.throttle, candidates=candidates)
+                 for field, spw in combos]
+        if args.write_plan:
+            if len(plans) != 1:
+                print("ERROR: --write-plan needs a single FIELD and SPW", file=sys.stderr)
+                return 1
+            write_plan(plans[0], args.write_plan)
+
+    if args.shell:
+        if len(plans) != 1:
+            print("ERROR: --shell needs a single FIELD and SPW", file=sys.stderr)
+            return 1
+        print(shell_exports(plans[0]))
+    elif args.json:
+        print(json.dumps(plans if len(plans) > 1 else plans[0], indent=2))
+    else:
+        for plan in plans:
+            print_plan(plan)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
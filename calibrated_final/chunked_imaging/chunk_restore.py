@@ -0,0 +1,408 @@
+"""
+Restoration of chunk products for the SgrB2 chunked imaging merge stage.
+
+The chunk jobs run tclean with restoration=False, so the merge has to build
+each chunk's .image from its .model (convolved to the common beam) plus its
+.residual.  Chunks are independent, so this module restores them in a pool
+of worker processes.  Each worker is a fresh interpreter running this file
+(CASA's python, via sys.executable) rather than a multiprocessing child, so
+nothing from the CASA session that runs the merge is forked or re-imported.
+
+Two restoration methods are available (RESTORE_METHOD):
+
+    'fused'   - (default) stream the chunk plane by plane: convolve each model
+                plane with a cached FFT of the common-beam Gaussian, add the
+                residual plane in memory and write .image once.  No
+                .model.conv intermediate is written or read back.
+    'imsmooth' - the original imsmooth -> immath -> setrestoringbeam sequence,
+                which writes and rereads a full .model.conv image.
+
+Run directly, it restores a single chunk:
+
+    python chunk_restore.py <chunk_base> '<common_beam json>'
+
+or checks the fused restore of a chunk against the imsmooth path with the
+beam rotated to a position angle (default 30 deg; exits nonzero if they
+differ by more than 1e-3 of the peak):
+
+    python chunk_restore.py --check <chunk_base> '<common_beam json>' [pa_deg]
+
+Environment variables read by sgrb2_chunk_imaging.py for this stage:
+
+    RESTORE_WORKERS - number of chunks restored concurrently
+                      (default: SLURM_CPUS_PER_TASK, else 1)
+    RESTORE_MEM_GB  - memory budget for all workers together
+                      (default: 80% of SLURM_MEM_PER_NODE, else unlimited)
+    RESTORE_METHOD  - 'fused' (default) or 'imsmooth'
+"""
+
+import os
+import sys
+import json
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+
+def beam_quantities(common_beam):
+    """Return (major, minor, pa) strings for a common-beam dict."""
+    return (f"{common_beam['major']['value']}{common_beam['major']['unit']}",
+            f"{common_beam['minor']['value']}{common_beam['minor']['unit']}",
+            f"{common_beam['pa']['value']}{common_beam['pa']['unit']}")
+
+
+def restore_chunk(chunk_base, common_beam, method=None):
+    """
+    Create <chunk_base>.image from .model and .residual with the common beam.
+
+    Returns the .image path, or None if the chunk's model or residual is missing.
+    """
+    if method is None:
+        method = os.getenv('RESTORE_METHOD', 'fused')
+    if method == 'fused':
+        return restore_chunk_fused(chunk_base, common_beam)
+    elif method != 'imsmooth':
+        raise ValueError(f"Unknown RESTORE_METHOD '{method}'. Must be 'fused' or 'imsmooth'")
+
+    from casatasks import imsmooth, immath
+    from casatools import image
+
+    chunk_model = f'{chunk_base}.model'
+    chunk_residual = f'{chunk_base}.residual'
+    chunk_image = f'{chunk_base}.image'
+
+    if not os.path.exists(chunk_model) or not os.path.exists(chunk_residual):
+        return None
+
+    if os.path.exists(chunk_image):
+        return chunk_image
+
+    major, minor, pa = beam_quantities(common_beam)
+
+    # Convolve model to common beam
+    chunk_model_conv = f'{chunk_base}.model.conv'
+    if os.path.exists(chunk_model_conv):
+        shutil.rmtree(chunk_model_conv)
+
+    imsmooth(
+        imagename=chunk_model,
+        kernel='gauss',
+        major=major,
+        minor=minor,
+        pa=pa,
+        targetres=True,
+        outfile=chunk_model_conv
+    )
+
+    # Add convolved model to residual.  Write to a temporary name first so an
+    # interrupted worker never leaves a half-written .image behind.
+    chunk_image_tmp = f'{chunk_image}.tmp'
+    if os.path.exists(chunk_image_tmp):
+        shutil.rmtree(chunk_image_tmp)
+    immath(
+        imagename=[chunk_model_conv, chunk_residual],
+        expr='IM0 + IM1',
+        outfile=chunk_image_tmp
+    )
+
+    # Set proper restoring beam in header
+    ia = image()
+    ia.open(chunk_image_tmp)
+    ia.setrestoringbeam(major=major, minor=minor, pa=pa)
+    ia.close()
+    ia.done()
+
+    # Clean up temporary convolved model
+    shutil.rmtree(chunk_model_conv)
+    os.rename(chunk_image_tmp, chunk_image)
+
+    return chunk_image
+
+
+# Cache of kernel FFTs, keyed by padded plane shape, beam and pixel scale
+_KERNEL_FFT_CACHE = {}
+
+
+def _beam_in_arcsec(common_beam):
+    """Return (major, minor) in arcsec and pa in degrees for a beam dict."""
+    from casatools import quanta
+    qa = quanta()
+    major = qa.convert(common_beam['major'], 'arcsec')['value']
+    minor = qa.convert(common_beam['minor'], 'arcsec')['value']
+    pa = qa.convert(common_beam['pa'], 'deg')['value']
+    return major, minor, pa
+
+
+def gaussian_kernel_fft(padded_shape, major, minor, pa, cdelt_x, cdelt_y):
+    """
+    FFT of a peak-normalised elliptical Gaussian on a (x, y) pixel grid.
+
+    A model in Jy/pixel convolved with this kernel comes out in Jy/beam, as
+    with imsmooth(targetres=True).  major/minor are FWHM in arcsec, pa is in
+    degrees east of north, and cdelt_x/cdelt_y are the signed pixel
+    increments in arcsec (cdelt_x < 0 for RA increasing to the left).
+    """
+    import numpy as np
+
+    key = (tuple(padded_shape), round(major, 9), round(minor, 9), round(pa, 9),
+           round(cdelt_x, 12), round(cdelt_y, 12))
+    if key in _KERNEL_FFT_CACHE:
+        return _KERNEL_FFT_CACHE[key]
+
+    nx, ny = padded_shape
+    # Pixel offsets with the kernel centre at (0, 0), wrapped for the FFT
+    dx = np.fft.fftfreq(nx, d=1. / nx)
+    dy = np.fft.fftfreq(ny, d=1. / ny)
+    # +x is west when cdelt_x < 0 (RA increases to the left)
+    east = dx[:, None] * cdelt_x
+    north = dy[None, :] * cdelt_y
+    pa_rad = np.deg2rad(pa)
+    along_major = north * np.cos(pa_rad) + east * np.sin(pa_rad)
+    along_minor = -north * np.sin(pa_rad) + east * np.cos(pa_rad)
+    kernel = np.exp(-4 * np.log(2) * ((along_major / major)**2 + (along_minor / minor)**2))
+
+    kernel_fft = np.fft.rfft2(kernel)
+    _KERNEL_FFT_CACHE[key] = kernel_fft
+    return kernel_fft
+
+
+def restore_chunk_fused(chunk_base, common_beam):
+    """
+    Single-pass restoration: .image = model (*) beam + residual, plane by plane.
+
+    Reads each .model and .residual plane once and writes each .image plane
+    once; the Gaussian kernel FFT is computed once per chunk and reused for
+    every plane.  Planes with an empty model are copied from the residual
+    without an FFT.
+    """
+    import numpy as np
+    from casatools import image
+
+    chunk_model = f'{chunk_base}.model'
+    chunk_residual = f'{chunk_base}.residual'
+    chunk_image = f'{chunk_base}.image'
+
+    if not os.path.exists(chunk_model) or not os.path.exists(chunk_residual):
+        return None
+
+    if os.path.exists(chunk_image):
+        return chunk_image
+
+    major, minor, pa = _beam_in_arcsec(common_beam)
+
+    ia_res = image()
+    ia_res.open(chunk_residual)
+    shape = [int(n) for n in ia_res.shape()]
+    csys = ia_res.coordsys()
+    has_mask = bool(ia_res.maskhandler('default')[0])
+    ia_res.close()
+
+    increment = csys.increment(format='n', type='direction')['numeric']
+    cdelt_x, cdelt_y = np.rad2deg(increment[:2]) * 3600.
+
+    ia_mod = image()
+    ia_mod.open(chunk_model)
+    ia_res.open(chunk_residual)
+
+    # Pad by the kernel support (3 FWHM) so FFT wrap-around cannot mix
+    # opposite edges of the plane
+    nx, ny = shape[0], shape[1]
+    pad = int(np.ceil(3 * major / min(abs(cdelt_x), abs(cdelt_y))))
+    padded_shape = (nx + 2 * pad, ny + 2 * pad)
+    kernel_fft = gaussian_kernel_fft(padded_shape, major, minor, pa, cdelt_x, cdelt_y)
+
+    chunk_image_tmp = f'{chunk_image}.tmp'
+    if os.path.exists(chunk_image_tmp):
+        shutil.rmtree(chunk_image_tmp)
+    ia_out = image()
+    ia_out.fromshape(outfile=chunk_image_tmp, shape=shape, csys=csys.torecord(), overwrite=True)
+    csys.done()
+
+    padded = np.zeros(padded_shape, dtype='float64')
+    nstokes = shape[2] if len(shape) > 2 else 1
+    nchan = shape[3] if len(shape) > 3 else 1
+    for stokes in range(nstokes):
+        for chan in range(nchan):
+            blc = [0, 0, stokes, chan][:len(shape)]
+            trc = [nx - 1, ny - 1, stokes, chan][:len(shape)]
+            model_plane = ia_mod.getchunk(blc=blc, trc=trc, dropdeg=True)
+            residual_plane = ia_res.getchunk(blc=blc, trc=trc, dropdeg=True)
+            if np.any(model_plane):
+                padded[:] = 0
+                padded[pad:pad + nx, pad:pad + ny] = model_plane
+                smoothed = np.fft.irfft2(np.fft.rfft2(padded) * kernel_fft, s=padded_shape)
+                plane = smoothed[pad:pad + nx, pad:pad + ny] + residual_plane
+            else:
+                plane = residual_plane
+            ia_out.putchunk(plane.astype('float32').reshape([nx, ny] + [1] * (len(shape) - 2)),
+                            blc=blc)
+
+    ia_mod.close()
+    ia_res.close()
+
+    maj_s, min_s, pa_s = beam_quantities(common_beam)
+    ia_out.setbrightnessunit('Jy/beam')
+    ia_out.setrestoringbeam(major=maj_s, minor=min_s, pa=pa_s)
+    if has_mask:
+        ia_out.calcmask(f'mask("{chunk_residual}")', name='mask0')
+    ia_out.close()
+    ia_out.done()
+    ia_mod.done()
+    ia_res.done()
+
+    os.rename(chunk_image_tmp, chunk_image)
+
+    return chunk_image
+
+
+def chunk_restore_memory_gb(chunk_base, method=None):
+    """
+    Rough peak memory of restoring one chunk.
+
+    The imsmooth path holds the model, the convolved model, the residual and
+    the output image as float32 cubes; the fused path only holds a handful of
+    padded float64/complex planes at a time.
+    """
+    from casatools import image
+    if method is None:
+        method = os.getenv('RESTORE_METHOD', 'fused')
+    ia = image()
+    ia.open(f'{chunk_base}.residual')
+    shape = ia.shape()
+    ia.close()
+    ia.done()
+    if method == 'fused':
+        return 8 * int(shape[0]) * int(shape[1]) * 8 / 1024**3
+    nvox = 1
+    for n in shape:
+        nvox *= int(n)
+    return 4 * nvox * 4 / 1024**3
+
+
+def default_workers():
+    return int(os.getenv('RESTORE_WORKERS', os.getenv('SLURM_CPUS_PER_TASK', '1')))
+
+
+def default_mem_gb():
+    if os.getenv('RESTORE_MEM_GB'):
+        return float(os.getenv('RESTORE_MEM_GB'))
+    if os.getenv('SLURM_MEM_PER_NODE'):
+        return 0.8 * float(os.getenv('SLURM_MEM_PER_NODE')) / 1024.
+    return None
+
+
+def restore_chunks(chunk_bases, common_beam, workers=None, mem_gb=None, log=print):
+    """
+    Restore many chunks, concurrently where the memory budget allows.
+
+    Args:
+        chunk_bases: chunk image basenames (without product suffix), in
+            channel order
+        common_beam: beam dict with 'major', 'minor' and 'pa' quantities
+        workers: maximum number of concurrent restorations
+        mem_gb: memory budget for all workers together
+        log: print-like function for progress messages
+
+    Returns the list of restored .image paths in the same order as
+    ``chunk_bases``, skipping chunks whose model or residual is missing.
+    """
+    if workers is None:
+        workers = default_workers()
+    if mem_gb is None:
+        mem_gb = default_mem_gb()
+
+    todo = [cb for cb in chunk_bases
+            if os.path.exists(f'{cb}.model') and os.path.exists(f'{cb}.residual')]
+    for cb in chunk_bases:
+        if cb not in todo:
+            log(f"  SKIPPING {cb}: model or residual missing")
+
+    if todo and mem_gb is not None:
+        per_chunk = chunk_restore_memory_gb(todo[0])
+        max_by_mem = max(1, int(mem_gb // max(per_chunk, 1e-3)))
+        if max_by_mem < workers:
+            log(f"  Memory cap {mem_gb:.1f}GB allows {max_by_mem} workers "
+                f"(~{per_chunk:.1f}GB per chunk), requested {workers}")
+        workers = min(workers, max_by_mem)
+    workers = max(1, min(workers, len(todo)))
+
+    log(f"  Restoring {len(todo)} chunks with {workers} worker(s)")
+
+    results = {}
+    if workers == 1:
+        for cb in todo:
+            log(f"  Creating {cb}.image...")
+            results[cb] = restore_chunk(cb, common_beam)
+    else:
+        beam_json = json.dumps(common_beam)
+
+        def run_worker(cb):
+            proc = subprocess.run([sys.executable, os.path.abspath(__file__), cb, beam_json],
+                                  stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                  universal_newlines=True)
+            if proc.returncode != 0:
+                raise RuntimeError(f"Restoration of {cb} failed (exit {proc.returncode}):\n"
+                                   f"{proc.stdout[-2000:]}")
+            return f'{cb}.image'
+
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {cb: pool.submit(run_worker, cb) for cb in todo}
+            for cb in todo:
+                results[cb] = futures[cb].result()
+                log(f"  Restored {results[cb]}")
+
+    return [results[cb] for cb in todo if results[cb] is not None]
+
+
+def compare_methods(chunk_base, common_beam, pa=30.):
+    """
+    Restore a chunk with both methods, with the beam's position angle set to
+    ``pa`` degrees, and return the largest |fused - imsmooth| difference as
+    a fraction of the imsmooth image's peak.
+
+    The restores go to a scratch directory (symlinks to the chunk's .model
+    and .residual), so the chunk's own .image is not touched.
+    """
+    import tempfile
+    import numpy as np
+    from casatools import image
+
+    beam = dict(common_beam, pa={'value': pa, 'unit': 'deg'})
+    scratch = tempfile.mkdtemp(prefix='restore_check.', dir=os.path.dirname(os.path.abspath(chunk_base)))
+    try:
+        images = {}
+        for method in ('fused', 'imsmooth'):
+            base = os.path.join(scratch, method)
+            for suffix in ('.model', '.residual'):
+                os.symlink(os.path.abspath(f'{chunk_base}{suffix}'), f'{base}{suffix}')
+            restored = restore_chunk(base, beam, method=method)
+            if restored is None:
+                raise FileNotFoundError(f"model or residual missing for {chunk_base}")
+            ia = image()
+            ia.open(restored)
+            images[method] = ia.getchunk(dropdeg=False)
+            ia.close()
+            ia.done()
+        reference = images['imsmooth']
+        peak = np.nanmax(np.abs(reference))
+        return float(np.nanmax(np.abs(images['fused'] - reference)) / peak) if peak > 0 else 0.
+    finally:
+        shutil.rmtree(scratch)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == '--check':
+        # python chunk_restore.py --check <chunk_base> '<common_beam json>' [pa_deg]
+        pa = float(sys.argv[4]) if len(sys.argv) > 4 else 30.
+        diff = compare_methods(sys.argv[2], json.loads(sys.argv[3]), pa=pa)
+        print(f"fused vs imsmooth at PA={pa:g} deg: max |difference| = {diff:.2e} of the peak")
+        sys.exit(0 if diff < 1e-3 else 1)
+    if len(sys.argv) != 3:
+        print("Usage: python chunk_restore.py <chunk_base> '<common_beam json>'")
+        print("       python chunk_restore.py --check <chunk_base> '<common_beam json>' [pa_deg]")
+        sys.exit(1)
+    restored = restore_chunk(sys.argv[1], json.loads(sys.argv[2]))
+    if restored is None:
+        print(f"ERROR: model or residual missing for {sys.argv[1]}")
+        sys.exit(1)
+    print(f"Created {restored}")
@@ -0,0 +1,100 @@
+"""
+Node-local scratch staging for SgrB2 chunk imaging.
+
+With SCRATCH_STAGING=1, sgrb2_chunk_imaging.py runs tclean in a directory
+under $SLURM_TMPDIR, so the many small tiled-table writes tclean makes go to
+the node's local disk instead of /orange.  When the chunk finishes, its
+products are copied back to WORK_DIR in bulk: each product is copied to
+<product>.tmp_copy, verified against the scratch copy (file count and
+total bytes), and only then renamed into place, so WORK_DIR never holds a
+partially copied product under its final name.  Bytes and time spent in
+the copy-back are reported.
+
+Environment variables:
+
+    SCRATCH_STAGING - '1' to image in node-local scratch (default: '0')
+    SCRATCH_DIR     - scratch directory (default: $SLURM_TMPDIR/chunk_scratch)
+"""
+
+import os
+import time
+import shutil
+
+
+def scratch_enabled():
+    return os.getenv('SCRATCH_STAGING', '0') == '1'
+
+
+def scratch_dir():
+    """Directory to image in, created if needed."""
+    path = os.getenv('SCRATCH_DIR')
+    if not path:
+        tmpdir = os.getenv('SLURM_TMPDIR')
+        if not tmpdir:
+            raise ValueError("SCRATCH_STAGING=1 needs SLURM_TMPDIR or SCRATCH_DIR")
+        path = os.path.join(tmpdir, 'chunk_scratch')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def tree_stats(path):
+    """Return (number of files, total bytes) under a CASA image directory."""
+    nfiles = nbytes = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            nfiles += 1
+            nbytes += os.path.getsize(os.path.join(root, name))
+    return nfiles, nbytes
+
+
+def stage_in(imagename, suffixes, src_dir, dst_dir, log=print):
+    """Copy existing products (e.g. a reused PSF) from WORK_DIR to scratch."""
+    for sfx in suffixes:
+        src = os.path.join(src_dir, f'{imagename}{sfx}')
+        dst = os.path.join(dst_dir, f'{imagename}{sfx}')
+        if os.path.exists(src):
+            if os.path.exists(dst):
+                shutil.rmtree(dst)
+            log(f"  Staging in {src}")
+            shutil.copytree(src, dst)
+
+
+def copy_back(imagename, suffixes, src_dir, dst_dir, log=print):
+    """
+    Copy finished products from scratch back to WORK_DIR with verification.
+
+    All products are copied to <product>.tmp_copy and verified before any
+    is renamed into place.  Raises IOError on a verification mismatch.
+    Returns (total bytes, seconds).
+    """
+    t0 = time.time()
+    total = 0
+    copied = []
+    for sfx in suffixes:
+        src = os.path.join(src_dir, f'{imagename}{sfx}')
+        if not os.path.exists(src):
+            continue
+        tmp = os.path.join(dst_dir, f'{imagename}{sfx}.tmp_copy')
+        if os.path.exists(tmp):
+            shutil.rmtree(tmp)
+        shutil.copytree(src, tmp)
+        src_stats, tmp_stats = tree_stats(src), tree_stats(tmp)
+        if src_stats != tmp_stats:
+            raise IOError(f"Copy-back of {src} failed verification: "
+                          f"{src_stats[0]} files/{src_stats[1]} bytes in scratch, "
+                          f"{tmp_stats[0]} files/{tmp_stats[1]} bytes copied")
+        total += src_stats[1]
+        copied.append(sfx)
+
+    for sfx in copied:
+        dst = os.path.join(dst_dir, f'{imagename}{sfx}')
+        if os.path.exists(dst):
+            shutil.rmtree(dst)
+        os.rename(f'{dst}.tmp_copy', dst)
+        shutil.rmtree(os.path.join(src_dir, f'{imagename}{sfx}'))
+
+    elapsed = time.time() - t0
+    rate = total / 2**20 / elapsed if elapsed > 0 else float('inf')
+    log(f"  Copied back {len(copied)} products, {total / 2**30:.2f} GB in {elapsed:.1f}s"
+        f" ({rate:.1f} MB/s)")
+    return total, elapsed
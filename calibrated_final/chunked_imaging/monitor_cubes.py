@@ -0,0 +1,386 @@
+#!/usr/bin/env python
+"""
+Live progress monitor for SgrB2 chunked cube imaging.
+
+For every field/SPW with a chunk plan (working_chunks/<FIELD>_spw<SPW>/
+chunk_plan.json) this shows completed, running, queued and failed chunks,
+the measured chunk duration and an ETA, from
+
+    one squeue call   - running and queued array tasks of $USER
+    one sacct call    - final state and elapsed time of finished tasks
+                        (since --since, default 7 days ago)
+    one listing of each work directory - .done/.residual/.psf/.lease
+                        markers and the chunks' .timing.json records
+
+The ETA is (remaining chunks / chunks in flight) x the median duration of
+the cube's completed chunks, less the mean time the running chunks have
+already spent; it is left empty while nothing of the cube is running or
+queued.
+
+Running chunks are checked against the SPW they are supposed to image (the
+problem monitor_ds6_spw29.sh was written for): the frequency axis of each
+running chunk's .psf is compared with the SPW's frequency range from the MS
+catalog (ms_catalog.json), widened by FRAME_TOLERANCE_KMS for the TOPO/LSRK
+difference.  Reading image headers needs casatools; without it the check is
+skipped.
+
+Jobs are matched to cubes by the job IDs recorded in the orchestrator's
+state database (chunk_orchestrator.py), or by job name
+(sgrb2_<FIELD>_spw<SPW>_chunk) for arrays submitted by the shell scripts.
+
+Usage:
+    python3 monitor_cubes.py [<FIELD> <SPW> | all] [--json [PATH]] [--watch SECONDS]
+                             [--since YYYY-MM-DD] [--quicklook] [--no-freq-check]
+
+Examples:
+    python3 monitor_cubes.py
+    python3 monitor_cubes.py DS6 29
+    python3 monitor_cubes.py all --json status.json
+    python3 monitor_cubes.py all --watch 1200
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+from statistics import median
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import chunk_planner
+import chunk_lease
+import chunk_benchmark
+import chunk_orchestrator as orch
+
+sys.path.insert(0, os.path.dirname(SCRIPT_DIR))
+import ms_catalog
+
+# ===========================
+# Configuration
+# ===========================
+
+# Approximate SPW ranges, used when the MS catalog has not been built
+SPW_FREQ_GHZ = {
+    '23': (132.89, 134.77),
+    '25': (135.0, 137.0),
+    '27': (144.83, 146.71),
+    '29': (146.6, 147.6),
+}
+
+# Allowed offset between the MS (TOPO) and image (LSRK) frequency frames
+FRAME_TOLERANCE_KMS = 60.
+
+FAILED_STATES = ('FAILED', 'TIMEOUT', 'OUT_OF_MEMORY', 'CANCELLED', 'NODE_FAIL', 'PREEMPTED', 'BOOT_FAIL')
+
+C_KMS = 299792.458
+
+
+# ===========================
+# Queries
+# ===========================
+
+def _split_task(job_id):
+    array_id, _, task = job_id.partition('_')
+    return array_id, int(task) if task.isdigit() else None
+
+
+def squeue_tasks():
+    """Active tasks of $USER from one squeue call (pending arrays expanded with -r)."""
+    try:
+        out = subprocess.run(['squeue', '-h', '-r', '-u', os.getenv('USER', ''), '-o', '%i|%j|%T|%M|%R'],
+                             stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        print("WARNING: squeue failed; no running jobs shown", file=sys.stderr)
+        return []
+    tasks = []
+    for line in out.splitlines():
+        job_id, name, state, elapsed, node = line.split('|', 4)
+        array_id, task = _split_task(job_id)
+        tasks.append({'array_id': array_id, 'task': task, 'name': name, 'state': state,
+                      'elapsed_s': chunk_benchmark.parse_duration(elapsed), 'node': node})
+    return tasks
+
+
+def sacct_tasks(names, since):
+    """Finished and running chunk tasks with these job names from one sacct call."""
+    if not names:
+        return []
+    cmd = ['sacct', '-X', '-P', '-n', '-u', os.getenv('USER', ''), '-S', since,
+           f"--name={','.join(sorted(names))}", '--format=JobID,JobName,State,End,ElapsedRaw']
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        print("WARNING: sacct failed; failed chunks are only detected from the work directories",
+              file=sys.stderr)
+        return []
+    tasks = []
+    for line in out.splitlines():
+        job_id, name, state, end, elapsed = line.split('|')
+        array_id, task = _split_task(job_id)
+        if task is None:
+            continue
+        tasks.append({'array_id': array_id, 'task': task, 'name': name, 'state': state.split()[0],
+                      'end': end, 'elapsed_s': float(elapsed) if elapsed else None})
+    return tasks
+
+
+def cube_job_ids(db, field, spw):
+    """Chunk array job IDs of a field/SPW recorded by the orchestrator, or None."""
+    if db is None:
+        return None
+    rows = db.execute("SELECT job_id FROM jobs WHERE field=? AND spw=? AND kind='chunk'",
+                      (field, spw)).fetchall()
+    return {row['job_id'] for row in rows} or None
+
+
+def spw_range_hz(spw):
+    """(low, high) frequency of an SPW over all catalogued MSs, in Hz."""
+    lo = hi = None
+    for entry in ms_catalog.load_catalog().values():
+        info = entry.get('spws', {}).get(str(spw))
+        if info is None:
+            continue
+        freqs = info['chanfreqs_hz']
+        half = abs(info['chanwidth_hz']) / 2.
+        lo = min(min(freqs) - half, lo if lo is not None else float('inf'))
+        hi = max(max(freqs) + half, hi if hi is not None else float('-inf'))
+    if lo is None:
+        lo, hi = (value * 1e9 for value in SPW_FREQ_GHZ[spw])
+    return lo, hi
+
+
+def image_freq_range_hz(imagename):
+    """(low, high) frequency of a CASA image's spectral axis, from its header."""
+    from casatools import image
+    ia = image()
+    ia.open(imagename)
+    summary = ia.summary(list=False)
+    ia.close()
+    ia.done()
+    axis = list(summary['axisnames']).index('Frequency')
+    nchan = summary['shape'][axis]
+    refval, refpix, incr = summary['refval'][axis], summary['refpix'][axis], summary['incr'][axis]
+    edges = [refval + (pix - refpix) * incr for pix in (-0.5, nchan - 0.5)]
+    return min(edges), max(edges)
+
+
+def check_frequency(imagename, spw):
+    """Frequency check of a running chunk: dict with lo_ghz, hi_ghz and ok (None if not possible)."""
+    try:
+        lo, hi = image_freq_range_hz(imagename)
+    except ImportError:
+        return {'lo_ghz': None, 'hi_ghz': None, 'ok': None, 'note': 'casatools not available'}
+    except Exception as ex:
+        return {'lo_ghz': None, 'hi_ghz': None, 'ok': None, 'note': str(ex)}
+    spw_lo, spw_hi = spw_range_hz(spw)
+    tol = spw_hi * FRAME_TOLERANCE_KMS / C_KMS
+    return {'lo_ghz': lo / 1e9, 'hi_ghz': hi / 1e9, 'ok': spw_lo - tol <= lo and hi <= spw_hi + tol,
+            'spw_ghz': [spw_lo / 1e9, spw_hi / 1e9]}
+
+
+# ===========================
+# Cube state
+# ===========================
+
+def cube_status(field, spw, queued, finished, db=None, freq_check=True):
+    """Chunk states, timings and ETA of one field/SPW, or None if it has no plan."""
+    work_dir = orch.work_dir_for(field, spw)
+    plan = chunk_planner.read_plan(work_dir)
+    if plan is None:
+        return None
+    try:
+        entries = set(os.listdir(work_dir))
+    except FileNotFoundError:
+        entries = set()
+
+    job_ids = cube_job_ids(db, field, spw)
+    name = f"sgrb2_{orch.field_clean(field)}_spw{spw}_chunk"
+
+    def ours(task):
+        return task['array_id'] in job_ids if job_ids is not None else task['name'] == name
+
+    active = {task['task']: task for task in queued if ours(task)}
+    last = {}
+    for task in finished:
+        if ours(task) and task['state'] not in ('RUNNING', 'PENDING'):
+            if task['task'] not in last or int(task['array_id']) > int(last[task['task']]['array_id']):
+                last[task['task']] = task
+
+    merged = f"{orch.basename_for(field, spw)}.cube.I.residual" in entries
+    nchan_chunk, totalnchan = plan['nchan_chunk'], plan['totalnchan']
+    chunks, durations = [], []
+    for chunk_id, startchan in enumerate(range(0, totalnchan, nchan_chunk)):
+        imagename = orch.chunk_imagename(field, spw, startchan, nchan_chunk)
+        chunk = {'chunk_id': chunk_id, 'startchan': startchan,
+                 'nchan': min(nchan_chunk, totalnchan - startchan)}
+        task = active.get(chunk_id)
+        if (merged or f"{imagename}.done" in entries
+                or (f"{imagename}.residual" in entries and task is None and f"{imagename}.lease" not in entries)):
+            chunk['state'] = 'done'
+            if chunk_id in last and last[chunk_id]['state'] == 'COMPLETED':
+                durations.append(last[chunk_id]['elapsed_s'])
+            elif f"{imagename}.timing.json" in entries:
+                with open(os.path.join(work_dir, f"{imagename}.timing.json")) as fh:
+                    durations.append(json.load(fh)['wall_s'])
+        elif task is not None:
+            chunk['state'] = 'running' if task['state'] == 'RUNNING' else 'queued'
+            chunk.update(job=f"{task['array_id']}_{chunk_id}", node=task['node'], elapsed_s=task['elapsed_s'])
+            if chunk['state'] == 'running' and freq_check and f"{imagename}.psf" in entries:
+                chunk['freq'] = check_frequency(os.path.join(work_dir, f"{imagename}.psf"), spw)
+        elif (f"{imagename}.lease" in entries
+              and chunk_lease.lease_state(os.path.join(work_dir, imagename)) == 'expired'):
+            chunk.update(state='failed', reason='lease expired')
+        elif chunk_id in last and last[chunk_id]['state'] in FAILED_STATES:
+            chunk.update(state='failed', reason=last[chunk_id]['state'],
+                         job=f"{last[chunk_id]['array_id']}_{chunk_id}")
+        elif f"{imagename}.psf" in entries or f"{imagename}.residual" in entries:
+            chunk.update(state='failed', reason='incomplete products, no active job')
+        else:
+            chunk['state'] = 'todo'
+        chunks.append(chunk)
+
+    counts = {state: 0 for state in ('done', 'running', 'queued', 'failed', 'todo')}
+    for chunk in chunks:
+        counts[chunk['state']] += 1
+
+    durations = [value for value in durations if value]
+    chunk_s = median(durations) if durations else None
+    remaining = len(chunks) - counts['done']
+    in_flight = counts['running'] or min(counts['queued'], chunk_planner.THROTTLE)
+    eta_s = None
+    if remaining == 0:
+        eta_s = 0.
+    elif chunk_s is not None and in_flight:
+        running_elapsed = [chunk['elapsed_s'] or 0 for chunk in chunks if chunk['state'] == 'running']
+        spent = sum(running_elapsed) / len(running_elapsed) if running_elapsed else 0.
+        eta_s = max(0., chunk_s * -(-remaining // in_flight) - spent)
+
+    freq = [chunk['freq']['ok'] for chunk in chunks if 'freq' in chunk and chunk['freq']['ok'] is not None]
+    return {
+        'field': field,
+        'spw': spw,
+        'work_dir': work_dir,
+        'nchunks': len(chunks),
+        'nchan_chunk': nchan_chunk,
+        'merged': merged,
+        'counts': counts,
+        'median_chunk_s': chunk_s,
+        'chan_per_hour': nchan_chunk * in_flight / chunk_s * 3600. if chunk_s and in_flight else None,
+        'eta_s': eta_s,
+        'freq_ok': all(freq) if freq else None,
+        'chunks': [chunk for chunk in chunks if chunk['state'] not in ('done', 'todo')],
+    }
+
+
+def collect(combos, since, quicklook=False, freq_check=True):
+    """Status of all planned cubes from one squeue and one sacct call."""
+    if quicklook:
+        orch.use_quicklook()
+    db_path = os.path.join(orch.WORK_BASE, 'chunk_state.sqlite')
+    db = orch.connect(db_path) if os.path.exists(db_path) else None
+    queued = squeue_tasks()
+    names = {f"sgrb2_{orch.field_clean(field)}_spw{spw}_chunk" for field, spw in combos}
+    finished = sacct_tasks(names, since)
+    cubes = [cube_status(field, spw, queued, finished, db=db, freq_check=freq_check) for field, spw in combos]
+    return {'generated': time.time(), 'quicklook': quicklook, 'cubes': [cube for cube in cubes if cube]}
+
+
+# ===========================
+# Output
+# ===========================
+
+def _hours(seconds, spec='6.1f'):
+    return format(seconds / 3600., spec) if seconds is not None else format('-', '>' + spec.split('.')[0])
+
+
+def print_report(report):
+    print(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(report['generated']))
+          + ("  (quick-look)" if report['quicklook'] else ""))
+    print("{:15s} {:>4s} {:>6s} {:>5s} {:>7s} {:>6s} {:>6s} {:>5s} {:>8s} {:>7s} {:>7s} {:>5s}".format(
+        "Field", "SPW", "chunks", "done", "running", "queued", "failed", "todo", "chunk[h]", "chan/h",
+        "ETA[h]", "freq"))
+    print("-" * 92)
+    for cube in report['cubes']:
+        counts = cube['counts']
+        freq = {True: 'ok', False: 'WRONG', None: '-'}[cube['freq_ok']]
+        chan_h = f"{cube['chan_per_hour']:7.0f}" if cube['chan_per_hour'] else f"{'-':>7s}"
+        print(f"{cube['field']:15s} {cube['spw']:>4s} {cube['nchunks']:6d} {counts['done']:5d} "
+              f"{counts['running']:7d} {counts['queued']:6d} {counts['failed']:6d} {counts['todo']:5d} "
+              f"{_hours(cube['median_chunk_s'], '8.2f')} {chan_h} {_hours(cube['eta_s'], '7.1f')} {freq:>5s}"
+              + ("  merged" if cube['merged'] else ""))
+
+    for cube in report['cubes']:
+        label = f"{cube['field']} SPW {cube['spw']}"
+        failed = [chunk for chunk in cube['chunks'] if chunk['state'] == 'failed']
+        if failed:
+            reasons = {}
+            for chunk in failed:
+                reasons.setdefault(chunk['reason'], []).append(chunk['chunk_id'])
+            for reason, ids in sorted(reasons.items()):
+                print(f"  {label}: failed {orch.compress_ids(ids)} ({reason})")
+        for chunk in cube['chunks']:
+            freq = chunk.get('freq')
+            if freq and freq['ok'] is False:
+                print(f"  WARNING {label} chunk {chunk['chunk_id']} ({chunk['job']}): imaging "
+                      f"{freq['lo_ghz']:.4f}-{freq['hi_ghz']:.4f} GHz, SPW {cube['spw']} covers "
+                      f"{freq['spw_ghz'][0]:.4f}-{freq['spw_ghz'][1]:.4f} GHz")
+    notes = {chunk['freq']['note'] for cube in report['cubes'] for chunk in cube['chunks']
+             if chunk.get('freq', {}).get('note')}
+    for note in sorted(notes):
+        print(f"  Frequency check skipped: {note}")
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Progress, ETA and frequency check of chunked cube imaging')
+    parser.add_argument('target', nargs='*', help="FIELD SPW, or 'all' (default)")
+    parser.add_argument('--json', nargs='?', const='-', metavar='PATH',
+                        help='Write the status as JSON to PATH (stdout if no PATH)')
+    parser.add_argument('--watch', type=int, metavar='SECONDS', help='Refresh every SECONDS')
+    parser.add_argument('--since', default=time.strftime('%Y-%m-%d', time.localtime(time.time() - 7 * 86400)),
+                        help='sacct start time (default: 7 days ago)')
+    parser.add_argument('--quicklook', action='store_true', help='Monitor the quick-look chunks')
+    parser.add_argument('--no-freq-check', action='store_true', help='Do not read running chunk headers')
+    args = parser.parse_args(argv)
+
+    if args.target in ([], ['all']):
+        combos = [(field, spw) for field in orch.ALL_FIELDS for spw in orch.ALL_SPWS]
+    elif len(args.target) == 2 and args.target[1] in orch.ALL_SPWS:
+        combos = [tuple(args.target)]
+    else:
+        print(f"ERROR: Need FIELD SPW (SPW one of {' '.join(orch.ALL_SPWS)}) or 'all'")
+        return 1
+
+    while True:
+        report = collect(combos, args.since, quicklook=args.quicklook, freq_check=not args.no_freq_check)
+        args.quicklook = False  # use_quicklook() has already switched WORK_BASE
+        report['quicklook'] = orch.QUICKLOOK
+        if args.json == '-':
+            print(json.dumps(report, indent=2))
+        else:
+            if args.watch:
+                print("\033[2J\033[H", end='')
+            if report['cubes']:
+                print_report(report)
+            else:
+                print(f"No chunk plans found under {orch.WORK_BASE}")
+            if args.json:
+                tmp = f"{args.json}.tmp"
+                with open(tmp, 'w') as fh:
+                    json.dump(report, fh, indent=2)
+                os.replace(tmp, args.json)
+        if not args.watch:
+            return 0
+        time.sleep(args.watch)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
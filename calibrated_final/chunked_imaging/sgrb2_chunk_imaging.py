@@ -8,14 +8,38 @@ environment variables:
     FIELD       - CASA field name (e.g., 'DS9', 'DS6', 'DS7-DS8', 'SgrB2S_DS1-5')
     SPW         - Spectral window number (23, 25, 27, 29)
     STARTCHAN   - Starting channel number for this chunk
-    NCHAN_CHUNK - Number of channels per chunk
+    NCHAN_CHUNK - Number of channels per chunk (defaults to the value in
+                  WORK_DIR/chunk_plan.json written by chunk_planner.py, else 32)
     WORK_DIR    - Working directory for output (absolute path)
 
+With VIS_CACHE=1 the chunk images from the channel-sliced MSs written by
+stage_chunk_vis.py (registered in WORK_DIR/vis_cache/manifest.json) instead
+of the full MSs.
+
+With SCRATCH_STAGING=1 tclean runs in node-local scratch ($SLURM_TMPDIR) and
+the products are copied back to WORK_DIR when the chunk finishes (see
+chunk_staging.py).
+
+With QUICKLOOK=1 the chunk is imaged as a quick-look preview (binned
+channels, coarse cell, small image, dirty; see ../quicklook.py).  The chunk
+keeps its native-channel name, so the orchestrator points WORK_DIR at
+working_chunks/quicklook/ and NCHAN_CHUNK must be a multiple of
+QUICKLOOK_BIN.
+
+With NOISE_NSIGMA=N the clean threshold is N times the median RMS of the
+chunk's channels in the field/SPW noise spectrum (../noise_estimator.py),
+if one has been measured, instead of the fixed 1.5 mJy.
+
+A successfully imaged chunk writes <imagename>.done.  With DOMERGE=1 and
+INCREMENTAL_MERGE=1 the merge consumes chunks that have a .done marker as
+they complete (see chunk_merge.incremental_merge_step).
+
 Follows the pattern from brick-jwst-2221/alma/reduction/slurm_subjob_jwbrick.py
 """
 
 import os
 import sys
+import time
 import shutil
 
 def logprint(string, origin='sgrb2_chunk_imaging.py', priority='INFO', flush=True):
@@ -38,12 +62,19 @@ if spw is None:
 
 startchan = int(os.getenv('STARTCHAN', '0'))
 
-nchan_chunk = int(os.getenv('NCHAN_CHUNK', '32'))
-
 work_dir = os.getenv('WORK_DIR')
 if work_dir is None:
     raise ValueError("WORK_DIR environment variable must be set")
 
+if os.getenv('NCHAN_CHUNK'):
+    nchan_chunk = int(os.getenv('NCHAN_CHUNK'))
+elif os.path.exists(os.path.join(work_dir, 'chunk_plan.json')):
+    import json
+    with open(os.path.join(work_dir, 'chunk_plan.json')) as fh:
+        nchan_chunk = int(json.load(fh)['nchan_chunk'])
+else:
+    nchan_chunk = 32
+
 domerge = os.getenv('DOMERGE', '0') == '1'
 
 print(f"SgrB2 chunked imaging")
@@ -60,6 +91,16 @@ print(f"  DOMERGE={domerge}")
 
 BASE = '/orange/adamginsburg/sgrb2/2024.1.01182.S/calibrated_final'
 
+# Helper modules (chunk_restore.py, ...) live next to this script in the
+# repository; the job copies only this file to SLURM_TMPDIR, so point
+# sys.path at the checked-out directory.
+CHUNK_IMAGING_DIR = os.getenv('CHUNK_IMAGING_DIR', f'{BASE}/chunked_imaging')
+if CHUNK_IMAGING_DIR not in sys.path:
+    sys.path.insert(0, CHUNK_IMAGING_DIR)
+# Shared helpers (casa_mpi.py, ...) live in calibrated_final/ itself
+if os.path.dirname(CHUNK_IMAGING_DIR) not in sys.path:
+    sys.path.append(os.path.dirname(CHUNK_IMAGING_DIR))
+
 # SgrB2S_DS1-5        17:47:20.026849 -28.23.46.89155 ICRS    4         950400
 # DS6                 17:47:21.120900 -28.24.18.26700 ICRS    5         950400
 # DS7-DS8             17:47:22.119692 -28.24.37.58403 ICRS    1         950400
@@ -152,6 +193,32 @@ if domerge:
     field_clean = field.replace('_', '')
     basename = f"oussid.SgrB2_{field_clean}_sci.spw{spw}"
 
+    # Incremental merge: append whatever contiguous chunks have finished since
+    # the last step (cursor in <basename>.cube.I.merge_cursor.json); the last
+    # step finalizes the merged products.  Steps are serialized by a lock.
+    if os.getenv('INCREMENTAL_MERGE', '0') == '1':
+        from chunk_merge import merge_lock, incremental_merge_step
+        finalize = os.getenv('FINALIZE_MERGE', '0') == '1'
+        with merge_lock(basename):
+            complete = incremental_merge_step(ia, basename, totalnchan, nchan_chunk,
+                                              cleanup=os.getenv('CLEANUP_CHUNKS', '1') == '1')
+        if complete:
+            print("Merge complete!")
+            sys.exit(0)
+        elif finalize:
+            print("ERROR: incremental merge could not be finalized (chunks missing);"
+                  " resubmit the failed chunks and rerun the merge")
+            sys.exit(1)
+        print("Incremental merge step done; merge not yet complete")
+        sys.exit(0)
+
+    from chunk_merge import (virtual_products, load_index, save_index, chunk_table,
+                             concat_product, materialize_product)
+    virtual_suffixes = virtual_products()
+    merge_index = load_index(basename)
+    merge_index['chunks'] = chunk_table(basename, totalnchan, nchan_chunk)
+    print(f"Virtual (reference) concatenation for: {virtual_suffixes or 'none'}")
+
     # Note: restoration=False means no .image file is produced;
     # the deconvolution products are .residual, .model, .mask, .psf, .pb, .sumwt
     for suffix in (".residual", ".model", ".mask", ".pb", ".psf", ".weight", ".sumwt"):
@@ -178,112 +245,57 @@ if domerge:
             print(f"SKIPPING {suffix}: merged output already exists: {outfile}")
             continue
 
-        print(f"Merging {len(existing)} files into {outfile}")
-        ia.imageconcat(outfile=outfile, infiles=existing, mode='p', relax=True)
+        virtual = suffix in virtual_suffixes
+        print(f"Merging {len(existing)} files into {outfile}"
+              + (" (virtual, references chunk files)" if virtual else ""))
+        concat_product(ia, outfile, existing, virtual)
+        if virtual and suffix not in merge_index['virtual']:
+            merge_index['virtual'].append(suffix)
+        save_index(basename, merge_index)
+
+    # Deferred physical concatenation of virtual products
+    if os.getenv('MATERIALIZE_VIRTUAL', '0') == '1':
+        for suffix in list(merge_index['virtual']):
+            outfile = f'{basename}.cube.I{suffix}'
+            print(f"Materializing virtual {outfile}")
+            materialize_product(ia, outfile)
+            merge_index['virtual'].remove(suffix)
+            save_index(basename, merge_index)
 
     # Create .image if it doesn't exist
     outimage = f'{basename}.cube.I.image'
     if not os.path.exists(outimage):
         print(f"\n.image does not exist, creating from model+residual with common beam...")
         
-        # Determine common beam from merged .psf or first chunk
+        # Determine the common beam from the per-channel beams in the chunk
+        # .psf headers (no merged .psf needed).  This is the smallest beam
+        # that encloses every channel's beam, so every channel can be
+        # convolved to it; the beam table is cached as a sidecar JSON.
+        from chunk_beams import chunk_beam_table, read_beams, common_beam as enclosing_beam, beam_dict
+        chunk_bases = [f'{basename}.{ii:04d}+{nchan_chunk:03d}.cube.I'
+                       for ii in range(0, totalnchan, nchan_chunk)]
         merged_psf = f'{basename}.cube.I.psf'
-        if os.path.exists(merged_psf):
-            ia.open(merged_psf)
-            beam_info = ia.restoringbeam()
-            ia.close()
-            if 'beams' in beam_info:
-                # Multi-beam case: use median beam
-                # Each channel has a beam stored as beams['*0']['*0'], beams['*1']['*0'], etc.
-                major_list = []
-                minor_list = []
-                pa_list = []
-                for chan_key in beam_info['beams']:
-                    beam = beam_info['beams'][chan_key]['*0']  # Get the single beam for this channel
-                    major_list.append(beam['major']['value'])
-                    minor_list.append(beam['minor']['value'])
-                    pa_list.append(beam['positionangle']['value'])
-                
-                import numpy as np
-                major_unit = list(beam_info['beams'].values())[0]['*0']['major']['unit']
-                minor_unit = list(beam_info['beams'].values())[0]['*0']['minor']['unit']
-                pa_unit = list(beam_info['beams'].values())[0]['*0']['positionangle']['unit']
-                
-                common_beam = {
-                    'major': {'value': np.median(major_list), 'unit': major_unit},
-                    'minor': {'value': np.median(minor_list), 'unit': minor_unit},
-                    'pa': {'value': np.median(pa_list), 'unit': pa_unit}
-                }
-            else:
-                # Single beam case
-                common_beam = {
-                    'major': beam_info['major'],
-                    'minor': beam_info['minor'],
-                    'pa': beam_info.get('positionangle', beam_info.get('pa'))
-                }
-            print(f"  Common beam: {common_beam['major']['value']:.3f}{common_beam['major']['unit']} x {common_beam['minor']['value']:.3f}{common_beam['minor']['unit']}, PA={common_beam['pa']['value']:.1f}{common_beam['pa']['unit']}")
+        if any(os.path.exists(f'{cb}.psf') for cb in chunk_bases):
+            common_beam = chunk_beam_table(basename, chunk_bases)['common_beam']
+        elif os.path.exists(merged_psf):
+            common_beam = beam_dict(*enclosing_beam(*read_beams(merged_psf)))
         else:
-            raise FileNotFoundError(f"Cannot determine common beam: {merged_psf} not found")
+            raise FileNotFoundError(f"Cannot determine common beam: no chunk .psf and {merged_psf} not found")
+        print(f"  Common beam: {common_beam['major']['value']:.3f}{common_beam['major']['unit']} x {common_beam['minor']['value']:.3f}{common_beam['minor']['unit']}, PA={common_beam['pa']['value']:.1f}{common_beam['pa']['unit']}")
         
-        # Process each chunk: convolve model and add to residual
-        chunk_images = []
-        for ii in range(0, totalnchan, nchan_chunk):
-            chunk_base = f'{basename}.{ii:04d}+{nchan_chunk:03d}.cube.I'
-            chunk_model = f'{chunk_base}.model'
-            chunk_residual = f'{chunk_base}.residual'
-            chunk_image = f'{chunk_base}.image'
-            
-            if not os.path.exists(chunk_model) or not os.path.exists(chunk_residual):
-                print(f"  SKIPPING chunk {ii:04d}: model or residual missing")
-                continue
-            
-            if os.path.exists(chunk_image):
-                print(f"  Chunk {ii:04d}: .image already exists")
-                chunk_images.append(chunk_image)
-                continue
-            
-            print(f"  Creating chunk {ii:04d} .image...")
-            
-            # Convolve model to common beam
-            chunk_model_conv = f'{chunk_base}.model.conv'
-            if os.path.exists(chunk_model_conv):
-                shutil.rmtree(chunk_model_conv)
-            
-            imsmooth(
-                imagename=chunk_model,
-                kernel='gauss',
-                major=f"{common_beam['major']['value']}{common_beam['major']['unit']}",
-                minor=f"{common_beam['minor']['value']}{common_beam['minor']['unit']}",
-                pa=f"{common_beam['pa']['value']}{common_beam['pa']['unit']}",
-                targetres=True,
-                outfile=chunk_model_conv
-            )
-            
-            # Add convolved model to residual
-            immath(
-                imagename=[chunk_model_conv, chunk_residual],
-                expr='IM0 + IM1',
-                outfile=chunk_image
-            )
-            
-            # Set proper restoring beam in header
-            ia.open(chunk_image)
-            ia.setrestoringbeam(
-                major=f"{common_beam['major']['value']}{common_beam['major']['unit']}",
-                minor=f"{common_beam['minor']['value']}{common_beam['minor']['unit']}",
-                pa=f"{common_beam['pa']['value']}{common_beam['pa']['unit']}"
-            )
-            ia.close()
-            
-            # Clean up temporary convolved model
-            shutil.rmtree(chunk_model_conv)
-            
-            chunk_images.append(chunk_image)
+        # Process each chunk: convolve model and add to residual.  Chunks are
+        # independent, so restore them in a process pool (RESTORE_WORKERS,
+        # RESTORE_MEM_GB) before the final concatenation.
+        from chunk_restore import restore_chunks
+        chunk_images = restore_chunks(chunk_bases, common_beam)
         
         # Concatenate chunk .image files
         if chunk_images:
             print(f"\n  Concatenating {len(chunk_images)} chunk .image files...")
-            ia.imageconcat(outfile=outimage, infiles=chunk_images, mode='p', relax=True)
+            concat_product(ia, outimage, chunk_images, '.image' in virtual_suffixes)
+            if '.image' in virtual_suffixes and '.image' not in merge_index['virtual']:
+                merge_index['virtual'].append('.image')
+                save_index(basename, merge_index)
             print(f"  Created {outimage}")
         else:
             print("  ERROR: No chunk .image files to concatenate")
@@ -300,6 +312,10 @@ if domerge:
             if not os.path.exists(merged):
                 print(f"  Skipping cleanup for {suffix}: merged file does not exist")
                 continue
+            if suffix in merge_index['virtual']:
+                print(f"  Keeping chunk {suffix} files: merged file is a virtual concatenation"
+                      " (set MATERIALIZE_VIRTUAL=1 to copy it)")
+                continue
             for ii in range(0, totalnchan, nchan_chunk):
                 chunk = f'{basename}.{ii:04d}+{nchan_chunk:03d}.cube.I{suffix}'
                 if os.path.exists(chunk):
@@ -321,13 +337,28 @@ print(f"Working in {os.getcwd()}")
 field_clean = field.replace('_', '')
 imagename = f"oussid.SgrB2_{field_clean}_sci.spw{spw}.{startchan:04d}+{nchan_chunk:03d}.cube.I"
 
-# Check if this chunk is already done (use .residual since restoration=False)
-if os.path.exists(f"{imagename}.residual"):
+# Check if this chunk is already done.  Jobs hold <imagename>.lease with a
+# heartbeat while they run, so partial products left by a crashed or
+# preempted job (expired lease) are reclaimed instead of blocking the chunk.
+from chunk_lease import (lease_state, read_lease, describe_lease, reclaim_chunk,
+                         acquire_lease, release_lease, abandon_lease)
+calcpsf = True
+reclaim = False
+if os.path.exists(f"{imagename}.done"):
+    print(f"SKIPPING: {imagename}.done already exists")
+    sys.exit(0)
+elif os.path.exists(f"{imagename}.residual") and read_lease(imagename) is None:
+    # Completed by a job that predates leases and .done markers
     print(f"SKIPPING: {imagename}.residual already exists")
     sys.exit(0)
-elif os.path.exists(f"{imagename}.psf"):
-    print(f"SKIPPING: {imagename}.psf already exists (either it's in progress or broken)")
-    sys.exit(1)
+elif os.path.exists(f"{imagename}.psf") or read_lease(imagename) is not None:
+    # (with scratch staging a running chunk has only its lease in WORK_DIR)
+    state = lease_state(imagename)
+    if state == 'fresh':
+        print(f"SKIPPING: {imagename} is in progress ({describe_lease(imagename)})")
+        sys.exit(1)
+    print(f"RECLAIMING: {imagename} has an expired lease ({describe_lease(imagename)})")
+    reclaim = True
 
 # Clamp nchan if we'd go past the end
 actual_nchan = min(nchan_chunk, totalnchan - startchan)
@@ -351,61 +382,150 @@ else:
     tclean_start = startchan
     tclean_width = ''
 
+# Image from the pre-staged channel slices if there are any for this chunk.
+# The slices are reindexed (one SPW 0 starting at original channel 'lo')
+# and hold the selected column as DATA.
+tclean_args = {'imsize': [2880, 2880], 'cell': '0.025arcsec', 'niter': 1000,
+               'threshold': '1.5mJy', 'usemask': 'auto-multithresh'}
+import noise_estimator
+tclean_args['threshold'] = noise_estimator.clean_threshold(field, spw, startchan, actual_nchan,
+                                                           default=tclean_args['threshold'])
+tclean_nchan = actual_nchan
+
+if os.getenv('VIS_CACHE', '0') == '1':
+    from stage_chunk_vis import manifest_entry
+    entry = manifest_entry(work_dir, startchan, nchan_chunk)
+    if entry is None or not all(os.path.exists(v) for v in entry['vis']):
+        print(f"WARNING: VIS_CACHE=1 but no complete slices for {startchan:04d}+{nchan_chunk:03d};"
+              " imaging from the full MSs")
+    else:
+        vis_list = entry['vis']
+        datacolumn = 'data'
+        spw_selection = '0'
+        if not spw_cfg['start']:
+            tclean_start = startchan - entry['lo']
+        print(f"Using channel slices {entry['lo']}~{entry['hi']} (pad {entry['pad']}) from the vis cache")
+
+# Quick-look preview: bin channels, coarse cell, small image, dirty
+import quicklook
+if quicklook.enabled():
+    if nchan_chunk % quicklook.chan_bin():
+        raise ValueError(f"QUICKLOOK=1 needs NCHAN_CHUNK ({nchan_chunk}) to be a multiple of "
+                         f"QUICKLOOK_BIN ({quicklook.chan_bin()})")
+    print(quicklook.describe())
+    tclean_start, tclean_width, tclean_nchan = quicklook.binned_axis(tclean_start, tclean_width, actual_nchan)
+    tclean_args.update(quicklook.tclean_overrides())
+
 print(f"\nImaging chunk:")
 print(f"  imagename: {imagename}")
 print(f"  field: {field}")
 print(f"  spw_selection: '{spw_selection}'")
 print(f"  datacolumn: {datacolumn}")
-print(f"  nchan: {actual_nchan}")
+print(f"  nchan: {tclean_nchan}")
 print(f"  start: {tclean_start}")
 print(f"  width: {tclean_width}")
 print(f"  phasecenter: {cfg['phasecenter']}")
 print(f"  vis: {len(vis_list)} MS files")
 
-tclean(
-    vis=vis_list,
-    field=field,
-    spw=spw_selection,
-    intent='OBSERVE_TARGET#ON_SOURCE',
-    datacolumn=datacolumn,
-    imagename=imagename,
-    imsize=[2880, 2880],
-    cell='0.025arcsec',
-    phasecenter=cfg['phasecenter'],
-    stokes='I',
-    specmode='cube',
-    nchan=actual_nchan,
-    start=tclean_start,
-    width=tclean_width,
-    outframe='LSRK',
-    perchanweightdensity=True,
-    gridder='standard',
-    mosweight=False,
-    usepointing=False,
-    pblimit=0.2,
-    deconvolver='hogbom',
-    restoration=False,
-    restoringbeam='common',
-    pbcor=False,
-    weighting='briggsbwtaper',
-    robust=0.5,
-    npixels=0,
-    niter=1000,
-    threshold='1.5mJy',
-    nsigma=0.0,
-    interactive=False,
-    fullsummary=False,
-    usemask='auto-multithresh',
-    sidelobethreshold=2.5,
-    noisethreshold=5.0,
-    lownoisethreshold=1.5,
-    negativethreshold=0.0,
-    minbeamfrac=0.3,
-    growiterations=75,
-    restart=True,
-    calcres=True,
-    calcpsf=True,
-    parallel=False,
-)
+# Channel-parallel imaging of the chunk when running under mpicasa
+from casa_mpi import tclean_parallel, mpi_world_size, write_timing
+parallel = tclean_parallel()
+print(f"  parallel: {parallel} ({mpi_world_size()} MPI processes)")
+
+# The lease and .done marker always live in WORK_DIR; with scratch staging
+# only tclean's products are written to node-local disk
+from chunk_staging import scratch_enabled, scratch_dir, stage_in, copy_back
+chunk_path = os.path.join(work_dir, imagename)
+CHUNK_PRODUCTS = (".residual", ".model", ".mask", ".pb", ".psf", ".weight", ".sumwt")
+# The lease is taken atomically before any partial products are removed, so
+# of several jobs reclaiming the same expired chunk only one images it
+heartbeat = acquire_lease(chunk_path)
+if heartbeat is None:
+    print(f"SKIPPING: {imagename} was taken by another job ({describe_lease(chunk_path)})")
+    sys.exit(1)
+if reclaim:
+    calcpsf = not reclaim_chunk(chunk_path)
+    if not calcpsf:
+        print(f"  Reusing existing PSF products (LEASE_REUSE_PSF=1)")
+print(f"  calcpsf: {calcpsf}")
+if scratch_enabled():
+    os.chdir(scratch_dir())
+    print(f"  Imaging in scratch: {os.getcwd()}")
+    if not calcpsf:
+        stage_in(imagename, (".psf", ".sumwt", ".pb", ".weight"), work_dir, os.getcwd())
+t_start = time.time()
+try:
+    tclean(
+        vis=vis_list,
+        field=field,
+        spw=spw_selection,
+        intent='OBSERVE_TARGET#ON_SOURCE',
+        datacolumn=datacolumn,
+        imagename=imagename,
+        imsize=tclean_args['imsize'],
+        cell=tclean_args['cell'],
+        phasecenter=cfg['phasecenter'],
+        stokes='I',
+        specmode='cube',
+        nchan=tclean_nchan,
+        start=tclean_start,
+        width=tclean_width,
+        outframe='LSRK',
+        perchanweightdensity=True,
+        gridder='standard',
+        mosweight=False,
+        usepointing=False,
+        pblimit=0.2,
+        deconvolver='hogbom',
+        restoration=False,
+        restoringbeam='common',
+        pbcor=False,
+        weighting='briggsbwtaper',
+        robust=0.5,
+        npixels=0,
+        niter=tclean_args['niter'],
+        threshold=tclean_args['threshold'],
+        nsigma=0.0,
+        interactive=False,
+        fullsummary=False,
+        usemask=tclean_args['usemask'],
+        sidelobethreshold=2.5,
+        noisethreshold=5.0,
+        lownoisethreshold=1.5,
+        negativethreshold=0.0,
+        minbeamfrac=0.3,
+        growiterations=75,
+        restart=True,
+        calcres=True,
+        calcpsf=calcpsf,
+        parallel=parallel,
+    )
+    if scratch_enabled():
+        copy_back(imagename, CHUNK_PRODUCTS, os.getcwd(), work_dir)
+        os.chdir(work_dir)
+except BaseException:
+    abandon_lease(chunk_path, heartbeat)
+    raise
+t_end = time.time()
+
+# Mark the chunk as complete: .residual appears as soon as tclean starts its
+# major cycles, so the incremental merge only consumes chunks with a marker
+import json
+with open(f"{chunk_path}.done", 'w') as fh:
+    json.dump({'finished': time.strftime('%Y-%m-%dT%H:%M:%S'),
+               'job_id': os.getenv('SLURM_JOB_ID'), 'host': os.uname().nodename,
+               'startchan': startchan, 'nchan': actual_nchan}, fh)
+
+release_lease(chunk_path, heartbeat)
+
+# Timing is telemetry: the chunk is already complete, so a failure here is
+# only a warning (an exception would leave the chunk to be re-imaged)
+try:
+    write_timing(f"{chunk_path}.timing.json", imagename, t_start, t_end,
+                 logfile=casalog.logfile(), parallel=parallel,
+                 field=field, spw=spw, startchan=startchan, nchan=actual_nchan,
+                 quicklook=quicklook.enabled())
+except Exception as e:
+    print(f"WARNING: could not write the tclean timing: {e}")
 
 print(f"\nCompleted chunk: {imagename}")
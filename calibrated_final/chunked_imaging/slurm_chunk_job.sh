@@ -17,6 +17,24 @@
 #   SPW         - spectral window
 #   NCHAN_CHUNK - channels per chunk
 #   WORK_DIR    - output directory
+#   INCREMENTAL_MERGE - '1' to queue an incremental merge step after this
+#                 chunk succeeds (one pending step per field/SPW; steps run
+#                 one at a time via --dependency=singleton)
+#   LEASE_TIMEOUT, LEASE_HEARTBEAT, LEASE_REUSE_PSF - chunk lease settings
+#                 (see chunk_lease.py); partial products of a chunk whose
+#                 lease expired are reclaimed automatically
+#   SCRATCH_STAGING - '1' to run tclean in $SLURM_TMPDIR and copy the
+#                 finished products back to WORK_DIR (see chunk_staging.py)
+#   VIS_CACHE   - '1' to image from the channel slices written by
+#                 stage_chunk_vis.py (slurm_stage_vis_job.sh)
+#   USE_MPI     - '1' to run CASA under mpicasa with SLURM_CPUS_PER_TASK
+#                 processes; tclean then images the chunk channel-parallel
+#                 (see casa_mpi.py; timing in <imagename>.timing.json)
+#   QUICKLOOK   - '1' for a quick-look preview chunk (QUICKLOOK_BIN channel
+#                 binning, coarse cell, QUICKLOOK_NITER iterations; see
+#                 quicklook.py); WORK_DIR should be under working_chunks/quicklook
+#   NOISE_NSIGMA - clean to NOISE_NSIGMA x the chunk's measured RMS instead
+#                 of 1.5mJy (needs a noise spectrum from noise_estimator.py)
 #
 # STARTCHAN is computed from SLURM_ARRAY_TASK_ID * NCHAN_CHUNK
 
@@ -44,6 +62,9 @@ echo "  NCHAN_CHUNK=${NCHAN_CHUNK}"
 echo "  WORK_DIR=${WORK_DIR}"
 echo "  SLURM_ARRAY_TASK_ID=${SLURM_ARRAY_TASK_ID}"
 echo "  SLURM_JOB_ID=${SLURM_JOB_ID}"
+echo "  SCRATCH_STAGING=${SCRATCH_STAGING:-0}"
+echo "  QUICKLOOK=${QUICKLOOK:-0}"
+echo "  NOISE_NSIGMA=${NOISE_NSIGMA:-unset}"
 echo "  Script: ${SCRIPT}"
 echo "================================================================"
 
@@ -62,6 +83,18 @@ ls $SLURM_TMPDIR
 
 # Export variables for the CASA script
 export FIELD SPW STARTCHAN NCHAN_CHUNK WORK_DIR
+export INCREMENTAL_MERGE=${INCREMENTAL_MERGE:-0}
+export SCRATCH_STAGING=${SCRATCH_STAGING:-0}
+export VIS_CACHE=${VIS_CACHE:-0}
+export USE_MPI=${USE_MPI:-0}
+export QUICKLOOK=${QUICKLOOK:-0}
+[ -n "${QUICKLOOK_BIN}" ] && export QUICKLOOK_BIN
+[ -n "${QUICKLOOK_NITER}" ] && export QUICKLOOK_NITER
+[ -n "${NOISE_NSIGMA}" ] && export NOISE_NSIGMA
+if [ "${SCRATCH_STAGING}" = "1" ]; then
+    echo "Scratch staging enabled; node-local space:"
+    df -h "${SLURM_TMPDIR}"
+fi
 export DOMERGE=0
 
 # Set up CASA environment
@@ -69,7 +102,15 @@ LOG_DIR="/orange/adamginsburg/sgrb2/2024.1.01182.S/calibrated_final/logs"
 LOGFILE="${LOG_DIR}/casa_chunk_${FIELD}_spw${SPW}_${SLURM_JOB_ID}.log"
 
 # Run CASA using the working pattern from brick scripts
-${CASA_PATH} --logfile=${LOGFILE} --nogui --nologger --cachedir=$SLURM_TMPDIR -c "execfile('${SCRIPT}')"
+if [ "${USE_MPI}" = "1" ]; then
+    # One MPI client plus SLURM_CPUS_PER_TASK-1 servers
+    NRANKS=${SLURM_CPUS_PER_TASK:-4}
+    export OMP_NUM_THREADS=1
+    echo "Running under mpicasa with ${NRANKS} processes"
+    $(dirname ${CASA_PATH})/mpicasa -n ${NRANKS} ${CASA_PATH} --logfile=${LOGFILE} --nogui --nologger --cachedir=$SLURM_TMPDIR -c "execfile('${SCRIPT}')"
+else
+    ${CASA_PATH} --logfile=${LOGFILE} --nogui --nologger --cachedir=$SLURM_TMPDIR -c "execfile('${SCRIPT}')"
+fi
 exit_code=$?
 
 if [ $exit_code -ne 0 ]; then
@@ -78,3 +119,20 @@ if [ $exit_code -ne 0 ]; then
 fi
 
 echo "Chunk imaging completed successfully"
+
+# Queue an incremental merge step, unless one is already waiting to run
+if [ "${INCREMENTAL_MERGE:-0}" = "1" ]; then
+    FIELD_CLEAN="${FIELD//_/}"
+    MERGE_NAME="sgrb2_${FIELD_CLEAN}_spw${SPW}_incmerge"
+    MERGE_SCRIPT="/orange/adamginsburg/sgrb2/2024.1.01182.S/calibrated_final/chunked_imaging/slurm_merge_job.sh"
+    if [ -n "$(squeue -h -u "$USER" -n "${MERGE_NAME}" -t PENDING -o %i)" ]; then
+        echo "Incremental merge step already pending for ${MERGE_NAME}"
+    else
+        sbatch --dependency=singleton \
+            --job-name="${MERGE_NAME}" \
+            --export=FIELD=${FIELD},SPW=${SPW},NCHAN_CHUNK=${NCHAN_CHUNK},WORK_DIR=${WORK_DIR},INCREMENTAL_MERGE=1,CLEANUP_CHUNKS=${CLEANUP_CHUNKS:-1} \
+            --output="${LOG_DIR}/merge_${FIELD_CLEAN}_spw${SPW}_%j.log" \
+            --error="${LOG_DIR}/merge_${FIELD_CLEAN}_spw${SPW}_%j.err" \
+            "${MERGE_SCRIPT}"
+    fi
+fi
@@ -19,8 +19,20 @@
 #   NCHAN_CHUNK    - channels per chunk (must match chunk jobs)
 #   WORK_DIR       - directory containing chunk outputs
 #   CLEANUP_CHUNKS - '1' to remove chunk files after merge (default: '1')
+#   RESTORE_WORKERS - chunks restored concurrently (default: SLURM_CPUS_PER_TASK)
+#   RESTORE_MEM_GB  - memory budget for restoration workers (default: 80% of --mem)
+#   RESTORE_METHOD  - 'fused' single-pass restoration (default) or 'imsmooth'
+#   VIRTUAL_PRODUCTS - suffixes merged as virtual concatenations that reference
+#                     the chunk files (default: '.psf,.weight,.sumwt,.mask')
+#   MATERIALIZE_VIRTUAL - '1' to copy existing virtual products into physical images
+#   INCREMENTAL_MERGE - '1' to merge only the chunks finished since the last
+#                     step (persistent cursor; see chunk_merge.py)
+#   FINALIZE_MERGE  - '1' to fail if the incremental merge cannot be finalized
 #
-# This job should be submitted with --dependency=afterok:<chunk_array_jobid>
+# This job should be submitted with --dependency=afterok:<chunk_array_jobid>,
+# or, for incremental merges, as the final step with
+# --dependency=afterany:<chunk_array_jobid> and FINALIZE_MERGE=1 (earlier steps
+# are queued by the chunk jobs themselves).
 
 CASA_PATH="/orange/adamginsburg/casa/casa-6.6.6-17-pipeline-2025.1.0.35-py3.10.el8/bin/casa"
 PYTHON_SCRIPT="/orange/adamginsburg/sgrb2/2024.1.01182.S/calibrated_final/chunked_imaging/sgrb2_chunk_imaging.py"
@@ -37,6 +49,8 @@ echo "  SPW=${SPW}"
 echo "  NCHAN_CHUNK=${NCHAN_CHUNK}"
 echo "  WORK_DIR=${WORK_DIR}"
 echo "  CLEANUP_CHUNKS=${CLEANUP_CHUNKS:-1}"
+echo "  RESTORE_WORKERS=${RESTORE_WORKERS:-${SLURM_CPUS_PER_TASK}}"
+echo "  INCREMENTAL_MERGE=${INCREMENTAL_MERGE:-0} FINALIZE_MERGE=${FINALIZE_MERGE:-0}"
 echo "  SLURM_JOB_ID=${SLURM_JOB_ID}"
 echo "================================================================"
 
@@ -48,6 +62,13 @@ SCRIPT="${SLURM_TMPDIR}/sgrb2_chunk_imaging.py"
 export FIELD SPW NCHAN_CHUNK WORK_DIR
 export DOMERGE=1
 export CLEANUP_CHUNKS=${CLEANUP_CHUNKS:-1}
+export RESTORE_WORKERS=${RESTORE_WORKERS:-${SLURM_CPUS_PER_TASK:-1}}
+[ -n "${RESTORE_MEM_GB}" ] && export RESTORE_MEM_GB
+export RESTORE_METHOD=${RESTORE_METHOD:-fused}
+export VIRTUAL_PRODUCTS=${VIRTUAL_PRODUCTS-.psf,.weight,.sumwt,.mask}
+export MATERIALIZE_VIRTUAL=${MATERIALIZE_VIRTUAL:-0}
+export INCREMENTAL_MERGE=${INCREMENTAL_MERGE:-0}
+export FINALIZE_MERGE=${FINALIZE_MERGE:-0}
 # STARTCHAN is not used in merge mode but set it to avoid errors
 export STARTCHAN=0
 
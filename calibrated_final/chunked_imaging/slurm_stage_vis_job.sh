@@ -0,0 +1,50 @@
+#!/bin/bash
+#SBATCH --job-name=sgrb2_stagevis
+#SBATCH --output=/orange/adamginsburg/sgrb2/2024.1.01182.S/calibrated_final/logs/stagevis_%x_%j.log
+#SBATCH --error=/orange/adamginsburg/sgrb2/2024.1.01182.S/calibrated_final/logs/stagevis_%x_%j.err
+#SBATCH --nodes=1
+#SBATCH --ntasks=1
+#SBATCH --cpus-per-task=8
+#SBATCH --mem=32gb
+#SBATCH --time=24:00:00
+#SBATCH --qos=astronomy-dept-b
+#SBATCH --account=astronomy-dept
+
+# SgrB2 chunked cube imaging - visibility slice staging job
+#
+# Writes the per-chunk channel slices (stage_chunk_vis.py) that chunk jobs
+# run with VIS_CACHE=1 image from.  Environment variables must be set:
+#   FIELD       - field name
+#   SPW         - spectral window
+#   CHUNKS      - chunk IDs to stage, e.g. '0-5,9' (default: all)
+#   VIS_PAD_KMS - Doppler pad in km/s (default: 30)
+#
+# Chunk arrays should depend on this job with --dependency=afterok:<jobid>
+
+CASA_PATH="/orange/adamginsburg/casa/casa-6.6.6-17-pipeline-2025.1.0.35-py3.10.el8/bin/casa"
+CASA_PYTHON="$(dirname ${CASA_PATH})/python3"
+STAGE_SCRIPT="/orange/adamginsburg/sgrb2/2024.1.01182.S/calibrated_final/chunked_imaging/stage_chunk_vis.py"
+
+if [ -z "$FIELD" ] || [ -z "$SPW" ]; then
+    echo "ERROR: FIELD and SPW must be set"
+    exit 1
+fi
+
+echo "================================================================"
+echo "SgrB2 chunked imaging - visibility staging job"
+echo "  FIELD=${FIELD}"
+echo "  SPW=${SPW}"
+echo "  CHUNKS=${CHUNKS:-all}"
+echo "  SLURM_JOB_ID=${SLURM_JOB_ID}"
+echo "================================================================"
+
+cd ${SLURM_TMPDIR:-/tmp}
+${CASA_PYTHON} ${STAGE_SCRIPT} "${FIELD}" "${SPW}" ${CHUNKS:+--chunks ${CHUNKS}} --workers ${SLURM_CPUS_PER_TASK:-1}
+exit_code=$?
+
+if [ $exit_code -ne 0 ]; then
+    echo "Visibility staging exited with code ${exit_code}"
+    exit $exit_code
+fi
+
+echo "Visibility staging completed successfully"
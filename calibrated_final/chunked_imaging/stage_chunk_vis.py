@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+"""
+Pre-stage channel-sliced visibilities for SgrB2 chunked imaging.
+
+Every chunk job otherwise opens all 10 MSs and lets tclean select its
+channels; for SgrB2S_DS1-5 these are the full consolidated
+*_targets_line.ms files with every field and SPW.  This writes, once per
+field/SPW/chunk, a compact slice of each MS holding only the field and the
+chunk's channel range plus a pad (mstransform), and records the slices in a
+manifest (<WORK_DIR>/vis_cache/manifest.json).  Chunk jobs run with
+VIS_CACHE=1 image from the slices instead (see sgrb2_chunk_imaging.py).
+
+The pad covers the Doppler shift between execution blocks: tclean grids the
+chunk onto an LSRK channel axis defined by the first MS, and the same LSRK
+channel falls on a different topocentric channel in MSs observed on other
+dates.  It defaults to the shift for VIS_PAD_KMS (30 km/s, Earth's orbital
+velocity) plus two channels for the gridding kernel.
+
+The slices are written with mstransform's default reindexing, so each slice
+has a single SPW 0 whose channel 0 is channel <lo> of the original SPW and
+the data column is DATA (CORRECTED_DATA for the consolidated MSs).
+
+Needs CASA (casatasks/casatools); slices are written concurrently by
+worker processes running this file.
+
+Usage:
+    python stage_chunk_vis.py <FIELD> <SPW> [--chunks 0-5,9] [--workers N] [--pad N]
+
+Examples:
+    python stage_chunk_vis.py SgrB2S_DS1-5 29 --workers 4
+    python stage_chunk_vis.py DS6 25 --chunks 10-19
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import shutil
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, SCRIPT_DIR)
+
+import chunk_planner
+
+# ===========================
+# Configuration (must match sgrb2_chunk_imaging.py)
+# ===========================
+
+BASE = '/orange/adamginsburg/sgrb2/2024.1.01182.S/calibrated_final'
+WORK_BASE = os.path.join(BASE, 'working_chunks')
+
+MS_UIDS = [
+    'uid___A002_X12c4b14_X77b0',
+    'uid___A002_X12c7631_X2152',
+    'uid___A002_X12c99be_Xa92b',
+    'uid___A002_X12cdde9_Xb8e6',
+    'uid___A002_X12d0dd8_Xbca',
+    'uid___A002_X12d2ac0_X13ec',
+    'uid___A002_X12d2ac0_X72e2',
+    'uid___A002_X12d4098_X223c',
+    'uid___A002_X12de9a8_X8e3e',
+    'uid___A002_X12de9a8_X954b',
+]
+
+# Field -> (ms_key, use_temp_line)
+FIELD_MS = {
+    'SgrB2S_DS1-5': ('DS15', False),
+    'DS6': ('DS6', True),
+    'DS7-DS8': ('DS7DS8', True),
+    'DS9': ('DS9', True),
+}
+
+SPEED_OF_LIGHT_KMS = 299792.458
+EDGE_CHANNELS = 2
+
+
+def source_vis(field, spw):
+    """Return (vis list, datacolumn) that the chunk jobs would image from."""
+    ms_key, use_temp_line = FIELD_MS[field]
+    if use_temp_line:
+        return ([f"{BASE}/temp_line/{uid}_{ms_key}_spw{spw}_line.ms" for uid in MS_UIDS], 'data')
+    return ([f"{BASE}/measurement_sets/{uid}_targets_line.ms" for uid in MS_UIDS], 'corrected')
+
+
+def cache_dir(work_dir):
+    return os.path.join(work_dir, 'vis_cache')
+
+
+def manifest_path(work_dir):
+    return os.path.join(cache_dir(work_dir), 'manifest.json')
+
+
+def load_manifest(work_dir):
+    path = manifest_path(work_dir)
+    if os.path.exists(path):
+        with open(path) as fh:
+            return json.load(fh)
+    return {'chunks': {}}
+
+
+def save_manifest(work_dir, manifest):
+    path = manifest_path(work_dir)
+    with open(f'{path}.tmp', 'w') as fh:
+        json.dump(manifest, fh, indent=2)
+    os.replace(f'{path}.tmp', path)
+
+
+def manifest_entry(work_dir, startchan, nchan_chunk):
+    """Manifest entry for a chunk, or None if it has not been staged."""
+    return load_manifest(work_dir)['chunks'].get(f'{startchan:04d}+{nchan_chunk:03d}')
+
+
+def doppler_pad(vis, spw, pad_kms=None):
+    """Channels of padding needed on each side of a chunk."""
+    from casatools import msmetadata
+    if pad_kms is None:
+        pad_kms = float(os.getenv('VIS_PAD_KMS', '30'))
+    msmd = msmetadata()
+    msmd.open(vis)
+    freqs = msmd.chanfreqs(int(spw))
+    widths = msmd.chanwidths(int(spw))
+    msmd.close()
+    shift = pad_kms / SPEED_OF_LIGHT_KMS * max(abs(freqs.max()), abs(freqs.min()))
+    return int(math.ceil(shift / abs(widths).min())) + EDGE_CHANNELS
+
+
+def slice_ms(vis, outputvis, field, spw_selection, datacolumn):
+    """Write one channel slice with mstransform (atomically, via a .tmp MS)."""
+    from casatasks import mstransform
+    tmp = f'{outputvis}.tmp'
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    mstransform(vis=vis, outputvis=tmp, field=field, spw=spw_selection,
+                intent='OBSERVE_TARGET#ON_SOURCE', datacolumn=datacolumn,
+                keepflags=True)
+    os.rename(tmp, outputvis)
+
+
+def stage_field_spw(field, spw, chunk_ids=None, workers=1, pad=None, force=False, log=print):
+    """
+    Stage slices for the chunks of one field/SPW and update the manifest.
+
+    Returns the number of chunks staged.
+    """
+    field_clean = field.replace('_', '')
+    work_dir = os.path.join(WORK_BASE, f'{field_clean}_spw{spw}')
+    plan = chunk_planner.read_plan(work_dir) or chunk_planner.plan_field_spw(field, spw)
+    nchan_chunk = plan['nchan_chunk']
+    totalnchan = chunk_planner.TOTALNCHAN[spw]
+    if chunk_ids is None:
+        chunk_ids = range(plan['nchunks'])
+
+    vis_list, datacolumn = source_vis(field, spw)
+    missing = [v for v in vis_list if not os.path.exists(v)]
+    if missing:
+        raise FileNotFoundError(f"Missing MS files:\n" + "\n".join(missing))
+    if pad is None:
+        pad = doppler_pad(vis_list[0], spw)
+
+    os.makedirs(cache_dir(work_dir), exist_ok=True)
+    manifest = load_manifest(work_dir)
+    log(f"Staging {field} SPW {spw}: {len(chunk_ids)} chunks of {nchan_chunk} chan, pad {pad} chan")
+
+    tasks = []
+    entries = {}
+    for chunk_id in chunk_ids:
+        startchan = chunk_id * nchan_chunk
+        nchan = min(nchan_chunk, totalnchan - startchan)
+        key = f'{startchan:04d}+{nchan_chunk:03d}'
+        lo = max(0, startchan - pad)
+        hi = min(totalnchan - 1, startchan + nchan - 1 + pad)
+        chunk_dir = os.path.join(cache_dir(work_dir), key)
+        os.makedirs(chunk_dir, exist_ok=True)
+        slices = [os.path.join(chunk_dir, os.path.basename(v).replace('.ms', f'.{key}.ms'))
+                  for v in vis_list]
+        entries[key] = {'startchan': startchan, 'nchan': nchan, 'lo': lo, 'hi': hi,
+                        'pad': pad, 'source_datacolumn': datacolumn, 'vis': slices}
+        old = manifest['chunks'].get(key)
+        for vis, outputvis in zip(vis_list, slices):
+            if os.path.exists(outputvis) and not force and old is not None and old['lo'] == lo:
+                continue
+            if os.path.exists(outputvis):
+                shutil.rmtree(outputvis)
+            tasks.append((vis, outputvis, f'{spw}:{lo}~{hi}'))
+
+    log(f"  {len(tasks)} slices to write with {workers} worker(s)")
+    t0 = time.time()
+
+    def run_slice(task):
+        vis, outputvis, spw_selection = task
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__), '--slice',
+                               vis, outputvis, field, spw_selection, datacolumn],
+                              stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                              universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"Slicing {vis} ({spw_selection}) failed (exit {proc.returncode}):\n"
+                               f"{proc.stdout[-2000:]}")
+        log(f"  Wrote {outputvis}")
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(run_slice, tasks))
+
+    for key, entry in entries.items():
+        entry['created'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        manifest['chunks'][key] = entry
+    save_manifest(work_dir, manifest)
+    log(f"  Staged {len(entries)} chunks in {time.time() - t0:.0f}s; manifest {manifest_path(work_dir)}")
+    return len(entries)
+
+
+def parse_ids(spec):
+    """Parse '0-5,9' into a list of ints."""
+    ids = []
+    for part in spec.split(','):
+        lo, _, hi = part.partition('-')
+        ids.extend(range(int(lo), int(hi or lo) + 1))
+    return ids
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == '--slice':
+        # Worker mode: write a single slice
+        slice_ms(*argv[1:6])
+        return 0
+
+    parser = argparse.ArgumentParser(description='Stage channel-sliced visibilities for chunk imaging')
+    parser.add_argument('field')
+    parser.add_argument('spw', choices=chunk_planner.ALL_SPWS)
+    parser.add_argument('--chunks', help="Chunk IDs to stage, e.g. '0-5,9' (default: all)")
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('SLURM_CPUS_PER_TASK', '1')),
+                        help='Concurrent mstransform processes')
+    parser.add_argument('--pad', type=int, help='Channel pad on each side (default: from VIS_PAD_KMS)')
+    parser.add_argument('--force', action='store_true', help='Rewrite existing slices')
+    args = parser.parse_args(argv)
+
+    if args.field not in FIELD_MS:
+        print(f"ERROR: Unknown field '{args.field}'. Must be one of: {list(FIELD_MS)}")
+        return 1
+    chunk_ids = parse_ids(args.chunks) if args.chunks else None
+    stage_field_spw(args.field, args.spw, chunk_ids, workers=args.workers,
+                    pad=args.pad, force=args.force)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
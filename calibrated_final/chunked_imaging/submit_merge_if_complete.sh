@@ -16,7 +16,10 @@ declare -A SPW_CHANNELS=(
     [29]=3840
 )
 
-NCHAN_CHUNK=32
+# Default chunk size for work dirs submitted before chunk_planner.py existed;
+# otherwise NCHAN_CHUNK is read from <work_dir>/chunk_plan.json
+DEFAULT_NCHAN_CHUNK=32
+PLANNER="${SCRIPT_DIR}/chunk_planner.py"
 
 # Field list
 FIELDS=("SgrB2S_DS1-5" "DS6" "DS7-DS8" "DS9")
@@ -26,12 +29,19 @@ check_and_submit_merge() {
     local field=$1
     local spw=$2
     
-    local totalchan=${SPW_CHANNELS[$spw]}
-    local expected_chunks=$(( (totalchan + NCHAN_CHUNK - 1) / NCHAN_CHUNK ))
-    
     # Construct work dir - match the naming from submit_chunked_jobs.sh
     local field_clean="${field//_/}"
     local work_dir="${BASE_DIR}/working_chunks/${field_clean}_spw${spw}"
+
+    # Use the chunk size this work dir was planned with
+    local NCHAN_CHUNK=${DEFAULT_NCHAN_CHUNK}
+    local NCHUNKS ARRAY_SPEC PLAN_MEM PLAN_TIME PLAN_CPUS
+    if [ -f "${work_dir}/chunk_plan.json" ]; then
+        eval "$(python3 "${PLANNER}" --read-plan "${work_dir}" --shell)"
+    fi
+
+    local totalchan=${SPW_CHANNELS[$spw]}
+    local expected_chunks=$(( (totalchan + NCHAN_CHUNK - 1) / NCHAN_CHUNK ))
     
     # Count existing residual files (exclude merged output files)
     local residual_count=0
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Disk and memory footprint of SgrB2 cubes, for gating job submission.
+
+Computes the on-disk size of every tclean product of a cube (or of one
+chunk) from the image size and channel count, and the peak tclean memory
+from the chunk planner's memory model (chunked_imaging/chunk_planner.py),
+so the two never disagree.
+
+On-disk sizes: CASA paged images store float32 pixels (4 bytes/pixel) plus
+a 1-bit-per-pixel pixel mask where tclean attaches one (the pblimit mask on
+.image, .residual and .pb), and a small fixed amount of table metadata.
+.sumwt holds one value per channel.
+
+Used by:
+    image_cubes.py         - refuses to image when the cube exceeds
+                             MAXCUBELIMIT, or free space / --mem is too small
+    chunk_orchestrator.py  - refuses to submit without enough free space in
+                             the work directory, and checks the memory
+                             request against the node limit and the MaxRSS
+                             of chunks that have run (max_rss_gb)
+    check_setup.sh         - prints the table for all cubes
+
+Pure python (no CASA needed).
+
+Usage:
+    python3 cube_footprint.py <FIELD> <SPW> [--nchan-chunk N] [--free PATH]
+    python3 cube_footprint.py all [--free PATH]
+
+Examples:
+    python3 cube_footprint.py DS6 29 --nchan-chunk 32
+    python3 cube_footprint.py all --free working_chunks
+"""
+
+import os
+import sys
+import json
+import shutil
+import argparse
+import subprocess
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'chunked_imaging'))
+
+import chunk_planner
+
+# ===========================
+# Configuration
+# ===========================
+
+# Float32 planes per channel for each product
+PRODUCT_PLANES = {
+    '.residual': 1,
+    '.model': 1,
+    '.mask': 1,
+    '.pb': 1,
+    '.psf': 1,
+    '.weight': 1,
+    '.sumwt': 0,
+    '.image': 1,
+}
+
+# Products that carry a boolean pixel mask (1 bit per pixel)
+PIXEL_MASKED = ('.image', '.residual', '.pb')
+
+# table.dat, table.info, logtable, locks, ... per image
+TABLE_OVERHEAD_BYTES = 256 * 1024
+
+GB = 1024**3
+
+
+# ===========================
+# FUNCTIONS
+# ===========================
+
+def product_bytes(suffix, imsize, nchan):
+    """On-disk size in bytes of one tclean product of ``nchan`` channels."""
+    npix = imsize[0] * imsize[1] * nchan
+    nbytes = PRODUCT_PLANES[suffix] * npix * 4 + TABLE_OVERHEAD_BYTES
+    if suffix == '.sumwt':
+        nbytes += nchan * 4
+    if suffix in PIXEL_MASKED:
+        nbytes += (npix + 7) // 8
+    return nbytes
+
+
+def products_bytes(imsize, nchan, restoration=False):
+    """Sizes of all products written by tclean (plus .image if restoring)."""
+    suffixes = [sfx for sfx in PRODUCT_PLANES if restoration or sfx != '.image']
+    return {sfx: product_bytes(sfx, imsize, nchan) for sfx in suffixes}
+
+
+def tclean_memory_gb(nchan, rows=None, imsize=chunk_planner.IMSIZE):
+    """Peak tclean memory (GB) for ``nchan`` channels, from the planner's model."""
+    if rows is None:
+        rows = [chunk_planner.DEFAULT_ROWS_PER_MS] * chunk_planner.NMS
+    _, memory = chunk_planner.predict_chunk(nchan, rows, imsize=imsize)
+    return memory
+
+
+def cube_footprint(field, spw, nchan_chunk=None, imsize=chunk_planner.IMSIZE, rows=None,
+                   virtual=('.psf', '.weight', '.sumwt', '.mask'), chan_bin=1):
+    """
+    Footprint of one field/SPW cube.
+
+    With ``nchan_chunk`` the cube is imaged in chunks and merged; the peak
+    disk usage is then reached during the merge, when the chunk products,
+    the restored chunk .image files and the merged physical products
+    coexist (products in ``virtual`` are merged by reference and cost
+    nothing extra).  Without it, the cube is imaged in one tclean call
+    (image_cubes.py, restoration=False).
+
+    ``chan_bin`` native channels are binned into each image channel
+    (quick-look cubes); ``nchan_chunk`` is in native channels.
+
+    Returns a dict with per-product bytes of the final cube, the total, the
+    peak disk usage and the peak tclean memory (GB, unpadded).
+    """
+    totalnchan = -(-chunk_planner.TOTALNCHAN[spw] // chan_bin)
+    if nchan_chunk is not None:
+        nchan_chunk = -(-nchan_chunk // chan_bin)
+    final = products_bytes(imsize, totalnchan, restoration=nchan_chunk is not None)
+    total = sum(final.values())
+
+    if nchan_chunk is None:
+        peak_disk = total
+        memory = tclean_memory_gb(totalnchan, rows, imsize)
+        nchunks = 1
+    else:
+        nchunks = (totalnchan + nchan_chunk - 1) // nchan_chunk
+        chunk_products = sum(sum(products_bytes(imsize, min(nchan_chunk, totalnchan - start)).values())
+                             for start in range(0, totalnchan, nchan_chunk))
+        chunk_images = sum(product_bytes('.image', imsize, min(nchan_chunk, totalnchan - start))
+                           for start in range(0, totalnchan, nchan_chunk))
+        merged_physical = sum(nbytes for sfx, nbytes in final.items() if sfx not in virtual)
+        peak_disk = chunk_products + chunk_images + merged_physical
+        memory = tclean_memory_gb(nchan_chunk, rows, imsize)
+
+    return {
+        'field': field,
+        'spw': spw,
+        'imsize': list(imsize),
+        'totalnchan': totalnchan,
+        'nchan_chunk': nchan_chunk,
+        'nchunks': nchunks,
+        'products': final,
+        'total_bytes': total,
+        'peak_disk_bytes': peak_disk,
+        'memory_gb': memory,
+    }
+
+
+def free_bytes(path):
+    """Free space on the filesystem holding ``path`` (or its nearest existing parent)."""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    return shutil.disk_usage(path).free
+
+
+def parse_mem_gb(mem):
+    """Parse an sbatch --mem value ('64gb', '32G', '4000M', '4000') to GB."""
+    mem = str(mem).strip().lower().rstrip('b')
+    units = {'k': 1. / 1024**2, 'm': 1. / 1024, 'g': 1., 't': 1024.}
+    if mem and mem[-1] in units:
+        return float(mem[:-1]) * units[mem[-1]]
+    return float(mem) / 1024.  # sbatch default unit is MB
+
+
+def max_rss_gb(job_ids):
+    """Largest MaxRSS (GB) sacct reports for the given SLURM jobs (one call), or None."""
+    if not job_ids:
+        return None
+    cmd = ['sacct', '-P', '-n', '-j', ','.join(job_ids), '--format=JobID,MaxRSS']
+    try:
+        out = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL,
+                             universal_newlines=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    # MaxRSS is only reported on the steps (.batch), e.g. '51234567K'
+    peaks = [parse_mem_gb(fields[1]) for fields in (line.split('|') for line in out.splitlines())
+             if len(fields) > 1 and fields[1]]
+    return max(peaks) if peaks else None
+
+
+def allocated_mem_gb():
+    """Memory of the current SLURM allocation in GB, or None outside SLURM."""
+    if os.getenv('SLURM_MEM_PER_NODE'):
+        return float(os.getenv('SLURM_MEM_PER_NODE')) / 1024.
+    return None
+
+
+def print_footprint(fp, free=None):
+    chunking = f"{fp['nchunks']} chunks of {fp['nchan_chunk']}" if fp['nchan_chunk'] else "single tclean"
+    print(f"{fp['field']} SPW {fp['spw']}: {fp['imsize'][0]}x{fp['imsize'][1]}x{fp['totalnchan']}, {chunking}")
+    for sfx, nbytes in fp['products'].items():
+        print(f"  {sfx:10s} {nbytes / GB:9.1f} GB")
+    print(f"  {'total':10s} {fp['total_bytes'] / GB:9.1f} GB")
+    print(f"  peak disk  {fp['peak_disk_bytes'] / GB:9.1f} GB"
+          + (f"  (free: {free / GB:.0f} GB{'' if free >= fp['peak_disk_bytes'] else ' -- INSUFFICIENT'})"
+             if free is not None else ""))
+    print(f"  tclean mem {fp['memory_gb']:9.1f} GB"
+          f"  (request with safety: {chunk_planner.MEM_SAFETY * fp['memory_gb']:.0f} GB)")
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Disk and memory footprint of SgrB2 cubes')
+    parser.add_argument('field', help="Field name, or 'all'")
+    parser.add_argument('spw', nargs='?', help='Spectral window')
+    parser.add_argument('--nchan-chunk', type=int,
+                        help='Chunked imaging with this chunk size')
+    parser.add_argument('--free', help='Compare peak disk usage with free space at this path')
+    parser.add_argument('--json', action='store_true', help='Print the footprints as JSON')
+    args = parser.parse_args(argv)
+
+    if args.field == 'all':
+        combos = [(field, spw) for field in chunk_planner.ALL_FIELDS for spw in chunk_planner.ALL_SPWS]
+    else:
+        if args.spw not in chunk_planner.ALL_SPWS:
+            print(f"ERROR: Need FIELD and SPW (one of {' '.join(chunk_planner.ALL_SPWS)}), or 'all'")
+            return 1
+        combos = [(args.field, args.spw)]
+
+    footprints = [cube_footprint(field, spw, nchan_chunk=args.nchan_chunk) for field, spw in combos]
+    if args.json:
+        print(json.dumps(footprints, indent=2))
+        return 0
+
+    free = free_bytes(args.free) if args.free else None
+    for fp in footprints:
+        print_footprint(fp, free)
+    if len(footprints) > 1:
+        total = sum(fp['total_bytes'] for fp in footprints)
+        peak = max(fp['peak_disk_bytes'] for fp in footprints)
+        print(f"All {len(footprints)} cubes: {total / GB / 1024:.2f} TB final products, "
+              f"largest single-cube peak {peak / GB:.0f} GB")
+        if free is not None and free < total:
+            print(f"WARNING: {free / GB:.0f} GB free is less than the {total / GB:.0f} GB needed for all cubes")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
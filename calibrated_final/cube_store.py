@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+"""
+Chunked, compressed Zarr/HDF5 stores of the merged SgrB2 cubes.
+
+CASA paged images are tiled for tclean, so reading a spectrum, or a channel
+map, out of a merged cube touches many tiles.  This converts each merged
+field/SPW cube into one store holding
+
+    image, residual, pb  - float32 (chan, y, x), Stokes I, masked pixels NaN
+    mask                 - uint8 clean mask (chan, y, x)
+    beams                - per-channel restoring beam table of the image
+                           (bmaj, bmin in arcsec, bpa in deg)
+
+chunked with one of the --layout presets, or an explicit --chunks c,y,x:
+
+    spectral  - (all channels, 16, 16): a spectrum is one chunk read
+    planes    - (4, 512, 512): channel maps / moment windows
+    balanced  - (64, 128, 128): mixed access
+
+and compressed (Blosc/zstd with byte shuffle for Zarr, gzip with shuffle
+for HDF5).  The store's attributes carry the FITS-style WCS header of the
+image (export_fits.fits_header_cards), the axis order, and provenance: the
+source images and their modification times, the chunk plan they were imaged
+with, the creation time, host and casatools version.
+
+The cube is copied in regions aligned to the store's chunk grid (at most
+--block-mb each, read with ia.getchunk), so every chunk is written exactly
+once and memory stays bounded.  Stores are written as <name>.tmp and
+renamed into place when complete.
+
+Writing needs casatools plus zarr (--format zarr, default) or h5py
+(--format hdf5); both are optional.  Reading needs only zarr/h5py (and
+astropy for the WCS):
+
+    import cube_store
+    store = cube_store.open_store('cube_store/oussid.SgrB2_DS6_sci.spw29.cube.I.zarr')
+    spectrum = store['image'][:, 1440, 1440]          # lazy, one chunk row
+    wcs = cube_store.store_wcs(store)
+
+Usage:
+    python cube_store.py [CUBE ...] [--format zarr|hdf5] [--layout spectral|planes|balanced]
+                         [--chunks C,Y,X] [--products image,residual,pb,mask]
+                         [--output-dir cube_store] [--block-mb MB] [--overwrite]
+
+CUBE is a merged image name without the product suffix (e.g.
+working_chunks/DS6_spw29/oussid.SgrB2_DS6_sci.spw29.cube.I); with none, all
+merged cubes in working_chunks/*/ and cube_images/ are converted.
+
+Examples:
+    python cube_store.py --layout spectral
+    python cube_store.py working_chunks/DS9_spw23/oussid.SgrB2_DS9_sci.spw23.cube.I --format hdf5 --chunks 32,256,256
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+
+import numpy as np
+
+import casa_script
+from casa_script import script_args
+import export_fits
+sys.path.insert(0, os.path.join(casa_script.BASEDIR, 'chunked_imaging'))
+import chunk_planner
+
+# ===========================
+# Configuration
+# ===========================
+
+OUTPUT_DIR = 'cube_store'
+PRODUCTS = ['image', 'residual', 'pb', 'mask']
+
+# Chunk shapes (chan, y, x); None = the full axis
+LAYOUTS = {
+    'spectral': (None, 16, 16),
+    'planes': (4, 512, 512),
+    'balanced': (64, 128, 128),
+}
+
+EXTENSIONS = {'zarr': '.zarr', 'hdf5': '.h5'}
+
+GB = 1024**3
+
+
+# ===========================
+# Backends
+# ===========================
+
+class ZarrWriter:
+    def __init__(self, path):
+        import zarr
+        self.zarr = zarr
+        self.root = zarr.open_group(path, mode='w')
+
+    def create(self, name, shape, chunks, dtype, fill_value):
+        if hasattr(self.root, 'create_array'):
+            # zarr >= 3: zstd with byte shuffle
+            from zarr.codecs import BloscCodec
+            return self.root.create_array(name, shape=shape, chunks=chunks, dtype=dtype, fill_value=fill_value,
+                                          compressors=[BloscCodec(cname='zstd', clevel=5, shuffle='shuffle')])
+        from numcodecs import Blosc
+        return self.root.create_dataset(name, shape=shape, chunks=chunks, dtype=dtype, fill_value=fill_value,
+                                        compressor=Blosc(cname='zstd', clevel=5, shuffle=Blosc.SHUFFLE))
+
+    def set_attrs(self, attrs):
+        self.root.attrs.update(attrs)
+
+    def close(self):
+        pass
+
+
+class Hdf5Writer:
+    def __init__(self, path):
+        import h5py
+        self.fh = h5py.File(path, 'w')
+
+    def create(self, name, shape, chunks, dtype, fill_value):
+        return self.fh.create_dataset(name, shape=shape, chunks=chunks, dtype=dtype, fillvalue=fill_value,
+                                      compression='gzip', compression_opts=4, shuffle=True)
+
+    def set_attrs(self, attrs):
+        # HDF5 attributes hold scalars/arrays; nested metadata goes in as JSON
+        for key, value in attrs.items():
+            self.fh.attrs[key] = json.dumps(value) if isinstance(value, (dict, list)) else value
+
+    def close(self):
+        self.fh.close()
+
+
+WRITERS = {'zarr': ZarrWriter, 'hdf5': Hdf5Writer}
+
+
+# ===========================
+# FUNCTIONS
+# ===========================
+
+def chunk_shape(layout, shape, chunks=None):
+    """Store chunk shape (chan, y, x) for a cube shape, clipped to the cube."""
+    chunks = chunks or LAYOUTS[layout]
+    return tuple(min(c or n, n) for c, n in zip(chunks, shape))
+
+
+def write_regions(shape, chunks, itemsize, block_mb):
+    """
+    Yield (c0, c1, y0, y1, x0, x1) regions covering the cube, each a whole
+    number of chunks and at most ``block_mb`` (but at least one chunk).
+    """
+    region = list(chunks)
+    budget = block_mb * 2**20 / itemsize
+    # Grow along x, then y, then channels, in whole chunks
+    for axis in (2, 1, 0):
+        while region[axis] < shape[axis] and np.prod(region) * 2 <= budget:
+            region[axis] = min(region[axis] * 2, shape[axis])
+        if region[axis] < shape[axis]:
+            break
+    for c0 in range(0, shape[0], region[0]):
+        for y0 in range(0, shape[1], region[1]):
+            for x0 in range(0, shape[2], region[2]):
+                yield (c0, min(c0 + region[0], shape[0]), y0, min(y0 + region[1], shape[1]),
+                       x0, min(x0 + region[2], shape[2]))
+
+
+def find_cubes():
+    """Merged cubes (image names without product suffix) in working_chunks/ and cube_images/."""
+    return [path[:-len('.image')] for path in export_fits.find_merged_images()]
+
+
+def provenance(base, products):
+    """Where the store came from: source images, their mtimes and the chunk plan."""
+    import casatools
+    sources = {}
+    for product in products:
+        path = f"{base}.{product}"
+        sources[product] = {'path': os.path.abspath(path),
+                            'mtime': max(os.path.getmtime(os.path.join(path, name))
+                                         for name in os.listdir(path) if name != 'table.lock')}
+    return {
+        'tool': 'cube_store.py',
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'host': os.uname().nodename,
+        'casatools_version': getattr(casatools, 'version_string', lambda: 'unknown')(),
+        'sources': sources,
+        'chunk_plan': chunk_planner.read_plan(os.path.dirname(os.path.abspath(base))),
+    }
+
+
+def convert_cube(base, output_dir=OUTPUT_DIR, fmt='zarr', layout='spectral', chunks=None,
+                 products=PRODUCTS, block_mb=512, overwrite=False):
+    """Write the products of one merged cube into a Zarr/HDF5 store; return a result dict."""
+    from casatools import image
+
+    t0 = time.time()
+    outfile = os.path.join(output_dir, os.path.basename(base) + EXTENSIONS[fmt])
+    result = {'cube': base, 'store': outfile, 'status': 'failed'}
+    products = [product for product in products if os.path.exists(f"{base}.{product}")]
+    if 'image' not in products:
+        result['error'] = f"{base}.image not found"
+        print(f"  ERROR: {result['error']}")
+        return result
+    if os.path.exists(outfile) and not overwrite:
+        print(f"  SKIP (exists): {outfile}")
+        result['status'] = 'skipped'
+        return result
+
+    tmp = f"{outfile}.tmp"
+    if os.path.isdir(tmp):
+        shutil.rmtree(tmp)
+    elif os.path.exists(tmp):
+        os.remove(tmp)
+    writer = WRITERS[fmt](tmp)
+    ia = image()
+    try:
+        attrs = {}
+        for product in products:
+            ia.open(f"{base}.{product}")
+            summary = ia.summary(list=False)
+            shape4 = [int(n) for n in summary['shape']]
+            if list(summary['axisnames'])[-1] != 'Frequency':
+                raise ValueError(f"{base}.{product}: expected frequency as the last axis")
+            nx, ny, nchan = shape4[0], shape4[1], shape4[-1]
+            shape = (nchan, ny, nx)
+            store_chunks = chunk_shape(layout, shape, chunks)
+            is_mask = product == 'mask'
+            dtype = 'u1' if is_mask else 'f4'
+            array = writer.create(product, shape, store_chunks, dtype, 0 if is_mask else np.nan)
+
+            if product == 'image':
+                attrs['wcs'] = {card[0]: card[1] for card in export_fits.fits_header_cards(ia)}
+                beams, single = export_fits.beam_table(ia, nchan, 1)
+                if beams is not None:
+                    for name, values in zip(('bmaj', 'bmin', 'bpa'), beams[:3]):
+                        writer.create(f'beams/{name}', (nchan,), (nchan,), 'f4', np.nan)[:] = values
+                    attrs['beams'] = {'units': {'bmaj': 'arcsec', 'bmin': 'arcsec', 'bpa': 'deg'},
+                                      'single': single}
+                attrs['bunit'] = summary['unit']
+
+            nregions = 0
+            for c0, c1, y0, y1, x0, x1 in write_regions(shape, store_chunks, np.dtype(dtype).itemsize, block_mb):
+                blc = [x0, y0] + [0] * (len(shape4) - 3) + [c0]
+                trc = [x1 - 1, y1 - 1] + [0] * (len(shape4) - 3) + [c1 - 1]
+                # CASA (x, y, [stokes,] chan) -> (chan, y, x), Stokes I only
+                data = ia.getchunk(blc=blc, trc=trc, dropdeg=False).reshape(x1 - x0, y1 - y0, c1 - c0).T
+                if is_mask:
+                    array[c0:c1, y0:y1, x0:x1] = data.astype('u1')
+                else:
+                    valid = ia.getchunk(blc=blc, trc=trc, dropdeg=False, getmask=True)
+                    block = data.astype('f4')
+                    block[~valid.reshape(x1 - x0, y1 - y0, c1 - c0).T] = np.nan
+                    array[c0:c1, y0:y1, x0:x1] = block
+                nregions += 1
+            ia.close()
+            print(f"  {product:9s} {nchan}x{ny}x{nx} in chunks {store_chunks}, {nregions} region(s)")
+
+        attrs.update({'axes': ['chan', 'y', 'x'], 'layout': layout if chunks is None else 'custom',
+                      'products': products, 'provenance': provenance(base, products)})
+        writer.set_attrs(attrs)
+        writer.close()
+        if os.path.isdir(outfile):
+            shutil.rmtree(outfile)
+        os.replace(tmp, outfile)
+        result['status'] = 'ok'
+
+    except Exception as e:
+        print(f"  ERROR converting {base}: {e}")
+        result['error'] = str(e)
+        writer.close()
+    finally:
+        ia.close()
+        ia.done()
+    result['wall_s'] = time.time() - t0
+    return result
+
+
+# ===========================
+# Reading (no CASA needed)
+# ===========================
+
+def open_store(path):
+    """
+    Open a store read-only; arrays are read lazily by slicing.
+
+    Returns a dict of product arrays ('image', 'residual', ..., and
+    'beams/bmaj' etc.) plus 'attrs' with the decoded metadata.
+    """
+    if path.rstrip('/').endswith('.zarr'):
+        import zarr
+        root = zarr.open_group(path, mode='r')
+        store = {name: root[name] for name in root.attrs['products']}
+        if 'beams' in root:
+            store.update({f'beams/{name}': root['beams'][name] for name in ('bmaj', 'bmin', 'bpa')})
+        store['attrs'] = dict(root.attrs)
+        return store
+    import h5py
+    fh = h5py.File(path, 'r')
+    attrs = {key: json.loads(value) if isinstance(value, str) and value[:1] in '{[' else value
+             for key, value in fh.attrs.items()}
+    store = {name: fh[name] for name in attrs['products']}
+    if 'beams' in fh:
+        store.update({f'beams/{name}': fh['beams'][name] for name in ('bmaj', 'bmin', 'bpa')})
+    store['attrs'] = attrs
+    return store
+
+
+def store_wcs(store):
+    """astropy WCS of a store (spatial + spectral axes, Stokes dropped)."""
+    from astropy.io import fits
+    from astropy.wcs import WCS
+    header = fits.Header()
+    for key, value in store['attrs']['wcs'].items():
+        header[key] = value
+    wcs = WCS(header)
+    # The cards carry no NAXIS, so find the Stokes axis (if any) by its CTYPE
+    stokes = [int(key[5:]) - 1 for key, value in header.items()
+              if key.startswith('CTYPE') and key[5:].isdigit() and str(value).upper() == 'STOKES']
+    return wcs.dropaxis(stokes[0]) if stokes else wcs
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert merged CASA cubes to chunked Zarr/HDF5 stores')
+    parser.add_argument('cubes', nargs='*', help='Merged cube names without product suffix (default: all)')
+    parser.add_argument('--format', choices=sorted(WRITERS), default='zarr')
+    parser.add_argument('--layout', choices=sorted(LAYOUTS), default='spectral')
+    parser.add_argument('--chunks', help='Explicit chunk shape C,Y,X (overrides --layout)')
+    parser.add_argument('--products', default=','.join(PRODUCTS))
+    parser.add_argument('--output-dir', default=os.path.join(casa_script.BASEDIR, OUTPUT_DIR))
+    parser.add_argument('--block-mb', type=float, default=512, help='Memory per copied region')
+    parser.add_argument('--overwrite', action='store_true')
+    args = parser.parse_args(script_args('cube_store.py') if argv is None else argv)
+
+    chunks = tuple(int(n) for n in args.chunks.split(',')) if args.chunks else None
+    if chunks is not None and len(chunks) != 3:
+        print("ERROR: --chunks needs three values C,Y,X")
+        return 1
+    try:
+        __import__({'zarr': 'zarr', 'hdf5': 'h5py'}[args.format])
+    except ImportError:
+        print(f"ERROR: --format {args.format} needs {'zarr' if args.format == 'zarr' else 'h5py'} "
+              f"(pip install {'zarr' if args.format == 'zarr' else 'h5py'})")
+        return 1
+
+    cubes = [cube[:-len('.image')] if cube.endswith('.image') else cube for cube in args.cubes] or find_cubes()
+    if not cubes:
+        print("ERROR: No merged cubes found")
+        return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    results = []
+    for base in cubes:
+        print(f"\n{base} -> {args.format} ({args.chunks or args.layout})")
+        results.append(convert_cube(base, args.output_dir, args.format, args.layout, chunks,
+                                    args.products.split(','), args.block_mb, args.overwrite))
+
+    print(f"\n{'Store':60s} {'status':8s} {'wall':>8s}")
+    for res in results:
+        print(f"{os.path.basename(res['store'])[:60]:60s} {res['status']:8s} {res.get('wall_s', 0):7.0f}s")
+    return 1 if any(res['status'] == 'failed' for res in results) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
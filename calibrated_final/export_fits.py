@@ -0,0 +1,361 @@
+#!/usr/bin/env python
+"""
+Stream merged SgrB2 cubes from CASA images to FITS, in channel blocks.
+
+A single exportfits call on a 2880x2880x3840 cube holds large parts of the
+cube in memory and is slow.  This exporter writes the FITS header first,
+pre-sized for the whole cube (astropy StreamingHDU), then reads the image
+--block-mb at a time (a block of whole channels, via ia.getchunk) and
+appends each block to the file, so memory use is one block regardless of
+the cube size.  Frequency is the last FITS axis, so the blocks land in the
+file in order.
+
+Output options (--bitpix):
+    -32  float32, masked pixels as NaN (default)
+     32  int32 with BSCALE/BZERO covering the cube's data range
+     16  int16 likewise (half the size of float32; the quantization step
+         is (max - min) / 65534 and is printed, so check it against the
+         noise before using it for faint lines)
+Integer output needs the data range first, from one ia.statistics pass.
+
+Per-channel restoring beams are written as a BEAMS binary table extension
+(BMAJ/BMIN in arcsec, BPA in deg, CHAN, POL; CASAMBM=T in the primary
+header, as exportfits does); a single-beam cube gets BMAJ/BMIN/BPA header
+keywords and a BEAMS table with the beam repeated for every channel.
+
+Cubes are exported concurrently (--workers, one process each).  Each FITS
+file is written as <name>.tmp and renamed into place when complete; cubes
+whose FITS file is newer than the image are skipped unless --overwrite.
+
+Needs casatools and astropy (modular CASA, or a monolithic CASA that
+includes astropy).
+
+Usage:
+    python export_fits.py [IMAGE ...] [--output-dir cube_fits] [--bitpix -32|32|16]
+                          [--workers N] [--block-mb MB] [--overwrite] [--list]
+
+With no IMAGE arguments, all merged cubes (oussid.SgrB2_*.cube.I.image) in
+working_chunks/*/ and cube_images/ are exported.
+
+Examples:
+    python export_fits.py --workers 4
+    python export_fits.py working_chunks/DS6_spw29/oussid.SgrB2_DS6_sci.spw29.cube.I.image --bitpix 16
+"""
+
+import os
+import re
+import sys
+import glob
+import json
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import casa_script
+from casa_script import script_args, run_script, json_result
+
+# ===========================
+# Configuration
+# ===========================
+
+BASEDIR = casa_script.BASEDIR  # calibrated_final/
+IMAGE_PATTERNS = ['working_chunks/*/oussid.SgrB2_*.cube.I.image', 'cube_images/oussid.SgrB2_*.cube.I.image']
+# The patterns also match the chunk images (...spw29.0000+032.cube.I.image)
+MERGED_RE = re.compile(r'^oussid\.SgrB2_.+_sci\.spw\d+\.cube\.I\.image$')
+OUTPUT_DIR = 'cube_fits'
+
+# Keywords the exporter sets itself
+STRUCTURAL = ('SIMPLE', 'BITPIX', 'NAXIS', 'EXTEND', 'BSCALE', 'BZERO', 'BLANK', 'END')
+
+# CASA axis names -> FITS CTYPE
+CTYPES = {
+    'Right Ascension': 'RA---SIN',
+    'Declination': 'DEC--SIN',
+    'Frequency': 'FREQ',
+    'Stokes': 'STOKES',
+}
+
+GB = 1024**3
+
+
+# ===========================
+# Header and beams
+# ===========================
+
+def _header_from_summary(ia):
+    """Minimal FITS header from the image summary and coordinate system (no ia.fitsheader)."""
+    summary = ia.summary(list=False)
+    csys = ia.coordsys()
+    cards = []
+    for axis, name in enumerate(summary['axisnames']):
+        n = axis + 1
+        refval, incr, unit = summary['refval'][axis], summary['incr'][axis], summary['axisunits'][axis]
+        if unit == 'rad':
+            refval, incr, unit = np.degrees(refval), np.degrees(incr), 'deg'
+        cards += [(f'CTYPE{n}', CTYPES.get(name, name.upper())), (f'CRVAL{n}', float(refval)),
+                  (f'CDELT{n}', float(incr)), (f'CRPIX{n}', float(summary['refpix'][axis]) + 1.),
+                  (f'CUNIT{n}', unit)]
+    cards += [('BUNIT', summary['unit']),
+              ('RADESYS', csys.referencecode('direction')[0]),
+              ('SPECSYS', {'LSRK': 'LSRK', 'TOPO': 'TOPOCENT', 'BARY': 'BARYCENT'}.get(
+                  csys.referencecode('spectral')[0], csys.referencecode('spectral')[0])),
+              ('RESTFRQ', float(csys.restfrequency()['value'][0]))]
+    csys.done()
+    return cards
+
+
+def fits_header_cards(ia):
+    """(keyword, value[, comment]) cards describing the image, without structural keywords."""
+    try:
+        header = ia.fitsheader()
+    except AttributeError:
+        return _header_from_summary(ia)
+    cards = []
+    for key, value in header.items():
+        if key.upper().startswith(STRUCTURAL) or key.upper() in ('COMMENT', 'HISTORY'):
+            continue
+        if isinstance(value, dict):
+            cards.append((key, value.get('value'), value.get('comment', '')))
+        else:
+            cards.append((key, value))
+    return cards
+
+
+def beam_table(ia, nchan, npol):
+    """
+    Restoring beams as arrays (bmaj, bmin, bpa, chan, pol) in arcsec/deg.
+
+    Returns (arrays, single) where ``single`` is True for a single-beam image
+    (its beam is then repeated for every channel).
+    """
+    from casatools import quanta
+    qa = quanta()
+    info = ia.restoringbeam()
+    rows = []
+    if 'beams' in info:
+        for chan in range(nchan):
+            for pol in range(npol):
+                beam = info['beams'][f'*{chan}'][f'*{pol}']
+                rows.append((beam, chan, pol))
+        single = False
+    elif info:
+        rows = [(info, chan, pol) for chan in range(nchan) for pol in range(npol)]
+        single = True
+    else:
+        return None, True
+    bmaj = np.array([qa.convert(b['major'], 'arcsec')['value'] for b, _, _ in rows], dtype='f4')
+    bmin = np.array([qa.convert(b['minor'], 'arcsec')['value'] for b, _, _ in rows], dtype='f4')
+    bpa = np.array([qa.convert(b.get('positionangle', b.get('pa')), 'deg')['value'] for b, _, _ in rows],
+                   dtype='f4')
+    chan = np.array([c for _, c, _ in rows], dtype='i4')
+    pol = np.array([p for _, _, p in rows], dtype='i4')
+    return (bmaj, bmin, bpa, chan, pol), single
+
+
+# ===========================
+# Export
+# ===========================
+
+def quantization(ia, bitpix):
+    """(BSCALE, BZERO, BLANK) covering the image's data range for integer output."""
+    stats = ia.statistics(robust=False, verbose=False, list=False)
+    lo, hi = float(stats['min'][0]), float(stats['max'][0])
+    nlevels = 2**bitpix - 2          # one value is reserved for BLANK
+    bscale = (hi - lo) / nlevels if hi > lo else 1.
+    bzero = (hi + lo) / 2.
+    blank = -2**(bitpix - 1)
+    return bscale, bzero, blank
+
+
+def export_cube(imagename, outfile, bitpix=-32, block_mb=512):
+    """Stream one CASA image into a FITS file; return a result dict."""
+    from astropy.io import fits
+    from casatools import image
+
+    t0 = time.time()
+    result = {'image': imagename, 'fits': outfile, 'bitpix': bitpix}
+    tmp = f"{outfile}.tmp"
+    ia = image()
+    try:
+        ia.open(imagename)
+        summary = ia.summary(list=False)
+        shape = [int(n) for n in summary['shape']]
+        names = list(summary['axisnames'])
+        if names[-1] != 'Frequency':
+            raise ValueError(f"expected frequency as the last axis, got {names}")
+        nx, ny = shape[0], shape[1]
+        nchan = shape[-1]
+        npol = shape[2] if len(shape) == 4 else 1
+        plane_bytes = nx * ny * npol * 4
+        block = max(1, int(block_mb * 2**20 // plane_bytes))
+
+        header = fits.Header()
+        header['SIMPLE'] = True
+        header['BITPIX'] = bitpix
+        header['NAXIS'] = len(shape)
+        for axis, n in enumerate(shape):
+            header[f'NAXIS{axis + 1}'] = n
+        header['EXTEND'] = True
+        if bitpix > 0:
+            bscale, bzero, blank = quantization(ia, bitpix)
+            header['BSCALE'], header['BZERO'], header['BLANK'] = bscale, bzero, blank
+            result['bscale'] = bscale
+            print(f"  {os.path.basename(imagename)}: int{bitpix}, quantization step {bscale:.3g} "
+                  f"{summary['unit']}")
+        for card in fits_header_cards(ia):
+            header[card[0]] = card[1:] if len(card) > 2 else card[1]
+
+        beams, single = beam_table(ia, nchan, npol)
+        if beams is not None:
+            if single:
+                header['BMAJ'] = float(beams[0][0]) / 3600.
+                header['BMIN'] = float(beams[1][0]) / 3600.
+                header['BPA'] = float(beams[2][0])
+            else:
+                header['CASAMBM'] = (True, 'CASA multiple beams in BEAMS table')
+        header['ORIGIN'] = 'export_fits.py'
+
+        hdu = fits.StreamingHDU(tmp, header)
+        dtype = {-32: '>f4', 32: '>i4', 16: '>i2'}[bitpix]
+        for start in range(0, nchan, block):
+            end = min(start + block, nchan) - 1
+            blc = [0] * (len(shape) - 1) + [start]
+            trc = [n - 1 for n in shape[:-1]] + [end]
+            # CASA (x, y, [stokes,] chan) Fortran order == FITS order read backwards
+            data = ia.getchunk(blc=blc, trc=trc, dropdeg=False).T
+            masked = ~ia.getchunk(blc=blc, trc=trc, dropdeg=False, getmask=True).T
+            if bitpix < 0:
+                out = data.astype(dtype)
+                out[masked] = np.nan
+            else:
+                # NaN/inf would cast to arbitrary integers; blank them with the mask
+                masked |= ~np.isfinite(data)
+                scaled = data.astype('f8')
+                scaled -= bzero
+                scaled /= bscale
+                np.clip(np.round(scaled, out=scaled), blank + 1, -blank - 1, out=scaled)
+                out = scaled.astype(dtype)
+                out[masked] = blank
+            hdu.write(out)
+        hdu.close()
+
+        if beams is not None:
+            columns = [fits.Column(name='BMAJ', format='1E', unit='arcsec', array=beams[0]),
+                       fits.Column(name='BMIN', format='1E', unit='arcsec', array=beams[1]),
+                       fits.Column(name='BPA', format='1E', unit='deg', array=beams[2]),
+                       fits.Column(name='CHAN', format='1J', array=beams[3]),
+                       fits.Column(name='POL', format='1J', array=beams[4])]
+            table = fits.BinTableHDU.from_columns(columns, name='BEAMS')
+            table.header['NCHAN'] = nchan
+            table.header['NPOL'] = npol
+            table.header['EXTVER'] = 1
+            fits.append(tmp, table.data, table.header)
+        os.replace(tmp, outfile)
+        result.update(status='ok', shape=shape, block_chans=block, bytes=os.path.getsize(outfile))
+
+    except Exception as e:
+        print(f"  ERROR exporting {imagename}: {e}")
+        result.update(status='failed', error=str(e))
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    finally:
+        ia.close()
+        ia.done()
+    result['wall_s'] = time.time() - t0
+    return result
+
+
+def output_name(imagename, output_dir):
+    return os.path.join(output_dir, os.path.basename(imagename.rstrip('/')) + '.fits')
+
+
+def up_to_date(imagename, outfile):
+    """True if the FITS file is newer than every table file of the image."""
+    if not os.path.exists(outfile):
+        return False
+    image_mtime = max(os.path.getmtime(os.path.join(imagename, name)) for name in os.listdir(imagename)
+                      if name != 'table.lock')
+    return os.path.getmtime(outfile) > image_mtime
+
+
+def run_worker(imagename, outfile, bitpix, block_mb):
+    """Export one cube in a separate process; return its result dict."""
+    proc = run_script('export_fits.py', [imagename, '--export-one', outfile, '--bitpix', bitpix,
+                                         '--block-mb', block_mb])
+    result = json_result(proc)
+    if result is None:
+        return {'image': imagename, 'fits': outfile, 'status': 'failed', 'wall_s': 0,
+                'error': f'worker exited with {proc.returncode}'}
+    return result
+
+
+def find_merged_images(basedir=BASEDIR):
+    """Merged cubes in working_chunks/ and cube_images/ (not the chunk images)."""
+    return sorted(path for pattern in IMAGE_PATTERNS for path in glob.glob(os.path.join(basedir, pattern))
+                  if MERGED_RE.match(os.path.basename(path)))
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Stream merged CASA cubes to FITS in channel blocks')
+    parser.add_argument('images', nargs='*', help='CASA images (default: all merged cubes)')
+    parser.add_argument('--output-dir', default=os.path.join(BASEDIR, OUTPUT_DIR))
+    parser.add_argument('--bitpix', type=int, default=-32, choices=[-32, 32, 16])
+    parser.add_argument('--block-mb', type=float, default=512, help='Memory per channel block')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('SLURM_CPUS_PER_TASK', '1')),
+                        help='Cubes to export concurrently')
+    parser.add_argument('--overwrite', action='store_true', help='Re-export up-to-date FITS files')
+    parser.add_argument('--list', action='store_true', help='Only list what would be exported')
+    parser.add_argument('--export-one', metavar='FITS', help=argparse.SUPPRESS)
+    args = parser.parse_args(script_args('export_fits.py') if argv is None else argv)
+
+    if args.export_one:
+        # Worker mode: the result is the last line of output
+        result = export_cube(args.images[0], args.export_one, args.bitpix, args.block_mb)
+        print(json.dumps(result))
+        return 0 if result['status'] == 'ok' else 1
+
+    images = args.images or find_merged_images()
+    if not images:
+        print("ERROR: No merged cubes found")
+        return 1
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    todo = []
+    for imagename in images:
+        outfile = output_name(imagename, args.output_dir)
+        current = not args.overwrite and up_to_date(imagename, outfile)
+        print(f"  {'SKIP (up to date)' if current else 'EXPORT':17s} {imagename} -> {outfile}")
+        if not current:
+            todo.append((imagename, outfile))
+    if args.list or not todo:
+        return 0
+
+    print(f"\nExporting {len(todo)} cube(s) as BITPIX={args.bitpix}, {args.workers} worker(s), "
+          f"{args.block_mb:.0f} MB channel blocks")
+    t0 = time.time()
+    if args.workers <= 1:
+        results = [export_cube(imagename, outfile, args.bitpix, args.block_mb) for imagename, outfile in todo]
+    else:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(lambda item: run_worker(item[0], item[1], args.bitpix, args.block_mb),
+                                    todo))
+
+    print(f"\n{'FITS':60s} {'status':7s} {'wall':>8s} {'GB':>7s} {'MB/s':>7s}")
+    for res in results:
+        size = res.get('bytes', 0)
+        rate = size / 2**20 / res['wall_s'] if res['wall_s'] > 0 else 0
+        print(f"{os.path.basename(res['fits'])[:60]:60s} {res['status']:7s} {res['wall_s']:7.0f}s "
+              f"{size / GB:7.1f} {rate:7.1f}")
+    failed = sum(1 for res in results if res['status'] != 'ok')
+    print(f"\n{len(results) - failed} exported, {failed} failed, wall time {time.time() - t0:.0f}s")
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
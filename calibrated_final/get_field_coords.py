@@ -1,26 +1,23 @@
 #!/usr/bin/env python
-"""Quick script to get field coordinates from measurement sets"""
+"""Quick script to get field coordinates from measurement sets
 
-import sys
-sys.path.append('/orange/adamginsburg/casa/casa-6.6.5-17-pipeline-2024.1.0.8/lib/py/lib/python3.8/site-packages/')
+Reads the MS catalog (ms_catalog.py), scanning the MS only if it is not
+catalogued yet.
 
-from casatools import msmetadata
+Usage:
+    python get_field_coords.py [MS]
+"""
 
-msmd = msmetadata()
+import sys
 
-# Get one of the measurement sets
-ms = 'measurement_sets/uid___A002_X12c4b14_X77b0_targets_line.ms'
-msmd.open(ms)
+import ms_catalog
 
-# Get all fields
-field_names = msmd.fieldnames()
-field_ids = range(len(field_names))
+# Get one of the measurement sets
+ms = sys.argv[1] if len(sys.argv) > 1 else 'measurement_sets/uid___A002_X12c4b14_X77b0_targets_line.ms'
+entry = ms_catalog.get_entry(ms)
 
 print("Fields and their phase centers:")
-for fid, fname in zip(field_ids, field_names):
-    direction = msmd.phasecenter(fid)
-    print(f"Field {fid}: {fname}")
-    print(f"  Direction: {direction}")
+for fname, info in entry['fields'].items():
+    print(f"Field {info['id']}: {fname}")
+    print(f"  Direction: {ms_catalog.phasecenter(ms, fname)}")
     print()
-
-msmd.close()
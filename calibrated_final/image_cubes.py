@@ -7,16 +7,29 @@ This script images each target source (DS1-5, DS6, DS7-8, DS9) in each
 spectral window (23, 25, 27, 29) using CASA's tclean.
 
 Usage:
-    casa -c image_cubes.py <cube_id>
+    casa -c image_cubes.py [--quicklook] <cube_id>
     
 Where cube_id is an integer from 0 to 15 identifying which cube to image.
+
+With --quicklook (or QUICKLOOK=1) a binned, coarse-cell, dirty preview of
+the cube is made instead (see quicklook.py): <imagename> gets a ".ql" infix
+and goes to cube_images/quicklook/.
+
+With NOISE_NSIGMA=N the clean threshold is N times the median RMS measured
+on an earlier residual of the cube (noise_estimator.py) instead of THRESHOLD.
+
+Before imaging, the cube's disk footprint is checked against MAXCUBELIMIT
+and the free space in cube_images/ (cube_footprint.py).
+
+Under mpicasa (submit_cube_jobs.sh with USE_MPI=1) tclean runs
+channel-parallel with parallel=True; see casa_mpi.py.  The tclean wall
+time (and per-rank timing under MPI) is written to <imagename>.timing.json.
 """
 
 import sys
 import os
 import glob
-from astropy.coordinates import SkyCoord
-import astropy.units as u
+import time
 
 # ===========================
 # CONFIGURATION
@@ -74,12 +87,13 @@ OUTFRAME = 'LSRK'
 PBLIMIT = 0.2
 DECONVOLVER = 'hogbom'
 NITER = 1000 
-THRESHOLD = '1.5mJy' # expected RMS ~ 800uJy/beam
+THRESHOLD = '1.5mJy' # expected RMS ~ 800uJy/beam; NOISE_NSIGMA=N uses N x measured RMS
 PERCHANWEIGHTDENSITY = True
 GRIDDER = 'standard'
 NTERMS = 2  # For MFS images; set to 1 for cube
 
-# Mitigation parameters
+# Mitigation parameters (size of a single image cube, see cube_footprint.py):
+# warn above MAXCUBESIZE, refuse to image above MAXCUBELIMIT
 MAXCUBESIZE = 1040.  # GB
 MAXCUBELIMIT = 1060.  # GB
 
@@ -109,43 +123,50 @@ def get_cube_config(cube_id):
 def get_phasecenter(ms_list, field):
     """
     Extract phase center from measurement set for a given field.
-    Uses astropy for proper coordinate conversion.
+    Read from the MS catalog (ms_catalog.py), which scans the MS only if it
+    is not catalogued yet.
     """
-    from casatools import msmetadata
-    msmd = msmetadata()
-    
-    # Open first MS and get phase center
-    msmd.open(ms_list[0])
-    field_ids = msmd.fieldsforname(field)
-    if len(field_ids) == 0:
-        msmd.close()
-        raise ValueError(f"Field {field} not found in {ms_list[0]}")
-    
-    direction = msmd.phasecenter(field_ids[0])
-    msmd.close()
-    
-    # Convert to ICRS string format using astropy
-    # CASA returns radians
-    ra_rad = direction['m0']['value']
-    dec_rad = direction['m1']['value']
-    
-    # Create SkyCoord object from radians
-    coord = SkyCoord(ra=ra_rad*u.rad, dec=dec_rad*u.rad, frame='icrs')
-    
-    # Format as CASA-compatible string
-    # CASA format: "ICRS HH:MM:SS.SSSS +DD.MM.SS.SSS"
-    ra_str = coord.ra.to_string(unit=u.hour, sep=':', precision=4, pad=True)
-    dec_str = coord.dec.to_string(unit=u.deg, sep='.', precision=3, 
-                                   alwayssign=True, pad=True)
+    import ms_catalog
+    return ms_catalog.phasecenter(ms_list[0], field)
+
+
+def check_footprint(source, spw, output_dir, imsize=IMSIZE, chan_bin=1):
+    """
+    Refuse to image a cube that exceeds MAXCUBELIMIT or does not fit on disk.
+
+    Set SKIP_FOOTPRINT_CHECK=1 to only print the footprint.
+    """
+    from cube_footprint import cube_footprint, print_footprint, free_bytes, allocated_mem_gb, GB
+    fp = cube_footprint(source, spw, imsize=imsize, chan_bin=chan_bin)
+    free = free_bytes(f"../{output_dir}")
+    print_footprint(fp, free)
+    cube_gb = fp['products']['.model'] / GB
     
-    phasecenter = f"ICRS {ra_str} {dec_str}"
+    problems = []
+    if cube_gb > MAXCUBELIMIT:
+        problems.append(f"cube size {cube_gb:.0f} GB exceeds MAXCUBELIMIT={MAXCUBELIMIT:.0f} GB;"
+                        " use chunked_imaging/ instead")
+    elif cube_gb > MAXCUBESIZE:
+        print(f"WARNING: cube size {cube_gb:.0f} GB exceeds MAXCUBESIZE={MAXCUBESIZE:.0f} GB")
+    if free < fp['peak_disk_bytes']:
+        problems.append(f"needs {fp['peak_disk_bytes'] / GB:.0f} GB on disk, only {free / GB:.0f} GB free")
+    mem_gb = allocated_mem_gb()
+    if mem_gb is not None and mem_gb < fp['memory_gb']:
+        # tclean partitions a cube internally when memory is short, so this
+        # only slows the job down
+        print(f"WARNING: predicted tclean memory {fp['memory_gb']:.0f} GB exceeds the "
+              f"{mem_gb:.0f} GB allocation; tclean will process the cube in more pieces")
     
-    return phasecenter
+    if problems and os.getenv('SKIP_FOOTPRINT_CHECK', '0') != '1':
+        for problem in problems:
+            print(f"ERROR: {problem}")
+        sys.exit(1)
 
 
-def run_imaging(source, spw, output_dir='cube_images'):
+def run_imaging(source, spw, output_dir='cube_images', quicklook=False):
     """
-    Run tclean to create a spectral cube for the given source and spw.
+    Run tclean to create a spectral cube for the given source and spw
+    (a quick-look preview if quicklook is True).
     """
     print("="*80)
     print(f"IMAGING: Source={source}, SPW={spw}")
@@ -167,11 +188,13 @@ def run_imaging(source, spw, output_dir='cube_images'):
         vis_list = temp_vis_list
         # uvcontsub output has continuum-subtracted data in DATA column
         datacolumn = 'data'
-        # temp_line files are already filtered by SPW, so don't specify spw again
-        spw_selection = ''
+        # temp_line files keep the original SPW IDs, and with
+        # run_uvcontsub.py --multi-spw they are links to one MS holding
+        # every SPW, so select the SPW explicitly
+        spw_selection = spw
         print(f"Found {len(vis_list)} field/SPW-specific measurement sets in temp_line/")
         print(f"Using DATA column (uvcontsub output)")
-        print(f"SPW selection: '' (pre-filtered by uvcontsub)")
+        print(f"SPW selection: {spw}")
     elif len(all_vis_list) > 0:
         # Use consolidated files (tclean will filter)
         vis_list = all_vis_list
@@ -214,21 +237,41 @@ def run_imaging(source, spw, output_dir='cube_images'):
     # Output image name
     imagename = f"oussid.SgrB2_{source}_sci.spw{spw}.cube.I"
     
+    tclean_args = {'imsize': IMSIZE, 'cell': CELL, 'niter': NITER, 'threshold': THRESHOLD,
+                   'usemask': 'auto-multithresh'}
+    import noise_estimator
+    tclean_args['threshold'] = noise_estimator.clean_threshold(source, spw, default=THRESHOLD)
+    if quicklook:
+        import quicklook as ql
+        print(ql.describe())
+        start, width, nchan = ql.binned_axis(start, width, nchan)
+        tclean_args.update(ql.tclean_overrides())
+        imagename = f"oussid.SgrB2_{source}_sci.spw{spw}.ql.cube.I"
+    
+    check_footprint(source, spw, output_dir, imsize=tclean_args['imsize'],
+                    chan_bin=ql.chan_bin() if quicklook else 1)
+    
     print(f"\nImaging parameters:")
     print(f"  imagename: {imagename}")
     print(f"  field: {source}")
     print(f"  spw: {spw}")
     print(f"  phasecenter: {phasecenter}")
-    print(f"  imsize: {IMSIZE}")
-    print(f"  cell: {CELL}")
+    print(f"  imsize: {tclean_args['imsize']}")
+    print(f"  cell: {tclean_args['cell']}")
     print(f"  nchan: {nchan}")
     print(f"  start: {start}")
     print(f"  width: {width}")
     print(f"  robust: {ROBUST}")
-    print(f"  niter: {NITER}")
+    print(f"  niter: {tclean_args['niter']}")
+    
+    # Channel-parallel imaging when running under mpicasa
+    from casa_mpi import tclean_parallel, mpi_world_size, write_timing
+    parallel = tclean_parallel()
+    print(f"  parallel: {parallel} ({mpi_world_size()} MPI processes)")
     print()
     
     # Run tclean to create spectral cube
+    t_start = time.time()
     tclean(
         vis=vis_list,
         field=source,
@@ -236,8 +279,8 @@ def run_imaging(source, spw, output_dir='cube_images'):
         intent='OBSERVE_TARGET#ON_SOURCE',
         datacolumn=datacolumn,
         imagename=imagename,
-        imsize=IMSIZE,
-        cell=CELL,
+        imsize=tclean_args['imsize'],
+        cell=tclean_args['cell'],
         phasecenter=phasecenter,
         stokes='I',
         specmode='cube',
@@ -257,12 +300,12 @@ def run_imaging(source, spw, output_dir='cube_images'):
         weighting=WEIGHTING,
         robust=ROBUST,
         npixels=0,
-        niter=NITER,
-        threshold=THRESHOLD,
+        niter=tclean_args['niter'],
+        threshold=tclean_args['threshold'],
         nsigma=0.0,
         interactive=False,
         fullsummary=False,
-        usemask='auto-multithresh',
+        usemask=tclean_args['usemask'],
         sidelobethreshold=2.5,
         noisethreshold=5.0,
         lownoisethreshold=1.5,
@@ -272,8 +315,11 @@ def run_imaging(source, spw, output_dir='cube_images'):
         restart=True,
         calcres=True,
         calcpsf=True,
-        parallel=False,
+        parallel=parallel,
     )
+    write_timing(f"{imagename}.timing.json", imagename, t_start, time.time(),
+                 logfile=casalog.logfile(), parallel=parallel, source=source, spw=spw,
+                 quicklook=quicklook)
     
     # Move images to output directory
     print(f"\nMoving images to {output_dir}/")
@@ -291,7 +337,7 @@ if __name__ == '__main__':
     # Get cube ID from command line
     if len(sys.argv) < 2:
         print("ERROR: cube_id not provided")
-        print("Usage: casa -c image_cubes.py <cube_id>")
+        print("Usage: casa -c image_cubes.py [--quicklook] <cube_id>")
         print()
         print("Available cube IDs:")
         cube_id = 0
@@ -306,13 +352,22 @@ if __name__ == '__main__':
     # Get configuration for this cube
     source, spw = get_cube_config(cube_id)
     
+    # Helper modules (casa_mpi.py) live in calibrated_final/, the directory
+    # this script is run from
+    if os.getcwd() not in sys.path:
+        sys.path.insert(0, os.getcwd())
+    
     # Change to working directory
     if not os.path.exists('working_cubes'):
         os.makedirs('working_cubes')
     os.chdir('working_cubes')
     
     # Run imaging
-    run_imaging(source, spw, output_dir='cube_images')
+    import quicklook
+    if quicklook.enabled(sys.argv):
+        run_imaging(source, spw, output_dir=f'cube_images/{quicklook.SUBDIR}', quicklook=True)
+    else:
+        run_imaging(source, spw, output_dir='cube_images')
     
     # Move back
     os.chdir('..')
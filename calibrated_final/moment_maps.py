@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+"""
+Moment maps of the SgrB2 cubes, computed tile by tile in a process pool.
+
+immoments on a 2880x2880x3840 cube reads the whole cube serially.  This
+splits the field into spatial tiles (--tile pixels square), reads only the
+channels inside the requested velocity windows for one tile at a time, and
+spreads the tiles over --workers processes.  Per window it computes
+
+    mom0   - integrated intensity          sum(I dv)            Jy/beam km/s
+    mom1   - intensity-weighted velocity    sum(I v) / sum(I)    km/s
+    mom2   - velocity dispersion            sqrt(sum(I (v - mom1)^2) / sum(I))
+    peak   - peak intensity                 max(I)               Jy/beam
+    vpeak  - velocity of the peak                                km/s
+
+Moments 0-2 only use channels brighter than --clip times the noise.  The
+noise is --rms (Jy/beam) if given, the per-channel RMS of a noise spectrum
+(--noise-spectrum, from noise_estimator.py), or otherwise a robust
+per-pixel estimate (1.4826 x the median absolute deviation of the pixel's
+spectrum over the channels read).  Velocities use the radio convention relative to
+--restfreq (default: the cube's rest frequency).
+
+Inputs (all on the same spatial grid):
+    a merged cube                 working_chunks/DS6_spw29/oussid.SgrB2_DS6_sci.spw29.cube.I.image
+    chunk images before merge     working_chunks/DS6_spw29/oussid.SgrB2_DS6_sci.spw29.*+*.cube.I.image
+                                  (concatenated in channel order)
+    a cube store (cube_store.py)  cube_store/oussid.SgrB2_DS6_sci.spw29.cube.I.zarr (no CASA needed;
+                                  use --layout spectral for the fastest tile reads)
+
+Each worker is a fresh interpreter running this file (as in
+chunked_imaging/chunk_restore.py) and writes its tiles into shared .npy
+memory maps, so the main process never holds a cube tile.  The maps are
+written as FITS images (2D, with the cube's celestial WCS and the largest
+channel beam) named <output-dir>/<cube>.<window>.<moment>.fits.
+
+Needs astropy, plus casatools for CASA image inputs.
+
+Usage:
+    python moment_maps.py INPUT [INPUT ...] [--window VMIN,VMAX ...] [--restfreq GHZ]
+                          [--clip N] [--rms JY | --noise-spectrum JSON] [--tile PIX] [--workers N]
+                          [--output-dir DIR]
+
+Examples:
+    python moment_maps.py working_chunks/DS6_spw27/oussid.SgrB2_DS6_sci.spw27.cube.I.image \\
+        --restfreq 146.618697 --window 40,90 --workers 8
+    python moment_maps.py cube_store/oussid.SgrB2_DS9_sci.spw23.cube.I.zarr --window -20,120 --window 55,75
+    python moment_maps.py cube_store/oussid.SgrB2_DS6_sci.spw29.cube.I.zarr --noise-spectrum noise_spectra/DS6_spw29.noise.json
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import warnings
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import casa_script
+from casa_script import script_args, run_script
+
+# ===========================
+# Configuration
+# ===========================
+
+OUTPUT_DIR = 'moment_maps'
+MOMENTS = ['mom0', 'mom1', 'mom2', 'peak', 'vpeak']
+UNITS = {'mom0': 'Jy/beam.km/s', 'mom1': 'km/s', 'mom2': 'km/s', 'peak': 'Jy/beam', 'vpeak': 'km/s'}
+
+C_KMS = 299792.458
+
+
+# ===========================
+# Cube readers
+# ===========================
+
+def summary_beam(bmaj, bmin, bpa):
+    """One beam (arcsec, arcsec, deg) for 2D maps: the largest channel beam axes."""
+    return float(np.nanmax(bmaj)), float(np.nanmax(bmin)), float(np.nanmedian(bpa))
+
+
+class CasaCube:
+    """One merged CASA image, or chunk images concatenated along frequency."""
+
+    def __init__(self, paths):
+        from casatools import image
+        self.paths = list(paths)
+        self.ia = image()
+        import export_fits
+        freqs, self.nchans, beams = [], [], []
+        for path in self.paths:
+            self.ia.open(path)
+            summary = self.ia.summary(list=False)
+            if list(summary['axisnames'])[-1] != 'Frequency':
+                raise ValueError(f"{path}: expected frequency as the last axis")
+            if not freqs:
+                self.header = {card[0]: card[1] for card in export_fits.fits_header_cards(self.ia)}
+                self.nx, self.ny = int(summary['shape'][0]), int(summary['shape'][1])
+                self.ndim = len(summary['shape'])
+            nchan = int(summary['shape'][-1])
+            beams.append(export_fits.beam_table(self.ia, nchan, 1)[0])
+            refval, refpix, incr = (summary[key][-1] for key in ('refval', 'refpix', 'incr'))
+            freqs.append(refval + (np.arange(nchan) - refpix) * incr)
+            self.nchans.append(nchan)
+            self.ia.close()
+        self.freqs = np.concatenate(freqs)
+        self.offsets = np.cumsum([0] + self.nchans[:-1]).tolist()
+        self.beam = summary_beam(*(np.concatenate([b[i] for b in beams]) for i in range(3))) \
+            if all(b is not None for b in beams) else None
+        self._open = None
+
+    def read(self, c0, c1, y0, y1, x0, x1):
+        """(chan, y, x) float32 block for channels [c0, c1), masked pixels NaN."""
+        planes = []
+        for path, offset, nchan in zip(self.paths, self.offsets, self.nchans):
+            lo, hi = max(c0, offset), min(c1, offset + nchan)
+            if lo >= hi:
+                continue
+            if self._open != path:
+                if self._open is not None:
+                    self.ia.close()
+                self.ia.open(path)
+                self._open = path
+            blc = [x0, y0] + [0] * (self.ndim - 3) + [lo - offset]
+            trc = [x1 - 1, y1 - 1] + [0] * (self.ndim - 3) + [hi - 1 - offset]
+            shape = (x1 - x0, y1 - y0, hi - lo)
+            data = self.ia.getchunk(blc=blc, trc=trc, dropdeg=False).reshape(shape).T.astype('f4')
+            valid = self.ia.getchunk(blc=blc, trc=trc, dropdeg=False, getmask=True).reshape(shape).T
+            data[~valid] = np.nan
+            planes.append(data)
+        return np.concatenate(planes, axis=0)
+
+    def close(self):
+        if self._open is not None:
+            self.ia.close()
+        self.ia.done()
+
+
+class StoreCube:
+    """A Zarr/HDF5 store written by cube_store.py."""
+
+    def __init__(self, path):
+        import cube_store
+        self.store = cube_store.open_store(path)
+        self.header = self.store['attrs']['wcs']
+        nchan, self.ny, self.nx = self.store['image'].shape
+        axis = next(n for n in range(1, 5) if str(self.header.get(f'CTYPE{n}', '')).startswith('FREQ'))
+        refval, refpix, incr = (float(self.header[f'{key}{axis}']) for key in ('CRVAL', 'CRPIX', 'CDELT'))
+        self.freqs = refval + (np.arange(nchan) + 1 - refpix) * incr
+        self.beam = None
+        if 'beams/bmaj' in self.store:
+            self.beam = summary_beam(*(self.store[f'beams/{name}'][:] for name in ('bmaj', 'bmin', 'bpa')))
+
+    def read(self, c0, c1, y0, y1, x0, x1):
+        return np.asarray(self.store['image'][c0:c1, y0:y1, x0:x1], dtype='f4')
+
+    def close(self):
+        pass
+
+
+def open_cube(inputs):
+    if len(inputs) == 1 and inputs[0].rstrip('/').endswith(('.zarr', '.h5')):
+        return StoreCube(inputs[0])
+    return CasaCube(sorted(inputs))
+
+
+# ===========================
+# Moments
+# ===========================
+
+def velocities(freqs, restfreq):
+    """Radio velocities (km/s) of the channel frequencies (Hz)."""
+    return C_KMS * (1. - freqs / restfreq)
+
+
+def window_channels(vel, windows):
+    """[(i0, i1)] channel ranges (end exclusive) inside each (vmin, vmax) window."""
+    ranges = []
+    for vmin, vmax in windows:
+        inside = np.flatnonzero((vel >= vmin) & (vel <= vmax))
+        if inside.size == 0:
+            raise ValueError(f"Window {vmin},{vmax} km/s is outside the cube "
+                             f"({vel.min():.1f} to {vel.max():.1f} km/s)")
+        ranges.append((int(inside[0]), int(inside[-1]) + 1))
+    return ranges
+
+
+def robust_rms(spec):
+    """Per-pixel noise of a (chan, y, x) block: 1.4826 x MAD along the spectral axis."""
+    with warnings.catch_warnings():
+        # Fully masked pixels (outside the pb limit) give NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        med = np.nanmedian(spec, axis=0)
+        return 1.4826 * np.nanmedian(np.abs(spec - med), axis=0)
+
+
+def tile_moments(spec, vel, dv, clip, rms=None):
+    """
+    Moment maps of one (chan, y, x) block over all its channels.
+
+    ``rms`` is a scalar or anything broadcastable to (y, x) or (chan, y, x);
+    None estimates it per pixel with robust_rms.
+    """
+    if rms is None:
+        rms = robust_rms(spec)
+    v = vel[:, None, None]
+    finite = np.isfinite(spec)
+    allnan = ~finite.any(axis=0)
+
+    weight = np.where(finite & (spec > clip * rms), spec, 0.)
+    total = weight.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mom1 = (weight * v).sum(axis=0) / total
+        mom2 = np.sqrt((weight * (v - mom1)**2).sum(axis=0) / total)
+    mom0 = total * dv
+    mom1[total <= 0] = np.nan
+    mom2[total <= 0] = np.nan
+
+    filled = np.where(finite, spec, -np.inf)
+    ipeak = filled.argmax(axis=0)
+    peak = np.take_along_axis(filled, ipeak[None], axis=0)[0]
+    vpeak = vel[ipeak]
+    for plane in (mom0, peak, vpeak):
+        plane[allnan] = np.nan
+    return {'mom0': mom0, 'mom1': mom1, 'mom2': mom2, 'peak': peak, 'vpeak': vpeak}
+
+
+def plan_tiles(ny, nx, tile):
+    return [(y0, min(y0 + tile, ny), x0, min(x0 + tile, nx))
+            for y0 in range(0, ny, tile) for x0 in range(0, nx, tile)]
+
+
+def map_path(workdir, iwin, moment):
+    return os.path.join(workdir, f'w{iwin}.{moment}.npy')
+
+
+def run_tiles(spec):
+    """Worker: compute the moments of ``spec['tiles']`` into the shared memory maps."""
+    cube = open_cube(spec['inputs'])
+    vel = np.array(spec['vel'])
+    c0, c1 = spec['read']
+    maps = {(iwin, moment): np.load(map_path(spec['workdir'], iwin, moment), mmap_mode='r+')
+            for iwin in range(len(spec['ranges'])) for moment in MOMENTS}
+    # A noise spectrum is one RMS per cube channel
+    chan_rms = np.array(spec['rms'], dtype='f4')[:, None, None] if isinstance(spec['rms'], list) else None
+    for y0, y1, x0, x1 in spec['tiles']:
+        block = cube.read(c0, c1, y0, y1, x0, x1)
+        rms = spec['rms'] if spec['rms'] is not None else robust_rms(block)
+        for iwin, (i0, i1) in enumerate(spec['ranges']):
+            result = tile_moments(block[i0 - c0:i1 - c0], vel[i0:i1], spec['dv'], spec['clip'],
+                                  chan_rms[i0:i1] if chan_rms is not None else rms)
+            for moment, plane in result.items():
+                maps[(iwin, moment)][y0:y1, x0:x1] = plane
+    for mmap in maps.values():
+        mmap.flush()
+    cube.close()
+    return len(spec['tiles'])
+
+
+def run_worker(spec, index):
+    """Run one worker in a fresh interpreter; return the number of tiles done."""
+    # The spec (velocities, noise spectrum, tiles) can exceed the argv limit
+    spec_path = os.path.join(spec['workdir'], f'worker{index}.json')
+    with open(spec_path, 'w') as fh:
+        json.dump(spec, fh)
+    proc = run_script('moment_maps.py', ['--worker', spec_path])
+    if proc.returncode != 0:
+        raise RuntimeError(f"Moment worker failed (exit {proc.returncode}):\n{proc.stdout[-2000:]}")
+    return len(spec['tiles'])
+
+
+# ===========================
+# Output
+# ===========================
+
+def map_header(cube, moment, window, restfreq, clip, noise):
+    """2D FITS header: the cube's celestial axes, beam and the moment's window."""
+    from astropy.io import fits
+    header = fits.Header()
+    for key, value in cube.header.items():
+        # Keep the celestial axes (1, 2) and axis-independent keywords
+        axes = re.findall(r'\d+', key)
+        if all(axis in ('1', '2') for axis in axes):
+            header[key] = value
+    for key in ('BMAJ', 'BMIN', 'BPA', 'CASAMBM'):
+        header.remove(key, ignore_missing=True)
+    if cube.beam is not None:
+        header['BMAJ'] = (cube.beam[0] / 3600., 'largest channel beam')
+        header['BMIN'] = (cube.beam[1] / 3600., 'largest channel beam')
+        header['BPA'] = cube.beam[2]
+    header['BUNIT'] = UNITS[moment]
+    header['BTYPE'] = moment
+    header['VMIN'] = (window[0], 'km/s, radio, start of the moment window')
+    header['VMAX'] = (window[1], 'km/s, radio, end of the moment window')
+    header['RESTFRQ'] = restfreq
+    header['MOMCLIP'] = (clip, 'noise clip for moments 0-2')
+    header['MOMRMS'] = (noise, 'noise used for clipping')
+    header['ORIGIN'] = 'moment_maps.py'
+    return header
+
+
+def window_label(window):
+    return f"v{window[0]:g}_{window[1]:g}"
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def parse_window(text):
+    vmin, vmax = (float(v) for v in text.split(','))
+    return (min(vmin, vmax), max(vmin, vmax))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tiled, multi-process moment maps of SgrB2 cubes')
+    parser.add_argument('inputs', nargs='*', help='Merged cube, chunk images, or a cube store')
+    parser.add_argument('--window', action='append', type=parse_window, metavar='VMIN,VMAX',
+                        help='Velocity window in km/s (repeatable; default: the whole cube)')
+    parser.add_argument('--restfreq', type=float, help='Rest frequency in GHz (default: from the header)')
+    parser.add_argument('--clip', type=float, default=3., help='Noise clip for moments 0-2')
+    noise = parser.add_mutually_exclusive_group()
+    noise.add_argument('--rms', type=float, help='Noise in Jy/beam (default: per-pixel MAD)')
+    noise.add_argument('--noise-spectrum', metavar='JSON',
+                       help='Per-channel noise from noise_estimator.py (noise_spectra/<field>_spw<spw>.noise.json)')
+    parser.add_argument('--tile', type=int, default=128, help='Tile size in pixels')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('SLURM_CPUS_PER_TASK', '1')))
+    parser.add_argument('--output-dir', default=os.path.join(casa_script.BASEDIR, OUTPUT_DIR))
+    parser.add_argument('--worker', help=argparse.SUPPRESS)
+    args = parser.parse_args(script_args('moment_maps.py') if argv is None else argv)
+
+    if args.worker:
+        with open(args.worker) as fh:
+            run_tiles(json.load(fh))
+        return 0
+    if not args.inputs:
+        parser.error("need a merged cube, chunk images or a cube store")
+
+    from astropy.io import fits
+    t0 = time.time()
+    cube = open_cube(args.inputs)
+    restfreq = args.restfreq * 1e9 if args.restfreq else float(cube.header.get('RESTFRQ') or 0)
+    if not restfreq:
+        print("ERROR: The cube has no rest frequency; pass --restfreq")
+        return 1
+    vel = velocities(cube.freqs, restfreq)
+    dv = float(np.abs(np.median(np.diff(vel)))) if len(vel) > 1 else 1.
+    windows = args.window or [(float(vel.min()), float(vel.max()))]
+    ranges = window_channels(vel, windows)
+    read = (min(i0 for i0, _ in ranges), max(i1 for _, i1 in ranges))
+    tiles = plan_tiles(cube.ny, cube.nx, args.tile)
+    workers = max(1, min(args.workers, len(tiles)))
+    name = os.path.basename(args.inputs[0].rstrip('/'))
+    for suffix in ('.image', '.zarr', '.h5'):
+        name = name[:-len(suffix)] if name.endswith(suffix) else name
+    if len(args.inputs) > 1:
+        # oussid.SgrB2_DS6_sci.spw29.0000+032.cube.I -> oussid.SgrB2_DS6_sci.spw29.chunks
+        name = '.'.join(name.split('.')[:3]) + '.chunks'
+
+    print(f"Moment maps of {len(args.inputs)} input(s): {cube.nx}x{cube.ny}x{len(vel)}, "
+          f"rest frequency {restfreq / 1e9:.6f} GHz, dv={dv:.3f} km/s")
+    for window, (i0, i1) in zip(windows, ranges):
+        print(f"  window {window[0]:g} to {window[1]:g} km/s: channels {i0}-{i1 - 1}")
+    rms, noise = args.rms, args.rms if args.rms else 'MAD per pixel'
+    if args.noise_spectrum:
+        import noise_estimator
+        with open(args.noise_spectrum) as fh:
+            rms = noise_estimator.rms_at(json.load(fh), cube.freqs).tolist()
+        noise = os.path.basename(args.noise_spectrum)
+    print(f"  reading channels {read[0]}-{read[1] - 1}, {len(tiles)} tiles of {args.tile} px, "
+          f"{workers} worker(s); clip {args.clip} x {noise}")
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    workdir = os.path.join(args.output_dir, f'.{name}.tmp')
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    for iwin in range(len(windows)):
+        for moment in MOMENTS:
+            np.lib.format.open_memmap(map_path(workdir, iwin, moment), mode='w+', dtype='f4',
+                                      shape=(cube.ny, cube.nx))[:] = np.nan
+
+    spec = {'inputs': args.inputs, 'vel': vel.tolist(), 'dv': dv, 'ranges': ranges, 'read': read,
+            'clip': args.clip, 'rms': rms, 'workdir': workdir}
+    if workers == 1:
+        cube.close()
+        run_tiles(dict(spec, tiles=tiles))
+    else:
+        cube.close()
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            done = sum(pool.map(run_worker, [dict(spec, tiles=tiles[ii::workers]) for ii in range(workers)],
+                                range(workers)))
+        print(f"  {done} tiles done")
+
+    for iwin, window in enumerate(windows):
+        for moment in MOMENTS:
+            outfile = os.path.join(args.output_dir, f"{name}.{window_label(window)}.{moment}.fits")
+            data = np.load(map_path(workdir, iwin, moment))
+            fits.PrimaryHDU(data, map_header(cube, moment, window, restfreq, args.clip, noise)).writeto(
+                f"{outfile}.tmp", overwrite=True, output_verify='silentfix')
+            os.replace(f"{outfile}.tmp", outfile)
+            print(f"  wrote {outfile}")
+    shutil.rmtree(workdir)
+    print(f"Done in {time.time() - t0:.0f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
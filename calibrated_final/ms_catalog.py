@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+"""
+One-pass metadata catalog of the SgrB2 measurement sets.
+
+Scripts used to open msmetadata over and over (check_field_in_ms for every
+field x SPW x MS combination, get_phasecenter, get_field_coords.py).  This
+module scans each MS once -- all MSs in parallel, one worker process per
+MS -- and records:
+
+    fields       - name, ID and phase center of every field
+    spws         - channel count, channel frequencies and widths of every SPW
+    rows         - visibility rows per field and SPW (from the FIELD_ID and
+                   DATA_DESC_ID columns)
+    flag_fraction - flagged fraction per field and per SPW (optional, --flags;
+                   needs a flagdata summary pass over the data)
+
+into a JSON index (ms_catalog.json next to this file) keyed by MS path and
+modification time.  Queries go through the index and only rescan an MS when
+it is missing or has changed on disk, so the scripts transparently share
+the one scan.  Reading the index needs no CASA; scanning needs casatools.
+
+Usage:
+    python ms_catalog.py build [MS ...] [--workers N] [--flags]
+    python ms_catalog.py show [MS ...]
+    python ms_catalog.py validate
+
+With no MS arguments, build/show use every MS under measurement_sets/ and
+temp_line/.  ``validate`` compares the hardcoded SPW channel counts of the
+imaging scripts (chunk_planner.TOTALNCHAN) with the catalog.
+
+Examples:
+    python ms_catalog.py build --workers 8
+    python ms_catalog.py show measurement_sets/uid___A002_X12c4b14_X77b0_targets_line.ms
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import fcntl
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+BASEDIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_CATALOG = os.path.join(BASEDIR, 'ms_catalog.json')
+MS_PATTERNS = ['measurement_sets/uid*.ms', 'temp_line/uid*.ms']
+
+_CACHE = {}
+
+
+# ===========================
+# Scanning (needs CASA)
+# ===========================
+
+def ms_mtime(vis):
+    """Newest modification time of the MS's top-level table files."""
+    # table.lock is rewritten whenever the MS is merely opened
+    return max(os.path.getmtime(os.path.join(vis, name)) for name in os.listdir(vis)
+               if name != 'table.lock')
+
+
+def scan_ms(vis, flags=False):
+    """Read the catalog entry of one MS."""
+    import numpy as np
+    from casatools import msmetadata, table
+    msmd = msmetadata()
+    msmd.open(vis)
+    fields = {}
+    for fid, name in enumerate(msmd.fieldnames()):
+        direction = msmd.phasecenter(fid)
+        fields[name] = {'id': fid,
+                        'ra_rad': direction['m0']['value'],
+                        'dec_rad': direction['m1']['value'],
+                        'frame': direction['refer']}
+    spws = {}
+    for spw in range(msmd.nspw()):
+        freqs = msmd.chanfreqs(spw)
+        spws[str(spw)] = {'nchan': int(msmd.nchan(spw)),
+                          'chanfreqs_hz': freqs.tolist(),
+                          'chanwidth_hz': float(np.median(msmd.chanwidths(spw))),
+                          'name': msmd.namesforspws(spw)[0]}
+    msmd.close()
+
+    # Rows per field and SPW from two integer columns, in one pass
+    tb = table()
+    tb.open(os.path.join(vis, 'DATA_DESCRIPTION'))
+    ddid_spw = tb.getcol('SPECTRAL_WINDOW_ID')
+    tb.close()
+    tb.open(vis)
+    field_ids = tb.getcol('FIELD_ID')
+    ddids = tb.getcol('DATA_DESC_ID')
+    tb.close()
+    names = {info['id']: name for name, info in fields.items()}
+    rows = {}
+    keys, counts = np.unique(np.stack([field_ids, ddid_spw[ddids]]), axis=1, return_counts=True)
+    for (fid, spw), count in zip(keys.T, counts):
+        rows.setdefault(names[int(fid)], {})[str(int(spw))] = int(count)
+
+    entry = {'mtime': ms_mtime(vis), 'scanned': time.time(),
+             'fields': fields, 'spws': spws, 'rows': rows}
+
+    if flags:
+        from casatasks import flagdata
+        summary = flagdata(vis=vis, mode='summary', action='calculate')
+        entry['flag_fraction'] = {
+            'field': {name: counts['flagged'] / counts['total']
+                      for name, counts in summary['field'].items() if counts['total']},
+            'spw': {spw: counts['flagged'] / counts['total']
+                    for spw, counts in summary['spw'].items() if counts['total']},
+        }
+    return entry
+
+
+# ===========================
+# Index
+# ===========================
+
+def load_catalog(path=DEFAULT_CATALOG):
+    if path in _CACHE:
+        return _CACHE[path]
+    catalog = {}
+    if os.path.exists(path):
+        with open(path) as fh:
+            catalog = json.load(fh)
+    _CACHE[path] = catalog
+    return catalog
+
+
+def _update_catalog(entries, path=DEFAULT_CATALOG):
+    """Merge new entries into the on-disk catalog (locked, atomic)."""
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        catalog = {}
+        if os.path.exists(path):
+            with open(path) as fh:
+                catalog = json.load(fh)
+        catalog.update(entries)
+        with open(f'{path}.tmp', 'w') as fh:
+            json.dump(catalog, fh)
+        os.replace(f'{path}.tmp', path)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+    _CACHE[path] = catalog
+    return catalog
+
+
+def is_stale(entry, vis):
+    return entry is None or abs(entry['mtime'] - ms_mtime(vis)) > 1e-3
+
+
+def build_catalog(ms_list, workers=1, flags=False, force=False, path=DEFAULT_CATALOG, log=print):
+    """Scan every MS that is missing from the catalog or changed, in parallel."""
+    catalog = load_catalog(path)
+    ms_list = [os.path.abspath(vis) for vis in ms_list]
+    todo = [vis for vis in ms_list
+            if force or is_stale(catalog.get(vis), vis)
+            or (flags and 'flag_fraction' not in catalog[vis])]
+    log(f"MS catalog {path}: {len(ms_list) - len(todo)} up to date, scanning {len(todo)}"
+        f" with {min(workers, max(len(todo), 1))} worker(s)")
+    if not todo:
+        return catalog
+
+    def run_worker(vis):
+        cmd = [sys.executable, os.path.abspath(__file__), 'scan-one', vis]
+        if flags:
+            cmd.append('--flags')
+        proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                              universal_newlines=True)
+        if proc.returncode != 0:
+            raise RuntimeError(f"Scanning {vis} failed (exit {proc.returncode}):\n{proc.stderr[-2000:]}")
+        log(f"  Scanned {os.path.basename(vis)}")
+        return vis, json.loads(proc.stdout.strip().splitlines()[-1])
+
+    t0 = time.time()
+    if workers <= 1:
+        entries = {vis: scan_ms(vis, flags=flags) for vis in todo}
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            entries = dict(pool.map(run_worker, todo))
+    log(f"  Scanned {len(entries)} MSs in {time.time() - t0:.0f}s")
+    return _update_catalog(entries, path)
+
+
+def get_entry(vis, path=DEFAULT_CATALOG):
+    """Catalog entry of an MS, scanning it first if it is missing or changed."""
+    vis = os.path.abspath(vis)
+    entry = load_catalog(path).get(vis)
+    if is_stale(entry, vis):
+        entry = scan_ms(vis)
+        _update_catalog({vis: entry}, path)
+    return entry
+
+
+# ===========================
+# Queries
+# ===========================
+
+def field_names(vis):
+    return list(get_entry(vis)['fields'])
+
+
+def has_field(vis, field):
+    """Replacement for check_field_in_ms."""
+    return field in get_entry(vis)['fields']
+
+
+def phasecenter(vis, field):
+    """Phase center of a field as a CASA string, 'ICRS HH:MM:SS.SSSS +DD.MM.SS.SSS'."""
+    from astropy.coordinates import SkyCoord
+    import astropy.units as u
+    fields = get_entry(vis)['fields']
+    if field not in fields:
+        raise ValueError(f"Field {field} not found in {vis}")
+    info = fields[field]
+    coord = SkyCoord(ra=info['ra_rad'] * u.rad, dec=info['dec_rad'] * u.rad, frame='icrs')
+    ra_str = coord.ra.to_string(unit=u.hour, sep=':', precision=4, pad=True)
+    dec_str = coord.dec.to_string(unit=u.deg, sep='.', precision=3, alwayssign=True, pad=True)
+    return f"{info['frame']} {ra_str} {dec_str}"
+
+
+def spw_info(vis, spw):
+    return get_entry(vis)['spws'][str(spw)]
+
+
+def row_count(vis, field, spw):
+    return get_entry(vis)['rows'].get(field, {}).get(str(spw), 0)
+
+
+def catalog_rows(ms_list, field, spw, path=DEFAULT_CATALOG):
+    """
+    Row counts of ``field``/``spw`` in each MS from the catalog alone.
+
+    Returns None if any MS is not catalogued (no scanning, no CASA needed),
+    e.g. for the chunk planner on a login node.
+    """
+    catalog = load_catalog(path)
+    rows = []
+    for vis in ms_list:
+        entry = catalog.get(os.path.abspath(vis))
+        if entry is None:
+            return None
+        rows.append(entry['rows'].get(field, {}).get(str(spw), 0))
+    return rows
+
+
+def default_ms_list():
+    ms_list = []
+    for pattern in MS_PATTERNS:
+        ms_list.extend(sorted(glob.glob(os.path.join(BASEDIR, pattern))))
+    return ms_list
+
+
+def validate(path=DEFAULT_CATALOG):
+    """Compare hardcoded SPW channel counts with the catalogued MSs; return the number of mismatches."""
+    sys.path.insert(0, os.path.join(BASEDIR, 'chunked_imaging'))
+    import chunk_planner
+    catalog = load_catalog(path)
+    mismatches = 0
+    for vis, entry in sorted(catalog.items()):
+        for spw, nchan in chunk_planner.TOTALNCHAN.items():
+            info = entry['spws'].get(spw)
+            if info is not None and info['nchan'] != nchan:
+                print(f"MISMATCH {os.path.basename(vis)} SPW {spw}: {info['nchan']} channels,"
+                      f" chunk_planner.TOTALNCHAN says {nchan}")
+                mismatches += 1
+    print(f"Checked {len(catalog)} MSs: {mismatches} mismatches")
+    return mismatches
+
+
+def print_entry(vis, entry):
+    print(f"{vis}")
+    for name, info in entry['fields'].items():
+        nrows = sum(entry['rows'].get(name, {}).values())
+        print(f"  field {info['id']:3d} {name:20s} {nrows:10d} rows")
+    for spw, info in entry['spws'].items():
+        if info['nchan'] > 1:
+            freqs = info['chanfreqs_hz']
+            print(f"  spw {spw:>3s} {info['nchan']:5d} chan  {min(freqs) / 1e9:.4f}-{max(freqs) / 1e9:.4f} GHz"
+                  f"  width {info['chanwidth_hz'] / 1e3:.1f} kHz")
+    if 'flag_fraction' in entry:
+        for name, frac in entry['flag_fraction']['field'].items():
+            print(f"  flagged {name}: {100 * frac:.1f}%")
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv and argv[0] == 'scan-one':
+        # Worker mode: print one entry as JSON
+        print(json.dumps(scan_ms(argv[1], flags='--flags' in argv)))
+        return 0
+
+    parser = argparse.ArgumentParser(description='One-pass MS metadata catalog')
+    parser.add_argument('command', choices=['build', 'show', 'validate'])
+    parser.add_argument('ms', nargs='*', help='Measurement sets (default: all)')
+    parser.add_argument('--workers', type=int, default=int(os.getenv('SLURM_CPUS_PER_TASK', '4')))
+    parser.add_argument('--flags', action='store_true', help='Also record flag fractions (slow)')
+    parser.add_argument('--force', action='store_true', help='Rescan even if up to date')
+    parser.add_argument('--catalog', default=DEFAULT_CATALOG)
+    args = parser.parse_args(argv)
+
+    if args.command == 'validate':
+        return 1 if validate(args.catalog) else 0
+
+    ms_list = args.ms or default_ms_list()
+    if args.command == 'build':
+        build_catalog(ms_list, workers=args.workers, flags=args.flags, force=args.force,
+                      path=args.catalog)
+    else:
+        catalog = load_catalog(args.catalog)
+        for vis in ms_list:
+            entry = catalog.get(os.path.abspath(vis))
+            if entry is None:
+                print(f"{vis}: not catalogued (run 'build')")
+            else:
+                print_entry(vis, entry)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
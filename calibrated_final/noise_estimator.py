@@ -0,0 +1,403 @@
+#!/usr/bin/env python
+"""
+Per-channel noise spectra of the SgrB2 cubes, measured on the residuals.
+
+The clean threshold (THRESHOLD in image_cubes.py and the chunk script) is a
+fixed 1.5 mJy chosen for an expected RMS of ~800 uJy/beam, but the noise
+varies across each SPW (atmospheric lines, band edges, bright-line
+channels).  This measures it: for every channel of a residual it computes
+a robust RMS, 1.4826 x the median absolute deviation of the pixels inside
+the primary beam (pb >= --pblimit, from the matching .pb image).
+
+The residual is read in channel blocks with a spatial stride (--stride,
+default 4, i.e. 1/16 of the pixels, which still leaves ~500k pixels per
+2880x2880 plane), and the medians of all planes in a block are taken with
+one sort rather than a loop over channels.
+
+Inputs per field/SPW, in order of preference:
+    the merged residual       working_chunks/DS6_spw29/oussid.SgrB2_DS6_sci.spw29.cube.I.residual
+                              or cube_images/oussid.SgrB2_DS6_sci.spw29.cube.I.residual
+    the chunk residuals       working_chunks/DS6_spw29/oussid.SgrB2_DS6_sci.spw29.*+*.cube.I.residual
+                              (complete chunks only: .done marker, or no lease)
+
+The spectrum is written to noise_spectra/<field>_spw<spw>.noise.json (what
+the imaging scripts and moment_maps.py --noise-spectrum read) and a .csv
+copy for analysis.  Residuals whose modification time is unchanged since
+the last run are not read again, so re-running while chunks complete only
+measures the new ones.
+
+Imaging scripts can use the measured noise for the clean threshold: with
+NOISE_NSIGMA=N set, image_cubes.py and sgrb2_chunk_imaging.py clean to
+N x the median RMS of the channels being imaged (see clean_threshold);
+without a spectrum they keep their fixed threshold.
+
+Usage:
+    python noise_estimator.py [RESIDUAL ...] [--field FIELD] [--spw SPW] [--stride N]
+                              [--pblimit PB] [--block-mb MB] [--output-dir DIR] [--overwrite] [--list]
+
+Examples:
+    python noise_estimator.py                      # every field/SPW with residuals
+    python noise_estimator.py --field DS6 --spw 29 --stride 2
+    python noise_estimator.py working_chunks/DS9_spw25/oussid.SgrB2_DS9_sci.spw25.cube.I.residual
+"""
+
+import os
+import re
+import sys
+import csv
+import glob
+import json
+import time
+import argparse
+from collections import defaultdict
+
+import numpy as np
+
+import casa_script
+from casa_script import script_args
+
+# ===========================
+# Configuration
+# ===========================
+
+BASEDIR = casa_script.BASEDIR  # calibrated_final/
+RESIDUAL_PATTERNS = ['working_chunks/*_spw*/oussid.SgrB2_*.cube.I.residual',
+                     'cube_images/oussid.SgrB2_*.cube.I.residual']
+NOISE_DIR = os.path.join(BASEDIR, 'noise_spectra')
+
+STRIDE = 4          # read every STRIDE-th pixel along x and y
+PBLIMIT = 0.5       # inner primary beam only (tclean images down to pb=0.2)
+MIN_PIXELS = 100    # fewer valid pixels in a plane -> no estimate
+MAD_TO_SIGMA = 1.4826
+
+RESIDUAL_RE = re.compile(r'oussid\.SgrB2_(?P<field>.+)_sci\.spw(?P<spw>\d+)'
+                         r'(?:\.(?P<startchan>\d{4})\+(?P<nchan>\d{3}))?\.cube\.I\.residual$')
+
+
+def field_clean(field):
+    # as in chunked_imaging/chunk_orchestrator.py
+    return field.replace('_', '')
+
+
+def spectrum_path(field, spw, output_dir=NOISE_DIR):
+    return os.path.join(output_dir, f"{field_clean(field)}_spw{spw}.noise.json")
+
+
+# ===========================
+# Estimation
+# ===========================
+
+def nan_median_rows(block):
+    """Median of each row of a 2D array, ignoring NaNs, with one sort for all rows."""
+    ordered = np.sort(block, axis=1)  # NaNs sort last
+    count = np.count_nonzero(~np.isnan(ordered), axis=1)
+    rows = np.arange(len(block))
+    median = 0.5 * (ordered[rows, np.maximum(count - 1, 0) // 2] + ordered[rows, count // 2])
+    median[count == 0] = np.nan
+    return median, count
+
+
+def plane_rms(planes):
+    """
+    Robust RMS of each plane of a (chan, npix) array (invalid pixels NaN).
+
+    Returns (rms, npix): 1.4826 x MAD per plane and the number of valid
+    pixels; planes with fewer than MIN_PIXELS valid pixels get NaN.
+    """
+    median, count = nan_median_rows(planes)
+    planes -= median[:, None]
+    np.abs(planes, out=planes)
+    mad, _ = nan_median_rows(planes)
+    rms = MAD_TO_SIGMA * mad
+    rms[count < MIN_PIXELS] = np.nan
+    return rms, count
+
+
+def read_block(ia, c0, c1, ndim, stride):
+    """(chan, npix) float32 block of channels [c0, c1) every ``stride`` pixels, masked pixels NaN."""
+    blc = [0] * (ndim - 1) + [c0]
+    trc = [-1] * (ndim - 1) + [c1 - 1]
+    inc = [stride, stride] + [1] * (ndim - 2)
+    data = ia.getchunk(blc=blc, trc=trc, inc=inc, dropdeg=False)
+    valid = ia.getchunk(blc=blc, trc=trc, inc=inc, dropdeg=False, getmask=True)
+    # (x, y, [stokes,] chan) -> (chan, npix)
+    data = np.asarray(data, dtype='f4').reshape(-1, c1 - c0).T.copy()
+    data[~np.asarray(valid).reshape(-1, c1 - c0).T] = np.nan
+    return data
+
+
+def measure_residual(residual, stride=STRIDE, pblimit=PBLIMIT, block_mb=512):
+    """
+    Per-channel noise of one residual image.
+
+    Returns {'freq_hz', 'rms_jy', 'npix'} lists (one entry per channel) and
+    the pb image used (None if there is no .pb next to the residual).
+    """
+    from casatools import image
+    ia, pb = image(), image()
+    ia.open(residual)
+    summary = ia.summary(list=False)
+    shape = [int(n) for n in summary['shape']]
+    if list(summary['axisnames'])[-1] != 'Frequency':
+        ia.close()
+        raise ValueError(f"{residual}: expected frequency as the last axis")
+    ndim, nchan = len(shape), shape[-1]
+    refval, refpix, incr = (summary[key][-1] for key in ('refval', 'refpix', 'incr'))
+    freqs = refval + (np.arange(nchan) - refpix) * incr
+
+    pbname = re.sub(r'\.residual$', '.pb', residual)
+    if os.path.exists(pbname):
+        pb.open(pbname)
+    else:
+        print(f"  WARNING: no {os.path.basename(pbname)}; using every unmasked pixel")
+        pbname = None
+
+    npix = -(-shape[0] // stride) * -(-shape[1] // stride)
+    # data, pb and the sort copies
+    block = max(1, int(block_mb * 2**20 / (npix * 4 * 4)))
+    rms, count = np.full(nchan, np.nan), np.zeros(nchan, dtype=int)
+    for c0 in range(0, nchan, block):
+        c1 = min(c0 + block, nchan)
+        planes = read_block(ia, c0, c1, ndim, stride)
+        if pbname:
+            planes[~(read_block(pb, c0, c1, ndim, stride) >= pblimit)] = np.nan
+        rms[c0:c1], count[c0:c1] = plane_rms(planes)
+    ia.close()
+    if pbname:
+        pb.close()
+    ia.done()
+    pb.done()
+    return {'freq_hz': freqs.tolist(),
+            'rms_jy': [None if np.isnan(value) else float(value) for value in rms],
+            'npix': count.tolist()}, pbname
+
+
+# ===========================
+# Inputs and spectra
+# ===========================
+
+def chunk_complete(residual):
+    imagename = residual[:-len('.residual')]
+    return os.path.exists(f"{imagename}.done") or not os.path.exists(f"{imagename}.lease")
+
+
+def find_inputs(paths=None):
+    """
+    Residuals to measure per (field, spw): the newest merged residual, else
+    the complete chunk residuals.  Each input is (path, startchan).
+    """
+    paths = paths or sorted(path for pattern in RESIDUAL_PATTERNS
+                            for path in glob.glob(os.path.join(BASEDIR, pattern)))
+    merged, chunks = defaultdict(list), defaultdict(list)
+    for path in paths:
+        path = path.rstrip('/')
+        match = RESIDUAL_RE.search(os.path.basename(path))
+        if match is None:
+            print(f"  WARNING: not a cube residual name, skipped: {path}")
+            continue
+        key = (field_clean(match['field']), match['spw'])
+        if match['startchan'] is None:
+            merged[key].append((path, 0))
+        elif chunk_complete(path):
+            chunks[key].append((path, int(match['startchan'])))
+    inputs = {}
+    for key in sorted(set(merged) | set(chunks)):
+        if merged[key]:
+            inputs[key] = [max(merged[key], key=lambda item: os.path.getmtime(item[0]))]
+        else:
+            inputs[key] = sorted(chunks[key], key=lambda item: item[1])
+    return inputs
+
+
+def load_spectrum(field, spw, output_dir=NOISE_DIR):
+    """The noise spectrum of a field/SPW, or None if it has not been measured."""
+    path = spectrum_path(field, spw, output_dir)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def build_spectrum(field, spw, inputs, previous=None, stride=STRIDE, pblimit=PBLIMIT, block_mb=512):
+    """
+    Noise spectrum of a field/SPW from its residuals, reusing the channels of
+    ``previous`` for residuals that have not changed since it was written.
+    """
+    reuse = {}
+    if previous and previous.get('stride') == stride and previous.get('pblimit') == pblimit:
+        for source in previous['sources']:
+            reuse[source['image']] = source
+    sources, channels = [], {}
+    for path, startchan in inputs:
+        mtime = os.path.getmtime(path)
+        old = reuse.get(path)
+        if old and old['mtime'] == mtime and old['startchan'] == startchan:
+            lo = startchan
+            measured = {key: previous[key][lo:lo + old['nchan']] for key in ('freq_hz', 'rms_jy', 'npix')}
+            pbname = old['pb']
+            print(f"  unchanged  {os.path.basename(path)}")
+        else:
+            t0 = time.time()
+            measured, pbname = measure_residual(path, stride, pblimit, block_mb)
+            values = [value for value in measured['rms_jy'] if value is not None]
+            median = f"{np.median(values) * 1e3:.3f} mJy" if values else "-"
+            print(f"  measured   {os.path.basename(path)}: {len(measured['rms_jy'])} channels, "
+                  f"median RMS {median} ({time.time() - t0:.0f}s)")
+        for offset, (freq, rms, npix) in enumerate(zip(measured['freq_hz'], measured['rms_jy'],
+                                                          measured['npix'])):
+            channels[startchan + offset] = (freq, rms, npix)
+        sources.append({'image': path, 'startchan': startchan, 'nchan': len(measured['rms_jy']),
+                        'mtime': mtime, 'pb': pbname})
+
+    nchan = max(channels) + 1 if channels else 0
+    freq_hz, rms_jy, npix = ([None] * nchan for _ in range(3))
+    for chan, (freq, rms, count) in channels.items():
+        freq_hz[chan], rms_jy[chan], npix[chan] = freq, rms, count
+    values = [value for value in rms_jy if value is not None]
+    return {
+        'field': field,
+        'spw': spw,
+        'nchan': nchan,
+        'unit': 'Jy/beam',
+        'estimator': f'{MAD_TO_SIGMA} x MAD of pixels with pb >= {pblimit}, stride {stride}',
+        'stride': stride,
+        'pblimit': pblimit,
+        'median_rms_jy': float(np.median(values)) if values else None,
+        'channels_measured': len(values),
+        'freq_hz': freq_hz,
+        'rms_jy': rms_jy,
+        'npix': npix,
+        'sources': sources,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def write_spectrum(spectrum, output_dir=NOISE_DIR):
+    """Write the .noise.json spectrum and its .csv copy (atomically); return the JSON path."""
+    os.makedirs(output_dir, exist_ok=True)
+    path = spectrum_path(spectrum['field'], spectrum['spw'], output_dir)
+    with open(f"{path}.tmp", 'w') as fh:
+        json.dump(spectrum, fh, indent=1)
+    os.replace(f"{path}.tmp", path)
+    csvpath = path[:-len('.json')] + '.csv'
+    with open(f"{csvpath}.tmp", 'w', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['chan', 'freq_hz', 'rms_jy', 'npix'])
+        for chan, row in enumerate(zip(spectrum['freq_hz'], spectrum['rms_jy'], spectrum['npix'])):
+            writer.writerow([chan] + ['' if value is None else value for value in row])
+    os.replace(f"{csvpath}.tmp", csvpath)
+    return path
+
+
+# ===========================
+# Consumers
+# ===========================
+
+def spectrum_rms(spectrum, startchan=0, nchan=None):
+    """Median measured RMS (Jy/beam) over channels [startchan, startchan + nchan), or None."""
+    stop = len(spectrum['rms_jy']) if nchan is None else startchan + nchan
+    values = [value for value in spectrum['rms_jy'][startchan:stop] if value is not None]
+    return float(np.median(values)) if values else None
+
+
+def rms_at(spectrum, freqs):
+    """Measured RMS at each frequency in ``freqs`` (Hz), nearest channel; gaps get the median."""
+    known = [(freq, rms) for freq, rms in zip(spectrum['freq_hz'], spectrum['rms_jy'])
+             if freq is not None and rms is not None]
+    if not known:
+        raise ValueError(f"No measured channels in the {spectrum['field']} SPW {spectrum['spw']} spectrum")
+    known.sort()
+    spec_freqs, spec_rms = (np.array(column) for column in zip(*known))
+    freqs = np.asarray(freqs, dtype=float)
+    upper = np.clip(np.searchsorted(spec_freqs, freqs), 0, len(spec_freqs) - 1)
+    lower = np.maximum(upper - 1, 0)
+    nearest = np.where(np.abs(freqs - spec_freqs[lower]) < np.abs(freqs - spec_freqs[upper]), lower, upper)
+    rms = spec_rms[nearest]
+    # More than a channel away from any measured channel: a gap in the spectrum
+    width = np.median(np.diff(spec_freqs)) if len(spec_freqs) > 1 else np.inf
+    rms[np.abs(freqs - spec_freqs[nearest]) > 1.5 * width] = np.median(spec_rms)
+    return rms
+
+
+def clean_threshold(field, spw, startchan=0, nchan=None, default='1.5mJy', nsigma=None):
+    """
+    tclean threshold for channels [startchan, startchan + nchan) of a cube.
+
+    NOISE_NSIGMA times the median measured RMS of those channels if
+    NOISE_NSIGMA is set (or ``nsigma`` is given) and the field/SPW has a
+    noise spectrum; ``default`` otherwise.
+    """
+    if nsigma is None:
+        if not os.getenv('NOISE_NSIGMA'):
+            return default
+        nsigma = float(os.getenv('NOISE_NSIGMA'))
+    spectrum = load_spectrum(field, spw)
+    rms = spectrum_rms(spectrum, startchan, nchan) if spectrum else None
+    if rms is None:
+        print(f"  No measured noise for {field} SPW {spw} (run noise_estimator.py); "
+              f"threshold stays {default}")
+        return default
+    threshold = f"{nsigma * rms * 1e3:.4f}mJy"
+    print(f"  Measured RMS {rms * 1e3:.4f} mJy/beam -> threshold {nsigma:g} x RMS = {threshold}")
+    return threshold
+
+
+# ===========================
+# MAIN
+# ===========================
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Per-channel noise spectra of the SgrB2 residual cubes')
+    parser.add_argument('residuals', nargs='*', help='Residual images (default: all merged or chunk residuals)')
+    parser.add_argument('--field', help='Only this field')
+    parser.add_argument('--spw', help='Only this SPW')
+    parser.add_argument('--stride', type=int, default=STRIDE, help='Spatial subsampling step in pixels')
+    parser.add_argument('--pblimit', type=float, default=PBLIMIT, help='Use pixels with pb >= PBLIMIT')
+    parser.add_argument('--block-mb', type=float, default=512, help='Memory per channel block')
+    parser.add_argument('--output-dir', default=NOISE_DIR)
+    parser.add_argument('--overwrite', action='store_true', help='Re-measure unchanged residuals')
+    parser.add_argument('--list', action='store_true', help='Only list the residuals that would be read')
+    args = parser.parse_args(script_args('noise_estimator.py') if argv is None else argv)
+
+    inputs = find_inputs(args.residuals)
+    inputs = {(field, spw): items for (field, spw), items in inputs.items()
+              if (args.field is None or field == field_clean(args.field))
+              and (args.spw is None or spw == str(args.spw))}
+    if not inputs:
+        print("ERROR: No residuals found")
+        return 1
+
+    for (field, spw), items in inputs.items():
+        merged = RESIDUAL_RE.search(os.path.basename(items[0][0]))['startchan'] is None
+        kind = 'merged residual' if merged else f'{len(items)} chunk residual(s)'
+        print(f"{field} SPW {spw}: {kind} -> {spectrum_path(field, spw, args.output_dir)}")
+        if args.list:
+            for path, _ in items:
+                print(f"    {path}")
+    if args.list:
+        return 0
+
+    t0 = time.time()
+    rows = []
+    for (field, spw), items in inputs.items():
+        print(f"\n{field} SPW {spw}")
+        previous = None if args.overwrite else load_spectrum(field, spw, args.output_dir)
+        spectrum = build_spectrum(field, spw, items, previous, args.stride, args.pblimit, args.block_mb)
+        path = write_spectrum(spectrum, args.output_dir)
+        print(f"  wrote {path}")
+        rows.append(spectrum)
+
+    print(f"\n{'Field':15s} {'SPW':>4s} {'chan':>6s} {'measured':>9s} {'median':>10s} {'min':>10s} "
+          f"{'max':>10s}  (mJy/beam)")
+    for spectrum in rows:
+        values = [value for value in spectrum['rms_jy'] if value is not None]
+        stats = [f"{stat(values) * 1e3:10.4f}" if values else f"{'-':>10s}"
+                 for stat in (np.median, min, max)]
+        print(f"{spectrum['field']:15s} {spectrum['spw']:>4s} {spectrum['nchan']:6d} "
+              f"{spectrum['channels_measured']:9d} {' '.join(stats)}")
+    print(f"\nDone in {time.time() - t0:.0f}s")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
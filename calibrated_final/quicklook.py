@@ -0,0 +1,82 @@
+"""
+Quick-look cube parameters for SgrB2 imaging.
+
+A full cube is a 2880x2880 native-resolution tclean run of 1916-3840
+channels and takes days.  A quick-look cube covers the same field of view
+and the whole band, but
+
+    - bins QUICKLOOK_BIN native channels (default 8) into each image channel
+    - uses a 4x coarser cell (0.1 arcsec) and a 720x720 image
+    - runs dirty (QUICKLOOK_NITER, default 0 iterations) or lightly cleaned
+
+so every field/SPW can be previewed in well under an hour to check data
+quality and line content before the full run is committed.
+
+Quick-look mode is selected with QUICKLOOK=1 (or --quicklook) in
+image_cubes.py, the chunk pipeline (sgrb2_chunk_imaging.py, via
+chunk_orchestrator.py --quicklook) and submit_cube_jobs.sh.  Products go to
+separate directories (cube_images/quicklook/, working_chunks/quicklook/)
+so they never mix with full-resolution products.
+"""
+
+import os
+import re
+
+# ===========================
+# Configuration
+# ===========================
+
+IMSIZE = [720, 720]   # same ~72 arcsec field of view as the full cubes
+CELL = '0.1arcsec'
+THRESHOLD = '5mJy'    # only used when QUICKLOOK_NITER > 0
+
+SUBDIR = 'quicklook'
+
+
+def enabled(argv=()):
+    """True if quick-look mode is requested (QUICKLOOK=1 or --quicklook)."""
+    return os.getenv('QUICKLOOK', '0') == '1' or '--quicklook' in argv
+
+
+def chan_bin():
+    """Native channels per quick-look image channel."""
+    return int(os.getenv('QUICKLOOK_BIN', '8'))
+
+
+def niter():
+    return int(os.getenv('QUICKLOOK_NITER', '0'))
+
+
+def binned_axis(start, width, nchan, nbin=None):
+    """
+    Binned tclean (start, width, nchan) for a native spectral axis.
+
+    ``start``/``width`` are either tclean quantities ('132.89GHz',
+    '0.977MHz') or, for native gridding, a channel index and ''.  In the
+    latter case the width becomes the integer number of channels to bin.
+    ``nchan`` is the number of native channels (-1 for all); partial bins at
+    the upper edge are dropped when the axis is given in frequency.
+    """
+    nbin = chan_bin() if nbin is None else nbin
+    if width:
+        value, unit = re.match(r'([\d.eE+-]+)\s*(\w+)', width).groups()
+        width = f'{float(value) * nbin:.7f}{unit}'
+        return start, width, (nchan // nbin if nchan > 0 else nchan)
+    return start, nbin, (-(-nchan // nbin) if nchan > 0 else nchan)
+
+
+def tclean_overrides():
+    """tclean arguments that differ from the full-resolution runs."""
+    nit = niter()
+    return {
+        'imsize': IMSIZE,
+        'cell': CELL,
+        'niter': nit,
+        'threshold': THRESHOLD if nit > 0 else '0mJy',
+        'usemask': 'auto-multithresh' if nit > 0 else 'user',
+    }
+
+
+def describe():
+    return (f"QUICK-LOOK: {chan_bin()}x channel binning, {IMSIZE[0]}x{IMSIZE[1]} x {CELL}, "
+            f"niter={niter()}")
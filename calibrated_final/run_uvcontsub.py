@@ -4,18 +4,64 @@ Run continuum subtraction for fields that are missing from the line measurement
 
 This script processes DS6, DS7-DS8, and DS9 for all SPWs (23, 25, 27, 29) by:
 1. Reading continuum ranges from cont.dat
-2. Running uvcontsub on each MS/field/SPW combination
-3. Creating *_targets_line.ms files with continuum subtracted
+2. Running uvcontsub on each MS/field/SPW combination (one "task" each)
+3. Creating temp_line/*_line.ms files with continuum subtracted
+
+Tasks are independent and idempotent: each writes its output MS atomically
+(via <output>.tmp) and a result record to temp_line/contsub_records/<output>.json.
+The records are the manifest of the outputs: each holds a content hash of
+the task's inputs -- the parsed fitspec, the input MS identity (path and
+modification time) and the uvcontsub parameters -- and a task whose record
+says 'ok' with the same hash, and whose output exists, is skipped.  Editing
+cont.dat for one field therefore only redoes that field's changed SPWs.
+Tasks can be run
+
+    local - by a pool of N worker processes on this node (--workers N; the
+            default is SLURM_CPUS_PER_TASK, and 1 runs the tasks in-process)
+    slurm - as a SLURM array, one array element per task (--mode slurm,
+            run with plain python3 on the login node), followed by a job
+            that prints the summary and runs split_line_ms.py
+
+Either way the summary at the end (from the records) has the same counts as
+the serial version: total combinations, skipped (field not in MS),
+successfully processed and failed.
+
+With --multi-spw (or CONTSUB_MULTI_SPW=1) a task is one MS/field instead:
+a single uvcontsub call with a combined fitspec ("23:...,25:...,...")
+subtracts every SPW in one read pass of the MS and writes
+temp_line/<ms>_<field>_line.ms.  The per-SPW names the imaging scripts use
+(temp_line/<ms>_<field>_spwNN_line.ms) are created as symlinks to it, and
+temp_line/line_ms_index.json maps each per-SPW name to the multi-SPW MS.
+uvcontsub keeps the original SPW IDs (23, 25, 27, 29), so the imaging
+scripts select the SPW as usual.  The record of a multi-SPW task also holds
+one hash per SPW (the hash its single-SPW task would have).  When only some
+SPWs' ranges change, only those are redone: each with its own single-SPW
+uvcontsub, whose MS replaces the per-SPW symlink.  A change to the MS or
+the uvcontsub parameters redoes the whole multi-SPW task, which also
+removes these single-SPW MSs again.
 
 Usage:
-    casa -c run_uvcontsub.py
+    casa -c run_uvcontsub.py [--workers N] [--multi-spw]
+    casa -c run_uvcontsub.py --task-index N     # one task (SLURM array element)
+    casa -c run_uvcontsub.py --summary
+    python3 run_uvcontsub.py --mode slurm [--max-concurrent 16] [--dry-run]
+    python3 run_uvcontsub.py --list              # with up-to-date/changed status
 """
 
 import os
 import sys
 import glob
+import json
+import time
+import fcntl
 import shutil
-from casatasks import uvcontsub
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import ms_catalog
+from casa_script import script_args, run_script
 
 # Field name mapping: cont.dat uses different names than MSs
 FIELD_NAME_MAP = {
@@ -30,6 +76,23 @@ FIELDS_TO_PROCESS = ['DS6', 'DS7-DS8', 'DS9']
 # SPWs to process
 SPWS = ['23', '25', '27', '29']
 
+# uvcontsub parameters (part of each output's content hash)
+UVCONTSUB_PARAMS = {
+    'fitmethod': 'gsl',
+    'fitorder': 1,
+    'writemodel': False,
+}
+
+CONT_DAT = 'caltables/cont.dat'
+MS_PATTERN = 'measurement_sets/uid*_targets.ms'
+OUTPUT_DIR = 'temp_line'
+RECORD_DIR = os.path.join(OUTPUT_DIR, 'contsub_records')
+LINE_MS_INDEX = os.path.join(OUTPUT_DIR, 'line_ms_index.json')
+
+# SLURM array mode
+CONTSUB_JOB = '/orange/adamginsburg/sgrb2/2024.1.01182.S/calibrated_final/submit_contsub.sh'
+LOG_DIR = '/blue/adamginsburg/adamginsburg/logs'
+
 
 def parse_cont_dat(cont_dat_path):
     """
@@ -72,51 +135,267 @@ def parse_cont_dat(cont_dat_path):
 
 
 def check_field_in_ms(vis, field):
-    """Check if a field exists in a measurement set."""
-    from casatools import msmetadata
-    msmd = msmetadata()
-    msmd.open(vis)
-    fields = list(msmd.fieldnames())
-    msmd.close()
-    return field in fields
+    """Check if a field exists in a measurement set (via the MS catalog)."""
+    return ms_catalog.has_field(vis, field)
+
+
+def output_name(vis, field, spw=None):
+    """Output MS of one MS/field/SPW task (or of a multi-SPW task if spw is None)."""
+    ms_basename = os.path.basename(vis).replace('_targets.ms', '')
+    if spw is None:
+        return f"{OUTPUT_DIR}/{ms_basename}_{field.replace('-','')}_line.ms"
+    return f"{OUTPUT_DIR}/{ms_basename}_{field.replace('-','')}_spw{spw}_line.ms"
+
+
+def build_fitspec(spw_ranges):
+    """
+    uvcontsub fitspec for {spw: cont.dat ranges}, e.g. "23:a~b;c~d,25:e~f".
+
+    The ranges from cont.dat are just "freq~freq;freq~freq" and need the SPW
+    number prepended; their " LSRK" suffix is removed (uvcontsub doesn't
+    accept it).
+    """
+    return ','.join(f"{spw}:{ranges.replace(' LSRK', '')}" for spw, ranges in spw_ranges.items())
+
+
+def update_line_ms_index(links, outputvis):
+    """
+    Record per-SPW name -> multi-SPW MS in LINE_MS_INDEX (under a lock); with
+    outputvis None, remove the per-SPW names (they are single-SPW MSs now).
+    """
+    with open(f'{LINE_MS_INDEX}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        index = {}
+        if os.path.exists(LINE_MS_INDEX):
+            with open(LINE_MS_INDEX) as fh:
+                index = json.load(fh)
+        for spw, link in links.items():
+            if outputvis is None:
+                index.pop(os.path.basename(link), None)
+            else:
+                index[os.path.basename(link)] = {'vis': os.path.basename(outputvis), 'spw': spw}
+        with open(f'{LINE_MS_INDEX}.tmp', 'w') as fh:
+            json.dump(index, fh, indent=2, sort_keys=True)
+        os.replace(f'{LINE_MS_INDEX}.tmp', LINE_MS_INDEX)
+
+
+def link_spw_outputs(links, outputvis):
+    """Point the per-SPW output names at the multi-SPW MS."""
+    for spw, link in links.items():
+        if os.path.islink(link):
+            os.remove(link)
+        elif os.path.exists(link):
+            print(f"  ! {os.path.basename(link)} is a single-SPW MS from an earlier run; leaving it")
+            continue
+        os.symlink(os.path.basename(outputvis), link)
+    update_line_ms_index(links, outputvis)
+
+
+def record_path(outputvis):
+    return os.path.join(RECORD_DIR, os.path.basename(outputvis).replace('.ms', '.json'))
+
+
+def read_record(outputvis):
+    path = record_path(outputvis)
+    if not os.path.exists(path):
+        return None
+    with open(path) as fh:
+        return json.load(fh)
+
+
+def write_record(task, status, t_start, error=None, split_spws=()):
+    """
+    Write the result record of a task (atomically).
+
+    ``split_spws`` are the SPWs of a multi-SPW task that were redone as
+    single-SPW MSs.
+    """
+    os.makedirs(RECORD_DIR, exist_ok=True)
+    record = dict(task)
+    if status == 'ok':
+        record['hash'], record['components'] = content_hash(task)
+        if task.get('spw_fitspecs'):
+            record['spw_hashes'] = spw_hashes(task)
+            record['split_spws'] = sorted(split_spws)
+    record.update({
+        'status': status,
+        'error': error,
+        'start': t_start,
+        'end': time.time(),
+        'wall_s': time.time() - t_start,
+        'host': os.uname().nodename,
+        'slurm_job_id': os.getenv('SLURM_JOB_ID'),
+        'slurm_array_task_id': os.getenv('SLURM_ARRAY_TASK_ID'),
+    })
+    path = record_path(task['outputvis'])
+    with open(f'{path}.tmp', 'w') as fh:
+        json.dump(record, fh, indent=2)
+    os.replace(f'{path}.tmp', path)
+    return record
+
+
+def input_identity(vis):
+    """Identity of an input MS: absolute path and modification time."""
+    return {'path': os.path.abspath(vis), 'mtime': ms_catalog.ms_mtime(vis)}
+
 
+def content_hash(task):
+    """
+    Hash of everything that determines a task's output.
+
+    Returns (hash, components); the components are stored in the record so
+    a changed hash can be explained.
+    """
+    components = {
+        'fitspec': task['fitspec'],
+        'field': task['field'],
+        'input': input_identity(task['vis']),
+        'params': UVCONTSUB_PARAMS,
+    }
+    digest = hashlib.sha256(json.dumps(components, sort_keys=True).encode()).hexdigest()
+    return digest, components
+
+
+def spw_hashes(task):
+    """Per-SPW hashes of a multi-SPW task: the content hash of each SPW's single-SPW task."""
+    return {spw: content_hash(dict(task, fitspec=fitspec))[0]
+            for spw, fitspec in task['spw_fitspecs'].items()}
+
+
+def task_state(task, record=None):
+    """
+    'done' if the task's output is up to date, else why it needs to run:
+    'new', 'failed', 'missing output', or the inputs that changed.  For a
+    multi-SPW task where only some SPWs changed this is 'changed spw: 23,25'.
+    """
+    record = read_record(task['outputvis']) if record is None else record
+    if record is None:
+        return 'new'
+    if record['status'] != 'ok':
+        return record['status']
+    if not os.path.exists(task['outputvis']):
+        return 'missing output'
+    split = record.get('split_spws', [])
+    if any(not os.path.isdir(task['links'][spw]) for spw in split if spw in task.get('links', {})):
+        return 'missing output'
+    digest, components = content_hash(task)
+    if record.get('hash') == digest:
+        return 'done'
+    if task.get('spw_fitspecs') and record.get('spw_hashes'):
+        current = spw_hashes(task)
+        changed = [spw for spw in current if record['spw_hashes'].get(spw) != current[spw]]
+        if changed and len(changed) < len(current):
+            return 'changed spw: ' + ','.join(changed)
+    old = record.get('components', {})
+    changed = [name for name in components if old.get(name) != components[name]]
+    return 'changed: ' + ', '.join(changed or ['hash'])
 
-def run_contsub_for_field_spw(vis, field, spw, fitspec):
+
+def get_all_ms():
+    """All measurement sets (non-line versions), sorted so task indices are stable."""
+    all_ms = sorted(glob.glob(MS_PATTERN))
+    # Filter to only non-line MSs (exclude *_line.ms)
+    return [ms for ms in all_ms if not ms.endswith('_targets_line.ms')]
+
+
+def build_tasks(continuum_ranges, all_ms, multi_spw=False, log=print):
+    """
+    Enumerate the MS/field/SPW tasks, in the order the serial loop ran them
+    (MS/field tasks covering every SPW with continuum ranges if multi_spw).
+
+    Field/SPW combinations without continuum ranges are reported and left
+    out; whether the field is in the MS is decided when the task runs.
+    """
+    tasks = []
+    for field in FIELDS_TO_PROCESS:
+        # Map to cont.dat field name
+        cont_field = None
+        for cont_name, ms_name in FIELD_NAME_MAP.items():
+            if ms_name == field:
+                cont_field = cont_name
+                break
+        
+        if cont_field not in continuum_ranges:
+            log(f"WARNING: No continuum ranges found for {field} (looked for {cont_field})")
+            continue
+        
+        spw_ranges = {}
+        for spw in SPWS:
+            if spw not in continuum_ranges[cont_field]:
+                log(f"WARNING: No continuum ranges for {field} SPW {spw}")
+                continue
+            spw_ranges[spw] = continuum_ranges[cont_field][spw]
+        
+        if multi_spw and spw_ranges:
+            for vis in all_ms:
+                tasks.append({
+                    'index': len(tasks),
+                    'vis': vis,
+                    'field': field,
+                    'spw': ','.join(spw_ranges),
+                    'fitspec': build_fitspec(spw_ranges),
+                    'spw_fitspecs': {spw: build_fitspec({spw: spw_ranges[spw]}) for spw in spw_ranges},
+                    'outputvis': output_name(vis, field),
+                    'links': {spw: output_name(vis, field, spw) for spw in spw_ranges},
+                })
+            continue
+        
+        for spw in spw_ranges:
+            for vis in all_ms:
+                tasks.append({
+                    'index': len(tasks),
+                    'vis': vis,
+                    'field': field,
+                    'spw': spw,
+                    'fitspec': build_fitspec({spw: spw_ranges[spw]}),
+                    'outputvis': output_name(vis, field, spw),
+                })
+    return tasks
+
+
+def load_tasks(multi_spw=False, log=print):
+    """Parse cont.dat, find the MSs and enumerate the tasks."""
+    if not os.path.exists(CONT_DAT):
+        print(f"ERROR: cont.dat not found at {CONT_DAT}")
+        sys.exit(1)
+    
+    log(f"Reading continuum ranges from {CONT_DAT}...")
+    continuum_ranges = parse_cont_dat(CONT_DAT)
+    log(f"Found continuum definitions for {len(continuum_ranges)} fields")
+    
+    all_ms = get_all_ms()
+    if len(all_ms) == 0:
+        print(f"ERROR: No measurement sets found matching {MS_PATTERN}")
+        sys.exit(1)
+    log(f"Found {len(all_ms)} measurement sets to process")
+    
+    return all_ms, build_tasks(continuum_ranges, all_ms, multi_spw=multi_spw, log=log)
+
+
+def run_contsub_for_field_spw(vis, field, spw, fitspec, outputvis):
     """
     Run uvcontsub for a specific field and SPW.
     
     Creates a temporary output MS for each field/SPW combo, which will need
-    to be combined later.
+    to be combined later.  The MS is written as <outputvis>.tmp and renamed
+    when uvcontsub succeeds, so outputvis only ever holds a complete MS.
     
     Args:
         vis: Input measurement set (non-line version)
         field: Field name
-        spw: SPW number as string
-        fitspec: Continuum frequency ranges for fitting
+        spw: SPW number(s) as string, e.g. '23' or '23,25,27,29'
+        fitspec: uvcontsub fitspec (from build_fitspec)
+        outputvis: Output measurement set
     """
-    # Check if field exists in this MS
-    if not check_field_in_ms(vis, field):
-        print(f"  ✗ Field '{field}' not found in {vis.split('/')[-1]}")
-        return False
+    from casatasks import uvcontsub
     
-    # Create unique output name for this field/SPW combo
-    ms_basename = os.path.basename(vis).replace('_targets.ms', '')
-    outputvis = f"temp_line/{ms_basename}_{field.replace('-','')}_spw{spw}_line.ms"
+    os.makedirs(os.path.dirname(outputvis), exist_ok=True)
     
-    # Create temp directory if needed
-    if not os.path.exists('temp_line'):
-        os.makedirs('temp_line')
-    
-    # If output exists, remove it (uvcontsub won't overwrite)
-    if os.path.exists(outputvis):
-        print(f"  ! Removing existing {os.path.basename(outputvis)}")
-        shutil.rmtree(outputvis)
-    
-    # Convert fitspec to include SPW number (format: "spw:freq~freq;freq~freq")
-    # The fitspec from cont.dat is just "freq~freq;freq~freq"
-    # Remove " LSRK" suffix if present (uvcontsub doesn't accept it)
-    fitspec_clean = fitspec.replace(' LSRK', '')
-    fitspec_with_spw = f"{spw}:{fitspec_clean}"
+    # uvcontsub won't overwrite: clear a partial output of an interrupted run
+    tmpvis = f'{outputvis}.tmp'
+    if os.path.exists(tmpvis):
+        print(f"  ! Removing partial {os.path.basename(tmpvis)}")
+        shutil.rmtree(tmpvis)
     
     print(f"\n{'='*80}")
     print(f"Running uvcontsub:")
@@ -124,95 +403,141 @@ def run_contsub_for_field_spw(vis, field, spw, fitspec):
     print(f"  Output: {os.path.basename(outputvis)}")
     print(f"  Field:  {field}")
     print(f"  SPW:    {spw}")
-    print(f"  Fitspec: {fitspec_with_spw[:70]}...")
+    print(f"  Fitspec: {fitspec[:70]}...")
     print(f"{'='*80}")
     
+    uvcontsub(
+        vis=vis,
+        outputvis=tmpvis,
+        field=field,
+        fitspec=fitspec,
+        **UVCONTSUB_PARAMS
+    )
+    if os.path.islink(outputvis):
+        # Left by a --multi-spw run
+        os.remove(outputvis)
+    elif os.path.exists(outputvis):
+        print(f"  ! Removing existing {os.path.basename(outputvis)}")
+        shutil.rmtree(outputvis)
+    os.rename(tmpvis, outputvis)
+    print(f"  ✓ Successfully created {os.path.basename(outputvis)}")
+
+
+def run_task(task):
+    """
+    Run one MS/field/SPW task and record its result.
+
+    Returns the status: 'ok', 'skipped' (field not in MS) or 'failed'.
+    """
+    t_start = time.time()
+    vis, field, spw, outputvis = task['vis'], task['field'], task['spw'], task['outputvis']
+    
+    # Check if this field exists in this MS
+    if not check_field_in_ms(vis, field):
+        print(f"  ✗ Field '{field}' not found in {vis.split('/')[-1]}")
+        return write_record(task, 'skipped', t_start)['status']
+    
+    state = task_state(task)
+    if state == 'done':
+        print(f"  ✓ {os.path.basename(outputvis)} up to date, skipping")
+        return 'ok'
+    if state.startswith('changed spw: '):
+        # Multi-SPW task: redo only the changed SPWs, as single-SPW MSs
+        changed = state[len('changed spw: '):].split(',')
+        split = set(read_record(outputvis).get('split_spws', [])) | set(changed)
+        print(f"  ! SPW {', '.join(changed)} of {os.path.basename(outputvis)} out of date, "
+              "redoing as single-SPW MSs")
+        try:
+            for spw_changed in changed:
+                run_contsub_for_field_spw(vis, field, spw_changed, task['spw_fitspecs'][spw_changed],
+                                          task['links'][spw_changed])
+            update_line_ms_index({spw_changed: task['links'][spw_changed] for spw_changed in changed}, None)
+        except Exception as e:
+            print(f"  ✗ ERROR: {str(e)}")
+            return write_record(task, 'failed', t_start, error=str(e))['status']
+        return write_record(task, 'ok', t_start, split_spws=split)['status']
+    if state.startswith('changed'):
+        print(f"  ! {os.path.basename(outputvis)} out of date ({state}), redoing")
+    
+    record = read_record(outputvis)
     try:
-        uvcontsub(
-            vis=vis,
-            outputvis=outputvis,
-            field=field,
-            fitspec=fitspec_with_spw,
-            fitmethod='gsl',
-            fitorder=1,
-            writemodel=False
-        )
-        print(f"  ✓ Successfully created {os.path.basename(outputvis)}")
-        return True
-        
+        run_contsub_for_field_spw(vis, field, spw, task['fitspec'], outputvis)
+        if task.get('links'):
+            # SPWs redone on their own earlier are covered by the new MS again
+            for spw_split in (record or {}).get('split_spws', []):
+                link = task['links'].get(spw_split)
+                if link and os.path.isdir(link) and not os.path.islink(link):
+                    shutil.rmtree(link)
+            link_spw_outputs(task['links'], outputvis)
     except Exception as e:
         print(f"  ✗ ERROR: {str(e)}")
-        return False
+        return write_record(task, 'failed', t_start, error=str(e))['status']
+    return write_record(task, 'ok', t_start)['status']
 
 
-def main():
-    """Main execution function."""
-    
-    # Parse cont.dat
-    cont_dat_path = 'caltables/cont.dat'
-    if not os.path.exists(cont_dat_path):
-        print(f"ERROR: cont.dat not found at {cont_dat_path}")
-        sys.exit(1)
+def run_local(tasks, workers, multi_spw=False):
+    """Run tasks with up to ``workers`` concurrent CASA processes (in-process if 1)."""
+    if workers <= 1:
+        for task in tasks:
+            run_task(task)
+        return
     
-    print(f"Reading continuum ranges from {cont_dat_path}...")
-    continuum_ranges = parse_cont_dat(cont_dat_path)
-    print(f"Found continuum definitions for {len(continuum_ranges)} fields")
+    print(f"Running {len(tasks)} tasks with {workers} worker processes")
     
-    # Get all measurement sets (non-line versions)
-    ms_pattern = 'measurement_sets/uid*_targets.ms'
-    all_ms = sorted(glob.glob(ms_pattern))
+    def run_worker(task):
+        proc = run_script('run_uvcontsub.py', ['--task-index', task['index']]
+                          + (['--multi-spw'] if multi_spw else []))
+        record = read_record(task['outputvis'])
+        status = record['status'] if record is not None else 'failed'
+        print(f"[{task['index']:3d}] {status:7s} {os.path.basename(task['outputvis'])}")
+        if proc.returncode != 0 or status == 'failed':
+            print(proc.stdout[-2000:])
     
-    # Filter to only non-line MSs (exclude *_line.ms)
-    all_ms = [ms for ms in all_ms if not ms.endswith('_targets_line.ms')]
-    
-    if len(all_ms) == 0:
-        print(f"ERROR: No measurement sets found matching {ms_pattern}")
-        sys.exit(1)
-    
-    print(f"Found {len(all_ms)} measurement sets to process")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        list(pool.map(run_worker, tasks))
+
+
+def submit_array(tasks, max_concurrent, multi_spw=False, dry_run=False):
+    """Submit one SLURM array element per task plus a dependent summary/split job."""
+    array_spec = f"0-{len(tasks) - 1}%{max_concurrent}"
+    cmd = ['sbatch', '--parsable', f'--array={array_spec}',
+           '--job-name=contsub_task', '--cpus-per-task=1', '--mem=8gb', '--time=08:00:00',
+           f'--export=ALL,CONTSUB_STEP=task,CONTSUB_MULTI_SPW={int(multi_spw)}',
+           f'--output={LOG_DIR}/contsub_task_%A_%a.out',
+           f'--error={LOG_DIR}/contsub_task_%A_%a.err',
+           CONTSUB_JOB]
+    print(' '.join(cmd))
+    if dry_run:
+        return None
+    array_id = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True,
+                              check=True).stdout.strip().split(';')[0]
+    print(f"Submitted contsub array {array_id} ({array_spec})")
     
-    # Track statistics
-    total_tasks = 0
+    # Summary + split once every task has finished, whatever its outcome
+    cmd = ['sbatch', '--parsable', f'--dependency=afterany:{array_id}',
+           '--job-name=contsub_finish',
+           f'--export=ALL,CONTSUB_STEP=finish,CONTSUB_MULTI_SPW={int(multi_spw)}', CONTSUB_JOB]
+    finish_id = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True,
+                               check=True).stdout.strip().split(';')[0]
+    print(f"Submitted summary/split job {finish_id} (afterany:{array_id})")
+    return array_id
+
+
+def summarize(tasks):
+    """Print the summary counts from the task records; return the number failed."""
+    total_tasks = len(tasks)
     completed_tasks = 0
     skipped_tasks = 0
     
-    # Process each field
-    for field in FIELDS_TO_PROCESS:
-        print(f"\n{'#'*80}")
-        print(f"# Processing field: {field}")
-        print(f"{'#'*80}")
-        
-        # Map to cont.dat field name
-        cont_field = None
-        for cont_name, ms_name in FIELD_NAME_MAP.items():
-            if ms_name == field:
-                cont_field = cont_name
-                break
-        
-        if cont_field not in continuum_ranges:
-            print(f"WARNING: No continuum ranges found for {field} (looked for {cont_field})")
+    for task in tasks:
+        record = read_record(task['outputvis'])
+        if record is None:
             continue
-        
-        # Process each SPW
-        for spw in SPWS:
-            if spw not in continuum_ranges[cont_field]:
-                print(f"\nWARNING: No continuum ranges for {field} SPW {spw}")
-                continue
-            
-            fitspec = continuum_ranges[cont_field][spw]
-            
-            # Process each MS
-            for vis in all_ms:
-                total_tasks += 1
-                
-                # Check if this field exists in this MS
-                if not check_field_in_ms(vis, field):
-                    skipped_tasks += 1
-                    continue
-                
-                success = run_contsub_for_field_spw(vis, field, spw, fitspec)
-                if success:
-                    completed_tasks += 1
+        if record['status'] == 'skipped':
+            skipped_tasks += 1
+        elif task_state(task, record) == 'done':
+            completed_tasks += 1
+    failed_tasks = total_tasks - skipped_tasks - completed_tasks
     
     # Summary
     print(f"\n{'='*80}")
@@ -221,13 +546,69 @@ def main():
     print(f"Total combinations checked: {total_tasks}")
     print(f"Skipped (field not in MS):  {skipped_tasks}")
     print(f"Successfully processed:      {completed_tasks}")
-    print(f"Failed:                      {total_tasks - skipped_tasks - completed_tasks}")
+    print(f"Failed:                      {failed_tasks}")
+    print(f"Task records:                {RECORD_DIR}/")
     print(f"{'='*80}")
+    return failed_tasks
+
+
+def main(argv=None):
+    """Main execution function."""
+    parser = argparse.ArgumentParser(description='Parallel uvcontsub over MS/field/SPW tasks')
+    parser.add_argument('--mode', choices=['local', 'slurm'], default='local',
+                        help='local process pool (default) or SLURM array submission')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('CONTSUB_WORKERS', os.getenv('SLURM_CPUS_PER_TASK', '1'))),
+                        help='Concurrent uvcontsub processes in local mode')
+    parser.add_argument('--task-index', type=int,
+                        help='Run a single task (default in a SLURM array: SLURM_ARRAY_TASK_ID)')
+    parser.add_argument('--max-concurrent', type=int, default=16,
+                        help='Array throttle in slurm mode')
+    parser.add_argument('--multi-spw', action='store_true',
+                        default=os.getenv('CONTSUB_MULTI_SPW', '0') == '1',
+                        help='One uvcontsub per MS/field covering all SPWs')
+    parser.add_argument('--summary', action='store_true', help='Only print the summary')
+    parser.add_argument('--list', action='store_true', help='List the tasks and exit')
+    parser.add_argument('--dry-run', action='store_true', help='Print the sbatch command only')
+    args = parser.parse_args(script_args('run_uvcontsub.py') if argv is None else argv)
+    
+    if args.task_index is None and os.getenv('CONTSUB_STEP') == 'task':
+        args.task_index = int(os.environ['SLURM_ARRAY_TASK_ID'])
+    
+    quiet = args.task_index is not None or args.list
+    all_ms, tasks = load_tasks(multi_spw=args.multi_spw, log=(lambda msg: None) if quiet else print)
+    
+    if args.list:
+        for task in tasks:
+            state = task_state(task) if os.path.exists(task['vis']) else 'no input'
+            print(f"{task['index']:3d}  {task['field']:8s} {task['spw']:12s} {state:24s} {task['vis']}")
+        return 0
+    
+    if args.task_index is not None:
+        if not 0 <= args.task_index < len(tasks):
+            print(f"ERROR: task index {args.task_index} out of range (0-{len(tasks) - 1})")
+            return 1
+        return 0 if run_task(tasks[args.task_index]) != 'failed' else 1
+    
+    if args.summary:
+        summarize(tasks)
+        return 0
+    
+    if args.mode == 'slurm':
+        submit_array(tasks, args.max_concurrent, multi_spw=args.multi_spw, dry_run=args.dry_run)
+        return 0
+    
+    # Scan all MSs once (in parallel); field checks in the tasks use the catalog
+    ms_catalog.build_catalog(all_ms, workers=max(4, args.workers))
+    
+    run_local(tasks, args.workers, multi_spw=args.multi_spw)
+    summarize(tasks)
     
     print("\nNOTE: uvcontsub created temporary field/SPW-specific line MSs in temp_line/")
     print("      These need to be concatenated with the existing *_targets_line.ms files")
     print("      Run the concat_line_ms.py script next to combine them.")
+    return 0
 
 
 if __name__ == '__main__':
-    main()
+    sys.exit(main())
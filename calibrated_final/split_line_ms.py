@@ -6,14 +6,30 @@ This should be run AFTER run_uvcontsub.py has completed.
 It extracts the CORRECTED_DATA column (which contains continuum-subtracted data)
 from the original MSs into new *_targets_line.ms files for the specified fields.
 
+Only the target fields present in each MS and the science SPWs are copied
+(mstransform with reindex=False, so the SPW IDs stay 23, 25, 27, 29 as the
+imaging scripts expect).  MSs are split concurrently, one worker process
+each (--workers, default SLURM_CPUS_PER_TASK), and every output is written
+to node-local scratch ($SLURM_TMPDIR, or SCRATCH_DIR) first, then moved
+next to its final name and renamed into place, so measurement_sets/ never
+holds a partial MS.  Bytes read and written (from /proc/self/io) and the
+wall time of every MS are reported.
+
 Usage:
-    casa -c split_line_ms.py
+    casa -c split_line_ms.py [--workers N] [--fields DS6,DS9] [--no-scratch]
 """
 
 import os
 import sys
 import glob
-from casatasks import split
+import json
+import time
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import ms_catalog
+from casa_script import script_args, run_script, json_result
 
 # Fields to process (those missing from line MSs)
 FIELDS_TO_PROCESS = ['DS6', 'DS7-DS8', 'DS9']
@@ -21,25 +37,63 @@ FIELDS_TO_PROCESS = ['DS6', 'DS7-DS8', 'DS9']
 # SPWs to process
 SPWS = ['23', '25', '27', '29']
 
+GB = 1024**3
+
 
 def check_field_in_ms(vis, field):
-    """Check if a field exists in a measurement set."""
-    from casatools import msmetadata
-    msmd = msmetadata()
-    msmd.open(vis)
-    fields = list(msmd.fieldnames())
-    msmd.close()
-    return field in fields
+    """Check if a field exists in a measurement set (via the MS catalog)."""
+    return ms_catalog.has_field(vis, field)
+
+
+def proc_io():
+    """I/O counters of this process from /proc/self/io (empty if unavailable)."""
+    counters = {}
+    try:
+        with open('/proc/self/io') as fh:
+            for line in fh:
+                key, _, value = line.partition(':')
+                counters[key] = int(value)
+    except OSError:
+        pass
+    return counters
 
 
-def split_line_data(vis, output_dir='measurement_sets'):
+def io_delta(before, after):
+    """Bytes read/written between two proc_io() snapshots."""
+    return {key: after.get(key, 0) - before.get(key, 0)
+            for key in ('read_bytes', 'write_bytes', 'rchar', 'wchar')}
+
+
+def scratch_root(use_scratch=True):
+    """Node-local directory to write outputs in, or None to write in place."""
+    if not use_scratch:
+        return None
+    path = os.getenv('SCRATCH_DIR') or os.getenv('SLURM_TMPDIR')
+    if not path:
+        return None
+    path = os.path.join(path, 'split_line_ms')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def split_line_data(vis, fields, output_dir='measurement_sets', scratch=None):
     """
     Split continuum-subtracted data from CORRECTED_DATA column into a new MS.
     
     Args:
         vis: Input measurement set (with CORRECTED_DATA containing line data)
+        fields: Target fields to keep (those present in vis)
         output_dir: Directory for output line MS
+        scratch: Directory to write the MS in before moving it to output_dir
+    
+    Returns:
+        dict: status, output, wall time and bytes read/written
     """
+    from casatasks import mstransform
+    
+    t0 = time.time()
+    io_start = proc_io()
+    
     # Construct output filename
     ms_basename = os.path.basename(vis)
     if ms_basename.endswith('_targets.ms'):
@@ -49,36 +103,102 @@ def split_line_data(vis, output_dir='measurement_sets'):
         output_basename = ms_basename.replace('.ms', '_line.ms')
     
     output_ms = os.path.join(output_dir, output_basename)
+    staged_ms = os.path.join(output_dir, f'{output_basename}.tmp')
+    write_ms = os.path.join(scratch, output_basename) if scratch else staged_ms
     
-    # Check if output already exists
-    if os.path.exists(output_ms):
-        print(f"  ! Output MS already exists: {output_basename}")
-        print(f"  Removing existing {output_basename}...")
-        os.system(f"rm -rf {output_ms}")
+    # Science SPWs present in this MS
+    spws = [spw for spw in SPWS if spw in ms_catalog.get_entry(vis)['spws']]
     
     print(f"\n{'='*80}")
     print(f"Splitting line MS:")
     print(f"  Input:  {ms_basename}")
     print(f"  Output: {output_basename}")
+    print(f"  Fields: {','.join(fields)}")
+    print(f"  SPWs:   {','.join(spws)}")
+    print(f"  Via:    {write_ms}")
     print(f"{'='*80}")
     
+    result = {'vis': vis, 'output': output_ms, 'fields': fields, 'spws': spws}
     try:
-        split(
+        for path in (write_ms, staged_ms):
+            if os.path.exists(path):
+                shutil.rmtree(path)
+        mstransform(
             vis=vis,
-            outputvis=output_ms,
+            outputvis=write_ms,
+            field=','.join(fields),
+            spw=','.join(spws),
+            reindex=False,
             datacolumn='corrected',  # CORRECTED_DATA contains the continuum-subtracted data
             keepflags=True
         )
+        if write_ms != staged_ms:
+            # Across filesystems: copy next to the final name, then rename
+            shutil.move(write_ms, staged_ms)
+        if os.path.exists(output_ms):
+            print(f"  ! Replacing existing {output_basename}")
+            shutil.rmtree(output_ms)
+        os.rename(staged_ms, output_ms)
         print(f"  ✓ Successfully created {output_basename}")
-        return True
+        result['status'] = 'ok'
         
     except Exception as e:
         print(f"  ✗ ERROR: {str(e)}")
-        return False
+        result['status'] = 'failed'
+        result['error'] = str(e)
+    
+    result['wall_s'] = time.time() - t0
+    result.update(io_delta(io_start, proc_io()))
+    return result
+
+
+def run_worker(vis, fields, output_dir, scratch):
+    """Split one MS in a separate CASA process; return its result dict."""
+    args = ['--split-one', vis, '--fields', ','.join(fields), '--output-dir', output_dir]
+    if scratch is None:
+        args.append('--no-scratch')
+    proc = run_script('split_line_ms.py', args)
+    result = json_result(proc)
+    if result is None:
+        return {'vis': vis, 'status': 'failed', 'error': f'worker exited with {proc.returncode}',
+                'wall_s': 0, 'read_bytes': 0, 'write_bytes': 0, 'rchar': 0, 'wchar': 0}
+    return result
+
 
+def print_io_table(results):
+    print(f"\n{'MS':40s} {'status':7s} {'wall':>8s} {'read GB':>9s} {'write GB':>9s} {'MB/s out':>9s}")
+    for res in results:
+        # read_bytes/write_bytes count storage I/O; rchar/wchar also count cached reads
+        read = res['read_bytes'] or res['rchar']
+        write = res['write_bytes'] or res['wchar']
+        rate = write / 2**20 / res['wall_s'] if res['wall_s'] > 0 else 0
+        print(f"{os.path.basename(res['vis'])[:40]:40s} {res['status']:7s} {res['wall_s']:7.0f}s "
+              f"{read / GB:9.2f} {write / GB:9.2f} {rate:9.1f}")
 
-def main():
+
+def main(argv=None):
     """Main execution function."""
+    parser = argparse.ArgumentParser(description='Split continuum-subtracted line MSs')
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('SLURM_CPUS_PER_TASK', '1')),
+                        help='MSs to split concurrently')
+    parser.add_argument('--fields', default=','.join(FIELDS_TO_PROCESS),
+                        help='Target fields (comma separated)')
+    parser.add_argument('--output-dir', default='measurement_sets')
+    parser.add_argument('--no-scratch', action='store_true',
+                        help='Write outputs in place instead of via node-local scratch')
+    parser.add_argument('--split-one', metavar='MS', help=argparse.SUPPRESS)
+    args = parser.parse_args(script_args('split_line_ms.py') if argv is None else argv)
+    fields = args.fields.split(',')
+    scratch = scratch_root(not args.no_scratch)
+    
+    if args.split_one:
+        # Worker mode: the result is the last line of output
+        vis = args.split_one
+        result = split_line_data(vis, [f for f in fields if check_field_in_ms(vis, f)],
+                                 args.output_dir, scratch)
+        print(json.dumps(result))
+        return 0 if result['status'] == 'ok' else 1
     
     # Get all measurement sets (non-line versions)
     ms_pattern = 'measurement_sets/uid*_targets.ms'
@@ -92,33 +212,39 @@ def main():
         sys.exit(1)
     
     print(f"Found {len(all_ms)} measurement sets")
-    print(f"Will split out line data for fields: {', '.join(FIELDS_TO_PROCESS)}")
+    
+    # Scan all MSs once (in parallel); field checks below use the catalog
+    ms_catalog.build_catalog(all_ms, workers=max(4, args.workers))
+    print(f"Will split out line data for fields: {', '.join(fields)}")
+    print(f"Writing via {'scratch ' + scratch if scratch else 'in-place .tmp MSs'}, "
+          f"{args.workers} worker(s)")
     print()
     
     # Check which MSs have the fields we're interested in
     ms_to_process = []
     for vis in all_ms:
-        has_field = False
-        for field in FIELDS_TO_PROCESS:
-            if check_field_in_ms(vis, field):
-                has_field = True
-                break
-        if has_field:
-            ms_to_process.append(vis)
+        present = [field for field in fields if check_field_in_ms(vis, field)]
+        if present:
+            ms_to_process.append((vis, present))
     
     print(f"Found {len(ms_to_process)} MSs containing target fields")
     print()
     
-    # Track statistics
-    total_processed = 0
-    successful = 0
+    # Process the MSs concurrently
+    t0 = time.time()
+    if args.workers <= 1:
+        results = [split_line_data(vis, present, args.output_dir, scratch)
+                   for vis, present in ms_to_process]
+    else:
+        with ThreadPoolExecutor(max_workers=args.workers) as pool:
+            results = list(pool.map(lambda item: run_worker(item[0], item[1], args.output_dir, scratch),
+                                    ms_to_process))
+    elapsed = time.time() - t0
+    
+    total_processed = len(results)
+    successful = sum(1 for res in results if res['status'] == 'ok')
     
-    # Process each MS
-    for vis in ms_to_process:
-        success = split_line_data(vis)
-        total_processed += 1
-        if success:
-            successful += 1
+    print_io_table(results)
     
     # Summary
     print(f"\n{'='*80}")
@@ -127,6 +253,8 @@ def main():
     print(f"Total MSs processed:  {total_processed}")
     print(f"Successfully split:   {successful}")
     print(f"Failed:               {total_processed - successful}")
+    print(f"Wall time:            {elapsed:.0f}s "
+          f"(sum over MSs {sum(res['wall_s'] for res in results):.0f}s)")
     print(f"{'='*80}")
 
 
@@ -17,10 +17,23 @@
 # to create continuum-subtracted data needed for line imaging.
 #
 # Steps:
-# 1. Run uvcontsub using cont.dat ranges
+# 1. Run uvcontsub using cont.dat ranges, one MS/field/SPW task per
+#    worker process (CONTSUB_WORKERS, default: one per CPU)
 # 2. Split CORRECTED_DATA into *_targets_line.ms files
+#
+# CONTSUB_STEP selects what this job does:
+#   all    - steps 1 and 2 in this job (default; sbatch submit_contsub.sh)
+#   task   - one uvcontsub task, as an element of the array submitted by
+#            'python3 run_uvcontsub.py --mode slurm'
+#   finish - summary of the task records, then step 2 (queued by
+#            --mode slurm after the array)
+#
+# CONTSUB_MULTI_SPW=1 subtracts all SPWs of a field in one uvcontsub call
+# per MS (run_uvcontsub.py --multi-spw).
 ########################################
 
+CONTSUB_STEP=${CONTSUB_STEP:-all}
+
 # CASA path - update this to your CASA installation
 CASA_PATH="/orange/adamginsburg/casa/casa-6.6.6-17-pipeline-2025.1.0.35-py3.10.el8/bin/casa"
 
@@ -40,6 +53,7 @@ echo "Node: $SLURM_NODELIST"
 echo "CPUs: $SLURM_CPUS_PER_TASK"
 echo "Memory: $SLURM_MEM_PER_NODE MB"
 echo "Working Directory: $(pwd)"
+echo "Step: $CONTSUB_STEP${SLURM_ARRAY_TASK_ID:+ (task $SLURM_ARRAY_TASK_ID)}"
 echo "========================================"
 echo ""
 
@@ -58,7 +72,14 @@ echo "STEP 1: Running uvcontsub"
 echo "========================================"
 echo ""
 
-$CASA_PATH --nologger --log2term -c run_uvcontsub.py
+if [ "$CONTSUB_STEP" = "task" ]; then
+    $CASA_PATH --nologger --log2term -c run_uvcontsub.py --task-index $SLURM_ARRAY_TASK_ID
+    exit $?
+elif [ "$CONTSUB_STEP" = "finish" ]; then
+    $CASA_PATH --nologger --log2term -c run_uvcontsub.py --summary
+else
+    $CASA_PATH --nologger --log2term -c run_uvcontsub.py --workers ${CONTSUB_WORKERS:-$SLURM_CPUS_PER_TASK}
+fi
 
 CONTSUB_EXIT=$?
 
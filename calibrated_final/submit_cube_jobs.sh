@@ -25,6 +25,15 @@
 # To submit only specific sources/spws, use:
 #   sbatch --array=0-3 submit_cube_jobs.sh      # Only DS1-5
 #   sbatch --array=0,4,8,12 submit_cube_jobs.sh  # Only SPW 23 for all sources
+#
+# MPI mode (channel-parallel tclean under mpicasa, one process per CPU):
+#   sbatch --export=ALL,USE_MPI=1 submit_cube_jobs.sh
+# The tclean timing (per MPI rank) is written to
+# cube_images/<imagename>.timing.json for comparison with chunked runs.
+#
+# Quick-look previews of all 16 cubes (8x binned channels, coarse cell,
+# dirty; products in cube_images/quicklook/, see quicklook.py):
+#   sbatch --export=ALL,QUICKLOOK=1 --mem=16gb --time=02:00:00 submit_cube_jobs.sh
 
 # Print job information
 echo "========================================"
@@ -92,7 +101,17 @@ esac
 echo
 
 # Set environment variables for CASA
-export OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK
+USE_MPI=${USE_MPI:-0}
+if [ "$USE_MPI" = "1" ]; then
+    # MPI processes do the parallelism; one client + (CPUs - 1) servers
+    export OMP_NUM_THREADS=1
+    NRANKS=${SLURM_CPUS_PER_TASK:-8}
+    CASA_CMD="$(dirname $CASA_PATH)/mpicasa -n $NRANKS $CASA_PATH"
+    echo "MPI mode: mpicasa with $NRANKS processes"
+else
+    export OMP_NUM_THREADS=$SLURM_CPUS_PER_TASK
+    CASA_CMD="$CASA_PATH"
+fi
 
 # Start time
 START_TIME=$(date +%s)
@@ -101,10 +120,10 @@ echo
 
 # Run CASA to image this cube
 echo "Running CASA imaging for cube $CUBE_ID..."
-echo "Command: $CASA_PATH --nologger --log2term -c image_cubes.py $CUBE_ID"
+echo "Command: $CASA_CMD --nologger --log2term -c image_cubes.py $CUBE_ID"
 echo
 
-$CASA_PATH --nologger --log2term -c image_cubes.py $CUBE_ID
+$CASA_CMD --nologger --log2term -c image_cubes.py $CUBE_ID
 
 # Check exit status
 EXIT_STATUS=$?